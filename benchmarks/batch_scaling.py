@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""
+Report batch throughput as the lines get spread across more processes
+"""
+
+import os
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ejpi import ejpi_batch
+
+
+class NullOutput(object):
+
+	def write(self, text):
+		pass
+
+
+def generate_lines(rng, count):
+	# Lines like _save_history writes, a mix of integer, float and symbolic
+	templates = [
+		"%(a)d %(b)d + %(c)d *",
+		"%(a)d.5 %(b)d / sqrt",
+		"0x%(a)x 0x%(b)x & %(c)d |",
+		"%(a)d %(c)d ** %(b)d %%",
+		"x %(a)d * %(b)d +",
+		"%(c)d ! %(a)d -",
+	]
+	for i in xrange(count):
+		values = {
+			"a": rng.randint(1, 999),
+			"b": rng.randint(1, 999),
+			"c": rng.randint(1, 20),
+		}
+		yield rng.choice(templates) % values
+
+
+def run(lineCount, maxJobs, seed):
+	lines = list(generate_lines(random.Random(seed), lineCount))
+
+	print "%d lines" % lineCount
+	baseRate = None
+	for jobs in xrange(1, maxJobs + 1):
+		start = time.time()
+		if jobs == 1:
+			calculator = ejpi_batch.BatchCalculator(*ejpi_batch.load_plugins())
+			failures = calculator.stream(lines, NullOutput(), NullOutput())
+		else:
+			failures = ejpi_batch.stream_parallel(lines, NullOutput(), NullOutput(), jobs)
+		elapsed = time.time() - start
+		assert failures == 0
+
+		rate = lineCount / elapsed
+		if baseRate is None:
+			baseRate = rate
+		print "%2d jobs %8.0f lines/s  speedup %4.2fx" % (jobs, rate, rate / baseRate)
+
+
+if __name__ == "__main__":
+	import optparse
+	import multiprocessing
+
+	opar = optparse.OptionParser()
+	opar.add_option("-n", "--lines", dest="lines", type="int", default=20000, help="Lines to calculate")
+	opar.add_option("-j", "--jobs", dest="jobs", type="int", default=multiprocessing.cpu_count(), help="Most processes to try")
+	opar.add_option("-s", "--seed", dest="seed", type="int", default=0, help="Random seed for the lines")
+	options, args = opar.parse_args(sys.argv[1:])
+
+	run(options.lines, options.jobs, options.seed)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""
+Compare Operation.evaluate against Operation.compile on deep and wide trees
+"""
+
+import os
+import sys
+import operator
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ejpi import operation
+
+
+addition = operation.generate_function(operator.add, "+", operation.Function.REP_INFIX, 2)
+multiplication = operation.generate_function(operator.mul, "*", operation.Function.REP_INFIX, 2)
+
+
+def deep_tree(depth):
+	node = operation.Value(1.0, 10)
+	for i in xrange(depth):
+		Node = addition if i % 2 else multiplication
+		node = Node(node, operation.Value(1.0001, 10))
+	return node
+
+
+def wide_tree(levels):
+	nodes = [operation.Value(float(i), 10) for i in xrange(2 ** levels)]
+	while 1 < len(nodes):
+		nodes = [
+			addition(nodes[i], nodes[i+1])
+			for i in xrange(0, len(nodes), 2)
+		]
+	return nodes[0]
+
+
+def bench(name, tree, number):
+	compiled = tree.compile()
+	assert compiled() == tree.evaluate()
+
+	evaluateTime = min(timeit.repeat(tree.evaluate, number=number, repeat=3))
+	compileTime = min(timeit.repeat(tree.compile, number=1, repeat=3))
+	compiledTime = min(timeit.repeat(compiled, number=number, repeat=3))
+	print "%-12s evaluate %8.3fms  compiled %8.3fms  speedup %5.1fx  (compile once %8.3fms)" % (
+		name,
+		evaluateTime / number * 1000,
+		compiledTime / number * 1000,
+		evaluateTime / compiledTime,
+		compileTime * 1000,
+	)
+
+
+if __name__ == "__main__":
+	import optparse
+
+	opar = optparse.OptionParser()
+	opar.add_option("-d", "--depth", dest="depth", type="int", default=400, help="Depth of the deep tree")
+	opar.add_option("-w", "--levels", dest="levels", type="int", default=12, help="Levels of the wide tree")
+	opar.add_option("-n", "--number", dest="number", type="int", default=100, help="Evaluations per measurement")
+	options, args = opar.parse_args(sys.argv[1:])
+
+	bench("deep(%d)" % options.depth, deep_tree(options.depth), options.number)
+	bench("wide(2**%d)" % options.levels, wide_tree(options.levels), options.number)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""
+Microbenchmarks of the calculator engine's hot paths
+
+Cases register themselves with @benchmark, returning the callable to time
+from their setup.  Results are kept as JSON so a later run can be compared
+against them and regressions flagged, see __main__ for the command line.
+"""
+
+from __future__ import with_statement
+
+import sys
+import time
+import fnmatch
+
+try:
+	import json as simplejson
+except ImportError:
+	import simplejson
+
+
+BASELINE_VERSION = 1
+
+
+_benchmarks = []
+
+
+def benchmark(name):
+	"""
+	Register a case, the decorated function does the setup and returns the
+	callable to time
+	"""
+
+	def register(setup):
+		_benchmarks.append((name, setup))
+		return setup
+
+	return register
+
+
+def iter_benchmarks(patterns = ()):
+	"""
+	@param patterns fnmatch patterns of the cases to keep, all of them when
+		empty
+	"""
+	import cases
+
+	for name, setup in _benchmarks:
+		if not patterns or any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns):
+			yield name, setup
+
+
+def measure(func, repeat = 5, minTime = 0.05):
+	"""
+	@returns the best seconds per call, after picking enough calls per
+		repetition that timer resolution doesn't matter
+	"""
+	number = 1
+	while True:
+		elapsed = _time_calls(func, number)
+		if minTime <= elapsed:
+			break
+		number *= 2
+
+	best = elapsed
+	for i in xrange(repeat - 1):
+		best = min(best, _time_calls(func, number))
+	return best / number
+
+
+def _time_calls(func, number):
+	calls = xrange(number)
+	start = time.time()
+	for i in calls:
+		func()
+	return time.time() - start
+
+
+def save_baseline(path, results):
+	data = {
+		"version": BASELINE_VERSION,
+		"python": sys.version.split()[0],
+		"results": results,
+	}
+	with open(path, "w") as f:
+		simplejson.dump(data, f, indent=1, sort_keys=True)
+
+
+def load_baseline(path):
+	with open(path, "r") as f:
+		data = simplejson.load(f)
+	if data.get("version") != BASELINE_VERSION:
+		raise ValueError("%s is a version %r baseline, expected %r" % (path, data.get("version"), BASELINE_VERSION))
+	return data["results"]
+
+
+def compare(baseline, results, threshold):
+	"""
+	@param threshold the fraction a case may slow down by before it counts
+		as a regression
+	@returns (name, ratio, isRegression) for each case in both, ratio being
+		current over baseline time
+
+	>>> list(compare({"a": 1.0, "b": 1.0, "old": 1.0}, {"a": 1.05, "b": 1.5, "new": 1.0}, 0.1))
+	[('a', 1.05, False), ('b', 1.5, True)]
+	"""
+	for name in sorted(results.iterkeys()):
+		if name not in baseline:
+			continue
+		ratio = results[name] / baseline[name]
+		yield name, ratio, 1.0 + threshold < ratio
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""
+Run from the top of the tree:
+
+	python -m benchmarks.engine --save baseline.json
+	python -m benchmarks.engine --compare baseline.json --threshold 0.1
+"""
+
+import sys
+
+from benchmarks import engine
+
+
+def run(args):
+	import optparse
+
+	opar = optparse.OptionParser(usage="python -m benchmarks.engine [options] [PATTERN]...")
+	opar.add_option("--save", dest="save", default=None, help="Write the results to this JSON baseline")
+	opar.add_option("--compare", dest="compare", default=None, help="Compare the results against this JSON baseline")
+	opar.add_option("--threshold", dest="threshold", type="float", default=0.1, help="Slowdown, as a fraction, beyond which a case is a regression")
+	opar.add_option("-r", "--repeat", dest="repeat", type="int", default=5, help="Repetitions per case, the best is kept")
+	opar.add_option("-l", "--list", action="store_true", dest="list", default=False, help="List the cases without running them")
+	options, patterns = opar.parse_args(args)
+
+	benchmarks = list(engine.iter_benchmarks(patterns))
+	if options.list:
+		for name, setup in benchmarks:
+			print name
+		return 0
+
+	baseline = engine.load_baseline(options.compare) if options.compare is not None else {}
+
+	results = {}
+	regressions = []
+	for name, setup in benchmarks:
+		seconds = engine.measure(setup(), options.repeat)
+		results[name] = seconds
+		line = "%-32s %10.2fus" % (name, seconds * 1e6)
+		if name in baseline:
+			((name, ratio, isRegression), ) = engine.compare(baseline, {name: seconds}, options.threshold)
+			line += "  %6.2fx" % ratio
+			if isRegression:
+				line += "  REGRESSION"
+				regressions.append(name)
+		print line
+		sys.stdout.flush()
+
+	if options.save is not None:
+		engine.save_baseline(options.save, results)
+	if options.compare is not None:
+		missing = sorted(set(baseline.iterkeys()) - set(results.iterkeys()))
+		if missing and not patterns:
+			print "Not measured: %s" % ", ".join(missing)
+		if regressions:
+			print "%d of %d cases regressed beyond %.0f%%" % (len(regressions), len(results), options.threshold * 100)
+			return 1
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(run(sys.argv[1:]))
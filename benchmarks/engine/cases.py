@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+"""
+The engine hot paths, each case sized like a single user action
+"""
+
+from ejpi import history
+from ejpi import operation
+from ejpi import ejpi_batch
+from ejpi.util import overloading
+
+from benchmarks.engine import benchmark
+
+
+_plugins = None
+
+
+def _load_plugins():
+	global _plugins
+	if _plugins is None:
+		_plugins = ejpi_batch.load_plugins()
+	return _plugins
+
+
+class _NoEntry(object):
+
+	def get_value(self):
+		return ""
+
+	def clear(self):
+		pass
+
+
+class _RaiseErrors(object):
+
+	def push_exception(self):
+		raise
+
+
+def _rpn_history():
+	constants, operators = _load_plugins()
+	return history.RpnCalcHistory(
+		history.CalcHistory(), _NoEntry(), _RaiseErrors(), constants, operators
+	)
+
+
+def _parse_case(name, text):
+
+	@benchmark("parse_number.%s" % name)
+	def setup():
+		parse_number = history.parse_number
+		return lambda: parse_number(text)
+
+
+_parse_case("int", "123456")
+_parse_case("hex", "0xdeadbeef")
+_parse_case("float", "3.14159")
+_parse_case("complex", "1+2j")
+
+
+@benchmark("parse_number.invalid")
+def setup_parse_invalid():
+	parse_number = history.parse_number
+
+	def parse():
+		try:
+			parse_number("x")
+		except ValueError:
+			pass
+
+	return parse
+
+
+@benchmark("scan_line")
+def setup_scan_line():
+	scan_line = history.scan_line
+	line = "1 2.5 + x * 0x10 pi ** 1+2j 3 0b101 y"
+	return lambda: list(scan_line(line))
+
+
+def _apply_case(name, tokens, symbol):
+
+	@benchmark("apply_operation.%s" % name)
+	def setup():
+		rpn = _rpn_history()
+		Node = rpn.OPERATIONS[symbol]
+		stack = rpn.history
+		rpn.deserialize_stack((tokens, ))
+		nodes = list(stack)
+		stack.clear()
+
+		def apply():
+			for node in nodes:
+				stack.push(node)
+			rpn._apply_operation(Node)
+			stack.pop()
+
+		return apply
+
+
+_apply_case("add", ["1", "2"], "+")
+_apply_case("symbolic", ["x", "2"], "*")
+_apply_case("unary", ["2.0"], "sqrt")
+_apply_case("fold", ["1", "x", "+", "2"], "+")
+
+
+def _construct_case(symbol):
+
+	@benchmark("construct.%s" % symbol)
+	def setup():
+		constants, operators = _load_plugins()
+		Node = operators[symbol]
+		args = [operation.Value(3, 10)] * Node.argumentCount
+		return lambda: Node(*args)
+
+
+def _register_construct_cases():
+	constants, operators = _load_plugins()
+	for symbol in sorted(operators.iterkeys()):
+		_construct_case(symbol)
+
+
+_register_construct_cases()
+
+
+def _compute_case(symbol, value):
+
+	@benchmark("compute.%s.%s" % (symbol, type(value).__name__))
+	def setup():
+		constants, operators = _load_plugins()
+		Node = operators[symbol]
+		args = [value] * Node.argumentCount
+		node = Node(*[operation.Value(value, 10)] * Node.argumentCount)
+		return lambda: node._compute(args)
+
+
+_compute_case("+", 3)
+_compute_case("sqrt", 2)
+_compute_case("sqrt", 2.0)
+_compute_case("sin", 0.5)
+_compute_case("sin", 0.5j)
+_compute_case("exp", 1.0)
+_compute_case("!", 20)
+_compute_case("hex", 255)
+
+
+def _render_case(name, tokens):
+
+	@benchmark("render_operation.%s" % name)
+	def setup():
+		rpn = _rpn_history()
+		rpn.deserialize_stack((tokens, ))
+		node = rpn.history.peek()
+		renderer = operation.render_number()
+		render_operation = operation.render_operation
+		return lambda: render_operation(renderer, node)
+
+
+_render_case("int", ["123456789"])
+_render_case("float", ["3.14159"])
+_render_case("complex", ["1+2j"])
+_render_case("tree", ["x", "1", "+"] + ["y", "*", "2", "+"] * 25)
+
+
+@benchmark("render_cache.new_top")
+def setup_render_cache():
+	# Pushing an operator on a rendered tree only renders the new top node
+	rpn = _rpn_history()
+	rpn.deserialize_stack((["x", "1", "+"] + ["y", "*", "2", "+"] * 25, ))
+	node = rpn.history.peek()
+	cache = operation.RenderCache(operation.render_number())
+	cache.render(node)
+	Node = rpn.OPERATIONS["+"]
+	leaf = operation.Value(3, 10)
+	return lambda: cache.render(Node(node, leaf))
+
+
+@benchmark("render_cache.long_top")
+def setup_render_cache_long():
+	# The same over a tree whose text is far past RenderCache.MAX_JOINED_LENGTH
+	rpn = _rpn_history()
+	rpn.deserialize_stack((["x"] + ["y", "*", "2", "+"] * 2000, ))
+	node = rpn.history.peek()
+	cache = operation.RenderCache(operation.render_number())
+	cache.render(node)
+	Node = rpn.OPERATIONS["+"]
+	leaf = operation.Value(3, 10)
+	return lambda: cache.render(Node(node, leaf))
+
+
+_SESSION = [
+	["1", "2", "+"],
+	["x", "3", "*", "0x10", "+"],
+	["2.5", "sqrt"],
+	["1+2j"],
+	["y", "pi", "*", "2", "**"],
+	["0o17", "0b101", "&"],
+] * 10
+
+
+@benchmark("serialize_stack")
+def setup_serialize():
+	rpn = _rpn_history()
+	rpn.deserialize_stack(_SESSION)
+	return rpn.serialize_stack
+
+
+@benchmark("deserialize_line")
+def setup_deserialize_line():
+	rpn = _rpn_history()
+	lines = [" ".join(tokens) for tokens in _SESSION]
+
+	def deserialize():
+		for line in lines:
+			rpn.deserialize_line(line)
+		rpn.history.clear()
+
+	return deserialize
+
+
+@benchmark("deserialize_stack")
+def setup_deserialize():
+	rpn = _rpn_history()
+
+	def deserialize():
+		rpn.deserialize_stack(_SESSION)
+		rpn.history.clear()
+
+	return deserialize
+
+
+@benchmark("overloading.render_operation")
+def setup_overloading_render_operation():
+	render_operation = operation.render_operation
+	renderer = operation.render_number()
+	node = operation.Variable("x")
+	return lambda: render_operation(renderer, node)
+
+
+@benchmark("overloading.specialized")
+def setup_overloading_specialized():
+
+	@overloading.overloaded
+	def dispatch(x, y):
+		return x
+
+	@dispatch.register(int, int)
+	def dispatch_int(x, y):
+		return y
+
+	@dispatch.register(float, overloading.AnyType)
+	def dispatch_float(x, y):
+		return y
+
+	return lambda: dispatch(1, 2)
+
+
+@benchmark("overloading.method")
+def setup_overloading_method():
+	renderer = operation.render_number()
+	return lambda: renderer.render(1.5, 10)
+
+
+@benchmark("seperate_num.short")
+def setup_seperate_short():
+	seperate_num = operation._seperate_num
+	return lambda: seperate_num("1234567", ",", 3)
+
+
+@benchmark("seperate_num.long")
+def setup_seperate_long():
+	seperate_num = operation._seperate_num
+	digits = str(7 ** 1200)
+	return lambda: seperate_num(digits, ",", 3)
+
+
+def _render_integer_case(name, value, maxDigits):
+
+	@benchmark("render_integer.%s" % name)
+	def setup():
+		renderer = operation.render_number(maxDigits = maxDigits)
+		return lambda: renderer(value, 10)
+
+
+_render_integer_case("long", 7 ** 1200, None)
+_render_integer_case("huge", 7 ** 24000, None)
+_render_integer_case("huge_elided", 7 ** 24000, 40)
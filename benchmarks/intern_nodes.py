@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""
+Report the memory held by a synthetic session with and without node interning
+
+The session replays the same restored stack over and over, duplicating
+rows along the way, the way a long running calculator session would.
+"""
+
+import os
+import sys
+import gc
+import random
+import operator
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ejpi import operation
+
+
+OPERATIONS = {
+	"+": operation.generate_function(operator.add, "+", operation.Function.REP_INFIX, 2),
+	"-": operation.generate_function(operator.sub, "-", operation.Function.REP_INFIX, 2),
+	"*": operation.generate_function(operator.mul, "*", operation.Function.REP_INFIX, 2),
+}
+
+
+def generate_program(rng, length):
+	tokens = []
+	depth = 0
+	for i in xrange(length):
+		if 2 <= depth and rng.random() < 0.45:
+			tokens.append(rng.choice(OPERATIONS.keys()))
+			depth -= 1
+		else:
+			tokens.append(rng.choice(["x", "y", "1", "2", "3", "0x10"]))
+			depth += 1
+	return tokens
+
+
+def parse(token, interner):
+	if token in ("x", "y"):
+		if interner is None:
+			return operation.Variable(token)
+		return interner.variable(token)
+	base = 16 if token.startswith("0x") else 10
+	value = int(token, base)
+	if interner is None:
+		return operation.Value(value, base)
+	return interner.value(value, base)
+
+
+def replay(tokens, nodeCount, interner):
+	stack = []
+	created = 0
+	while created < nodeCount:
+		for token in tokens:
+			if token in OPERATIONS:
+				Node = OPERATIONS[token]
+				args = stack[-2:]
+				del stack[-2:]
+				if interner is None:
+					node = Node(*args)
+				else:
+					node = interner.function(Node, *args)
+			else:
+				node = parse(token, interner)
+			stack.append(node)
+			created += 1
+		# Duplicate the top row like QCalcHistory._duplicate_row
+		stack.append(stack[-1])
+	return stack
+
+
+def footprint():
+	gc.collect()
+	nodes = [obj for obj in gc.get_objects() if isinstance(obj, operation.Operation)]
+	size = 0
+	for node in nodes:
+		size += sys.getsizeof(node) + sys.getsizeof(node.__dict__)
+		for attr in node.__dict__.itervalues():
+			if isinstance(attr, (str, tuple, list)):
+				size += sys.getsizeof(attr)
+	return len(nodes), size
+
+
+def run(nodeCount, programLength, seed):
+	tokens = generate_program(random.Random(seed), programLength)
+
+	baseNodes, baseSize = footprint()
+	stack = replay(tokens, nodeCount, None)
+	plainNodes, plainSize = footprint()
+	del stack
+
+	interner = operation.NodeInterner()
+	stack = replay(tokens, nodeCount, interner)
+	internedNodes, internedSize = footprint()
+	internerSize = sys.getsizeof(interner._nodes.data) + sum(
+		sys.getsizeof(key) for key in interner._nodes.iterkeys()
+	)
+	del stack
+
+	print "%d nodes pushed, program of %d tokens" % (nodeCount, programLength)
+	print "%-10s %8d live nodes %10.1f KiB" % ("plain", plainNodes - baseNodes, (plainSize - baseSize) / 1024.0)
+	print "%-10s %8d live nodes %10.1f KiB (+%.1f KiB interning table)" % (
+		"interned",
+		internedNodes - baseNodes,
+		(internedSize - baseSize) / 1024.0,
+		internerSize / 1024.0,
+	)
+
+
+if __name__ == "__main__":
+	import optparse
+
+	opar = optparse.OptionParser()
+	opar.add_option("-n", "--nodes", dest="nodes", type="int", default=100000, help="Nodes to push in the session")
+	opar.add_option("-l", "--length", dest="length", type="int", default=200, help="Tokens in the replayed program")
+	opar.add_option("-s", "--seed", dest="seed", type="int", default=0, help="Random seed for the program")
+	options, args = opar.parse_args(sys.argv[1:])
+
+	run(options.nodes, options.length, options.seed)
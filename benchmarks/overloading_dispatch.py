@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""
+Compare overloaded's dispatch as it was, a type tuple and cache lookup per
+call, against the compiled dispatcher on the calls the renderers make
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ejpi import operation
+from ejpi.util import overloading
+
+
+class LegacyOverloaded(object):
+	# overloading.overloaded's registration and dispatch as they were
+
+	def __init__(self, default_func):
+		self.registry = {}
+		self.cache = {}
+		self.default_func = default_func
+
+	def register(self, *types):
+
+		def helper(func):
+			self.register_func(types, func)
+			return func
+
+		return helper
+
+	def register_func(self, types, func):
+		self.registry[tuple(types)] = func
+		self.cache = {}
+
+	def __call__(self, *args):
+		types = tuple(map(type, args))
+		func = self.cache.get(types)
+		if func is None:
+			self.cache[types] = func = self.find_func(types)
+		return func(*args)
+
+	find_func = overloading.overloaded.find_func.im_func
+
+
+def render_operation_like(Dispatcher):
+	# The shape of operation.render_operation, dispatched on the node
+	dispatch = Dispatcher(lambda renderer, node: str(node))
+	dispatch.register(overloading.AnyType, operation.Value)(lambda renderer, node: node.value)
+	dispatch.register(overloading.AnyType, operation.Variable)(lambda renderer, node: node.name)
+	dispatch.register(overloading.AnyType, operation.Function)(lambda renderer, node: node.symbol)
+	node = operation.Variable("x")
+	return lambda: dispatch(None, node)
+
+
+def render_number_like(Dispatcher):
+	# The shape of render_number.render, a method dispatched on the value
+	dispatch = Dispatcher(lambda self, value, base: str(value))
+	dispatch.register(overloading.AnyType, int, overloading.AnyType)(lambda self, value, base: value)
+	dispatch.register(overloading.AnyType, float, overloading.AnyType)(lambda self, value, base: value)
+	dispatch.register(overloading.AnyType, complex, overloading.AnyType)(lambda self, value, base: value)
+	return lambda: dispatch(None, 1.5, 10)
+
+
+def two_positions(Dispatcher):
+	dispatch = Dispatcher(lambda x, y: x)
+	dispatch.register(int, int)(lambda x, y: y)
+	dispatch.register(float, overloading.AnyType)(lambda x, y: y)
+	return lambda: dispatch(1, 2)
+
+
+def variadic(Dispatcher):
+	# Falls back to building the whole type tuple, like before
+	dispatch = Dispatcher(lambda *args: args)
+	dispatch.register(int)(lambda x: x)
+	dispatch.register(int, int)(lambda x, y: y)
+	return lambda: dispatch(1, 2)
+
+
+def register_warm(Dispatcher):
+	# Registering while calls of other types are already cached
+	dispatch = Dispatcher(lambda x: x)
+	dispatch.register(str)(lambda x: x)
+	values = [1, 1.5, 1j, "a", u"a", None, (), []]
+
+	def register():
+		for value in values:
+			dispatch(value)
+		dispatch.register_func((str, ), lambda x: x)
+		for value in values:
+			dispatch(value)
+
+	return register
+
+
+CASES = [
+	("render_operation", render_operation_like),
+	("render_number", render_number_like),
+	("two_positions", two_positions),
+	("variadic", variadic),
+	("register_warm", register_warm),
+]
+
+
+def bench(name, setup, number):
+	legacyTime = min(timeit.repeat(setup(LegacyOverloaded), number=number, repeat=5))
+	compiledTime = min(timeit.repeat(setup(overloading.overloaded), number=number, repeat=5))
+	print "%-18s legacy %8.3fus  compiled %8.3fus  speedup %5.2fx" % (
+		name,
+		legacyTime / number * 1e6,
+		compiledTime / number * 1e6,
+		legacyTime / compiledTime,
+	)
+
+
+def report_counters(number):
+	dispatch = operation.render_operation
+	dispatch.set_counting(True)
+	try:
+		renderer = operation.render_number()
+		nodes = [operation.Variable("x"), operation.Value(1, 10), operation.Value(2.5, 10)]
+		for i in xrange(number):
+			for node in nodes:
+				dispatch(renderer, node)
+		print "render_operation   %d calls  %d misses  %d invalidations  %d cached" % (
+			dispatch.calls, dispatch.misses, dispatch.invalidations, len(dispatch.cache),
+		)
+	finally:
+		dispatch.set_counting(False)
+
+
+if __name__ == "__main__":
+	import optparse
+
+	opar = optparse.OptionParser()
+	opar.add_option("-n", "--number", dest="number", type="int", default=100000, help="Calls per measurement")
+	options, args = opar.parse_args(sys.argv[1:])
+
+	for name, setup in CASES:
+		if name == "register_warm":
+			bench(name, setup, options.number // 100)
+		else:
+			bench(name, setup, options.number)
+	report_counters(options.number // 100)
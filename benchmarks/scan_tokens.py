@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+Compare the exception driven number parsing scan_token replaced against the
+single pass scanner, per token and per line
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ejpi import history
+
+
+_BASE_MAPPINGS = {
+	"0x": 16,
+	"0o": 8,
+	"0b": 2,
+}
+
+
+CONSTANTS = {"pi": None, "e": None}
+
+
+def legacy_parse(userInput):
+	# history.parse_number and RpnCalcHistory._parse_value as they were
+	try:
+		base = _BASE_MAPPINGS.get(userInput[0:2], 10)
+		if base != 10:
+			userInput = userInput[2:]
+		return int(userInput, base), base
+	except ValueError:
+		pass
+
+	try:
+		return float(userInput), 10
+	except ValueError:
+		pass
+
+	try:
+		return complex(userInput), 10
+	except ValueError:
+		pass
+
+	try:
+		return CONSTANTS[userInput]
+	except KeyError:
+		pass
+
+	history.validate_variable_name(userInput)
+	return userInput
+
+
+def scanned_parse(userInput):
+	kind, value, base = history.scan_token(userInput)
+	if kind == history.TOKEN_NUMBER:
+		return value, base
+	elif userInput in CONSTANTS:
+		return CONSTANTS[userInput]
+	return userInput
+
+
+TOKENS = {
+	"int": "123456",
+	"hex": "0xdeadbeef",
+	"float": "3.14159",
+	"complex": "1+2j",
+	"constant": "pi",
+	"variable": "x",
+}
+
+
+LINE = "1 2.5 + x * 0x10 pi ** 1+2j 3 0b101 y"
+
+
+def bench(name, func, number):
+	return min(timeit.repeat(func, number=number, repeat=7)) / number * 1e6
+
+
+if __name__ == "__main__":
+	import optparse
+
+	opar = optparse.OptionParser()
+	opar.add_option("-n", "--number", dest="number", type="int", default=100000, help="Calls per measurement")
+	options, args = opar.parse_args(sys.argv[1:])
+
+	for name in ["int", "hex", "float", "complex", "constant", "variable"]:
+		token = TOKENS[name]
+		legacy = bench(name, lambda: legacy_parse(token), options.number)
+		scanned = bench(name, lambda: scanned_parse(token), options.number)
+		print "%-10s legacy %6.2fus  scanned %6.2fus  speedup %4.1fx" % (name, legacy, scanned, legacy / scanned)
+
+	number = options.number // 10
+	legacy = bench("line", lambda: [legacy_parse(token) for token in LINE.split() if token not in ("+", "*", "**")], number)
+	scanned = bench("line", lambda: list(history.scan_line(LINE)), number)
+	print "%-10s legacy %6.2fus  scanned %6.2fus  speedup %4.1fx (%d tokens)" % ("line", legacy, scanned, legacy / scanned, len(LINE.split()))
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""
+Compare restoring a saved stack from the text history against a snapshot
+
+Restoring text parses, applies and simplifies every line again and renders
+each row, like QCalcHistory does when pushed to, a snapshot skips all of it.
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import random
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ejpi import history
+from ejpi import operation
+from ejpi import ejpi_batch
+
+import batch_scaling
+
+
+class RenderingHistory(history.CalcHistory):
+	"""
+	Does the work a QCalcHistory row costs, minus Qt
+	"""
+
+	def __init__(self):
+		super(RenderingHistory, self).__init__()
+		self.renderer = operation.render_number()
+
+	def push(self, node):
+		simpleNode = node.simplify()
+		operation.render_operation(self.renderer, node)
+		operation.render_operation(self.renderer, simpleNode)
+		return super(RenderingHistory, self).push(node)
+
+	def push_restored(self, node, equationText, resultText):
+		if resultText is None:
+			return self.push(node)
+		return super(RenderingHistory, self).push(node)
+
+
+class NoEntry(object):
+
+	def get_value(self):
+		return ""
+
+	def clear(self):
+		pass
+
+
+def new_history(constants, operators):
+	return history.RpnCalcHistory(RenderingHistory(), NoEntry(), None, constants, operators)
+
+
+def run(rowCount, seed):
+	constants, operators = ejpi_batch.load_plugins()
+
+	lines = list(batch_scaling.generate_lines(random.Random(seed), rowCount))
+	original = new_history(constants, operators)
+	for line in lines:
+		original.deserialize_line(line)
+	serialized = [list(tokens) for tokens in original.serialize_stack()]
+
+	directory = tempfile.mkdtemp()
+	snapshotPath = os.path.join(directory, "history.snapshot")
+	textPath = os.path.join(directory, "history.stack")
+	try:
+		with open(textPath, "w") as f:
+			for lineData in serialized:
+				f.write("%s\n" % " ".join(lineData))
+		original.save_snapshot(snapshotPath, original.history.renderer)
+
+		start = time.time()
+		restored = new_history(constants, operators)
+		with open(textPath, "rU") as f:
+			restored.deserialize_stack(line.split(" ") for line in f.read().splitlines())
+		textTime = time.time() - start
+		assert len(restored.history) == rowCount
+
+		start = time.time()
+		restored = new_history(constants, operators)
+		restored.restore_snapshot(snapshotPath)
+		snapshotTime = time.time() - start
+		assert len(restored.history) == rowCount
+		assert [list(tokens) for tokens in restored.serialize_stack()] == serialized
+
+		print "%d rows" % rowCount
+		print "%-10s %8.1fms %8.1f KiB" % ("text", textTime * 1000, os.path.getsize(textPath) / 1024.0)
+		print "%-10s %8.1fms %8.1f KiB  speedup %4.1fx" % (
+			"snapshot",
+			snapshotTime * 1000,
+			os.path.getsize(snapshotPath) / 1024.0,
+			textTime / snapshotTime,
+		)
+	finally:
+		for path in (snapshotPath, textPath):
+			if os.path.exists(path):
+				os.remove(path)
+		os.rmdir(directory)
+
+
+if __name__ == "__main__":
+	import optparse
+
+	opar = optparse.OptionParser()
+	opar.add_option("-n", "--rows", dest="rows", type="int", default=10000, help="Rows on the saved stack")
+	opar.add_option("-s", "--seed", dest="seed", type="int", default=0, help="Random seed for the rows")
+	options, args = opar.parse_args(sys.argv[1:])
+
+	run(options.rows, options.seed)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+"""
+Headless front end, evaluating RPN from files or stdin without Qt
+
+Every input line is its own calculation, the results left on its stack are
+written as one tab separated output line, so memory stays flat however much
+input is streamed through.  Being independent, lines can also be spread
+across processes.
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import collections
+import logging
+
+try:
+	import multiprocessing
+except ImportError:
+	multiprocessing = None
+
+import history
+import operation
+import plugin_utils
+import instrumentation
+
+
+_moduleLogger = logging.getLogger(__name__)
+
+
+PLUGIN_SEARCH_PATHS = [
+	os.path.join(os.path.dirname(__file__), "plugins/"),
+]
+
+
+PLUGIN_NAMES = ["Builtins", "Trigonometry", "Computer", "Alphabet"]
+
+
+def load_plugins(searchPaths = PLUGIN_SEARCH_PATHS, pluginNames = PLUGIN_NAMES):
+	"""
+	@returns the constants and operators of the plugins, the same set the
+		GUI loads
+	"""
+	constantPlugins = plugin_utils.ConstantPluginManager()
+	constantPlugins.add_path(*searchPaths)
+	operatorPlugins = plugin_utils.OperatorPluginManager()
+	operatorPlugins.add_path(*searchPaths)
+	for pluginName in pluginNames:
+		for plugins in (constantPlugins, operatorPlugins):
+			pluginId = plugins.lookup_plugin(pluginName)
+			plugins.enable_plugin(pluginId)
+	return constantPlugins.constants, operatorPlugins.operators
+
+
+class _NoEntry(object):
+	"""
+	Batch input goes straight to the stack, there is never anything typed
+	"""
+
+	def get_value(self):
+		return ""
+
+	def clear(self):
+		pass
+
+
+class _LogErrors(object):
+
+	def push_exception(self):
+		_moduleLogger.exception("Calculation failed")
+
+
+class BatchCalculator(object):
+
+	def __init__(self, constants, operators, recorder = None):
+		self._entry = _NoEntry()
+		self._history = history.CalcHistory()
+		self._rpn = history.RpnCalcHistory(
+			self._history, self._entry, _LogErrors(), constants, operators, recorder
+		)
+		self._renderer = operation.render_number()
+
+	def calculate(self, tokens):
+		"""
+		@param tokens the RPN tokens of one calculation
+		@returns the rendered results, bottom of the stack first
+		"""
+		try:
+			self._rpn.deserialize_stack((tokens, ))
+			return self._render_stack()
+		finally:
+			self._history.clear()
+
+	def calculate_line(self, line):
+		"""
+		@returns the output line and the error message, if it failed
+		"""
+		try:
+			self._rpn.deserialize_line(line)
+			results = self._render_stack()
+		except StandardError, e:
+			return "", str(e)
+		finally:
+			self._history.clear()
+		return "\t".join(results), None
+
+	def _render_stack(self):
+		return [
+			operation.render_operation(self._renderer, node.simplify())
+			for node in self._history
+		]
+
+	def stream(self, lines, output, errors):
+		"""
+		@returns how many lines failed
+		"""
+		results = (self.calculate_line(line) for line in lines)
+		return _write_results(results, output, errors)
+
+
+def stream_parallel(lines, output, errors, jobs, budget = None, chunkSize = 256):
+	"""
+	Calculate lines on a pool of jobs processes, each loading the plugins
+	once, writing results in input order
+
+	@returns how many lines failed
+	"""
+	assert multiprocessing is not None, "multiprocessing is not available"
+	pool = multiprocessing.Pool(jobs, _init_worker, (budget, ))
+	try:
+		results = _iter_parallel(pool, lines, jobs, chunkSize)
+		failures = _write_results(results, output, errors)
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+	return failures
+
+
+def _iter_parallel(pool, lines, jobs, chunkSize):
+	# Only a few chunks per worker are in flight at once, Pool.imap would
+	# read all of the input up front
+	inFlight = collections.deque()
+	for chunk in _iter_chunks(lines, chunkSize):
+		inFlight.append(pool.apply_async(_calculate_chunk, (chunk, )))
+		if jobs * 2 <= len(inFlight):
+			for result in inFlight.popleft().get():
+				yield result
+	while inFlight:
+		for result in inFlight.popleft().get():
+			yield result
+
+
+def _iter_chunks(lines, chunkSize):
+	chunk = []
+	for line in lines:
+		chunk.append(line)
+		if chunkSize <= len(chunk):
+			yield chunk
+			chunk = []
+	if chunk:
+		yield chunk
+
+
+_workerCalculator = None
+
+
+def _init_worker(budget):
+	global _workerCalculator
+	operation.set_budget(budget)
+	_workerCalculator = BatchCalculator(*load_plugins())
+
+
+def _calculate_chunk(lines):
+	return [_workerCalculator.calculate_line(line) for line in lines]
+
+
+def _write_results(results, output, errors):
+	failures = 0
+	for lineNumber, (text, error) in enumerate(results):
+		if error is not None:
+			failures += 1
+			errors.write("%d: %s\n" % (lineNumber + 1, error))
+		output.write(text)
+		output.write("\n")
+	return failures
+
+
+def _iter_lines(paths):
+	if not paths:
+		paths = ["-"]
+	for path in paths:
+		if path == "-":
+			# readline rather than iteration, which reads ahead and would
+			# hold back results when piped interactively
+			for line in iter(sys.stdin.readline, ""):
+				yield line
+		else:
+			with open(path, "rU") as f:
+				for line in f:
+					yield line
+
+
+def run(args):
+	import optparse
+
+	opar = optparse.OptionParser(usage="%prog --batch [-j JOBS] [FILE]...")
+	opar.add_option("--batch", action="store_true", dest="batch", default=False, help="Evaluate RPN lines from FILEs or stdin without the GUI")
+	opar.add_option("--max-bits", dest="maxBits", type="int", default=operation.MAX_BITS, help="Leave results estimated larger than this symbolic")
+	opar.add_option("--max-seconds", dest="maxSeconds", type="float", default=None, help="Time to spend on each line's operations")
+	opar.add_option("-j", "--jobs", dest="jobs", type="int", default=1, help="Processes to spread lines across, 0 for one per core")
+	opar.add_option("--timings", action="store_true", dest="timings", default=False, help="Report time spent per stage and operator to stderr, needs -j 1")
+	options, paths = opar.parse_args(args)
+
+	logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(name)s: %(message)s")
+	budget = operation.Budget(maxBits=options.maxBits, maxSeconds=options.maxSeconds)
+	operation.set_budget(budget)
+
+	jobs = options.jobs
+	if jobs == 0:
+		jobs = multiprocessing.cpu_count() if multiprocessing is not None else 1
+	if options.timings and jobs != 1:
+		opar.error("--timings only works with -j 1")
+	if jobs == 1:
+		recorder = None
+		if options.timings:
+			recorder = instrumentation.Recorder()
+			operation.set_recorder(recorder)
+		constants, operators = load_plugins()
+		calculator = BatchCalculator(constants, operators, recorder)
+		failures = calculator.stream(_iter_lines(paths), sys.stdout, sys.stderr)
+		if recorder is not None:
+			for line in recorder.report():
+				sys.stderr.write("%s\n" % line)
+	else:
+		failures = stream_parallel(_iter_lines(paths), sys.stdout, sys.stderr, jobs, budget)
+	sys.stdout.flush()
+	return 1 if failures else 0
+
+
+if __name__ == "__main__":
+	sys.exit(run(sys.argv[1:]))
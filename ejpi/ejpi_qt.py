@@ -28,6 +28,11 @@ from util import qtpieboard
 import plugin_utils
 import history
 import qhistory
+import operation
+import offload
+import instrumentation
+import snapshot
+import journal
 
 
 _moduleLogger = logging.getLogger(__name__)
@@ -142,13 +147,27 @@ class MainWindow(qwrappers.WindowWrapper):
 	]
 
 	_user_history = linux_utils.get_resource_path("config", constants.__app_name__, "history.stack")
+	_user_snapshot = linux_utils.get_resource_path("cache", constants.__app_name__, "history.snapshot")
+	_user_journal = linux_utils.get_resource_path("cache", constants.__app_name__, "history.journal")
 
 	def __init__(self, parent, app):
 		qwrappers.WindowWrapper.__init__(self, parent, app)
 		self._window.setWindowTitle("%s" % constants.__pretty_app_name__)
 		#self._freezer = qwrappers.AutoFreezeWindowFeature(self._app, self._window)
 
-		self._historyView = qhistory.QCalcHistory(self._app.errorLog)
+		if offload.multiprocessing is not None:
+			self._backend = offload.ProcessBackend()
+			operation.set_offload(self._backend)
+		else:
+			self._backend = None
+		if os.environ.get("EJPI_INSTRUMENT"):
+			# Timings are kept for as long as the window is open and logged on
+			# close, or on demand with the "Log Timings" action
+			self._recorder = instrumentation.Recorder()
+			operation.set_recorder(self._recorder)
+		else:
+			self._recorder = None
+		self._historyView = qhistory.QCalcHistory(self._app.errorLog, self._backend, self._recorder)
 		self._userEntry = QValueEntry()
 		self._userEntry.entry.returnPressed.connect(self._on_push)
 		self._userEntryLayout = QtGui.QHBoxLayout()
@@ -175,6 +194,16 @@ class MainWindow(qwrappers.WindowWrapper):
 		self._pasteItemAction.setShortcut(QtGui.QKeySequence("CTRL+v"))
 		self._pasteItemAction.triggered.connect(self._on_paste)
 
+		self._cancelAction = QtGui.QAction(None)
+		self._cancelAction.setText("Cancel")
+		self._cancelAction.setShortcut(QtGui.QKeySequence("Escape"))
+		self._cancelAction.triggered.connect(self._on_cancel)
+
+		self._logTimingsAction = QtGui.QAction(None)
+		self._logTimingsAction.setText("Log Timings")
+		self._logTimingsAction.setShortcut(QtGui.QKeySequence("CTRL+SHIFT+t"))
+		self._logTimingsAction.triggered.connect(self._on_log_timings)
+
 		self._closeWindowAction = QtGui.QAction(None)
 		self._closeWindowAction.setText("Close")
 		self._closeWindowAction.setShortcut(QtGui.QKeySequence("CTRL+w"))
@@ -182,6 +211,9 @@ class MainWindow(qwrappers.WindowWrapper):
 
 		self._window.addAction(self._copyItemAction)
 		self._window.addAction(self._pasteItemAction)
+		self._window.addAction(self._cancelAction)
+		if self._recorder is not None:
+			self._window.addAction(self._logTimingsAction)
 
 		self._constantPlugins = plugin_utils.ConstantPluginManager()
 		self._constantPlugins.add_path(*self._plugin_search_paths)
@@ -208,8 +240,12 @@ class MainWindow(qwrappers.WindowWrapper):
 		self._history = history.RpnCalcHistory(
 			self._historyView,
 			self._userEntry, self._app.errorLog,
-			self._constantPlugins.constants, self._operatorPlugins.operators
+			self._constantPlugins.constants, self._operatorPlugins.operators,
+			self._recorder,
 		)
+		self._journal = journal.Journal(self._user_journal, self._user_snapshot, self._user_history)
+		self._isJournaling = False
+		self._isJournalUnreplayed = False
 		self._load_history()
 
 		# Basic keyboard stuff
@@ -218,6 +254,7 @@ class MainWindow(qwrappers.WindowWrapper):
 		self._handler.register_command_handler("unpush", self._on_unpush)
 		self._handler.register_command_handler("backspace", self._on_entry_backspace)
 		self._handler.register_command_handler("clear", self._on_entry_clear)
+		self._handler.register_command_handler("cancel", self._on_cancel)
 
 		# Main keyboard
 		entryKeyboardId = self._keyboardPlugins.lookup_plugin("Entry")
@@ -238,6 +275,13 @@ class MainWindow(qwrappers.WindowWrapper):
 		self._scrollTimer.timeout.connect(self._on_delayed_scroll_to_bottom)
 		self._scrollTimer.start()
 
+		# Records are synced in batches, at the latest a second after they
+		# are made
+		self._journalTimer = QtCore.QTimer()
+		self._journalTimer.setInterval(1000)
+		self._journalTimer.timeout.connect(self._on_journal_timeout)
+		self._start_journal()
+
 		self.set_fullscreen(self._app.fullscreenAction.isChecked())
 		self.update_orientation(self._app.orientation)
 
@@ -284,9 +328,27 @@ class MainWindow(qwrappers.WindowWrapper):
 
 	def close(self):
 		qwrappers.WindowWrapper.close(self)
-		self._save_history()
+		self._journalTimer.stop()
+		self._historyView.journal = None
+		if self._isJournaling:
+			# Everything is in the journal already, only the text is behind
+			self._journal.close(self._historyView)
+		else:
+			self._save_history()
+		self._historyView.stop()
+		if self._recorder is not None:
+			self._log_timings()
 
 	def _load_history(self):
+		if self._is_snapshot_current():
+			try:
+				self._history.restore_snapshot(self._user_snapshot, self._journal)
+				return
+			except (snapshot.SnapshotError, EnvironmentError):
+				_moduleLogger.exception("Falling back to %s" % self._user_history)
+				# Its segments hold changes the text may not have
+				self._isJournalUnreplayed = True
+
 		serialized = []
 		try:
 			with open(self._user_history, "rU") as f:
@@ -299,6 +361,14 @@ class MainWindow(qwrappers.WindowWrapper):
 				raise
 		self._history.deserialize_stack(serialized)
 
+	def _log_timings(self):
+		_moduleLogger.info("Timings by stage and operator")
+		self._recorder.log(_moduleLogger)
+		renderCache = self._historyView.render_cache
+		_moduleLogger.info("Render cache %d hits %d misses (%.1f%% hits)" % (
+			renderCache.hits, renderCache.misses, renderCache.hit_rate * 100,
+		))
+
 	def _save_history(self):
 		serialized = self._history.serialize_stack()
 		with open(self._user_history, "w") as f:
@@ -306,11 +376,41 @@ class MainWindow(qwrappers.WindowWrapper):
 				line = " ".join(data for data in lineData)
 				f.write("%s\n" % line)
 
+	def _start_journal(self):
+		try:
+			self._journal.start(self._historyView, self._historyView.renderer, self._isJournalUnreplayed)
+		except EnvironmentError:
+			_moduleLogger.exception("Not journaling to %s" % self._user_journal)
+			return
+		self._historyView.journal = self._journal
+		self._isJournaling = True
+		self._journalTimer.start()
+
+	def _is_snapshot_current(self):
+		"""
+		The text history is what gets imported and exported, the snapshot and
+		journal only stand in for the text they were written along with
+		"""
+		journalModified = self._journal.last_modified()
+		if journalModified is None:
+			return False
+		try:
+			return os.path.getmtime(self._user_history) <= journalModified
+		except OSError:
+			return True
+
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_delayed_scroll_to_bottom(self):
 		with qui_utils.notify_error(self._app.errorLog):
 			self._historyView.scroll_to_bottom()
 
+	@misc_utils.log_exception(_moduleLogger)
+	def _on_journal_timeout(self):
+		with qui_utils.notify_error(self._app.errorLog):
+			self._journal.sync()
+			if self._journal.is_compaction_due():
+				self._journal.compact(self._historyView, self._historyView.renderer)
+
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_child_close(self, something = None):
 		with qui_utils.notify_error(self._app.errorLog):
@@ -327,7 +427,14 @@ class MainWindow(qwrappers.WindowWrapper):
 	def _on_paste(self, *args):
 		with qui_utils.notify_error(self._app.errorLog):
 			result = str(self._app._clipboard.text())
-			self._userEntry.append(result)
+			if not self._history.is_program(result):
+				self._userEntry.append(result)
+				return
+
+			# Several tokens are run as a program, shown once it is done and
+			# undone if any of it fails
+			self._history.push_entry()
+			self._history.run_program(result)
 
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_entry_direct(self, keys, modifiers):
@@ -346,6 +453,16 @@ class MainWindow(qwrappers.WindowWrapper):
 		with qui_utils.notify_error(self._app.errorLog):
 			self._historyView.unpush()
 
+	@misc_utils.log_exception(_moduleLogger)
+	def _on_cancel(self, *args):
+		with qui_utils.notify_error(self._app.errorLog):
+			self._historyView.cancel()
+
+	@misc_utils.log_exception(_moduleLogger)
+	def _on_log_timings(self, *args):
+		with qui_utils.notify_error(self._app.errorLog):
+			self._log_timings()
+
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_entry_backspace(self, *args):
 		with qui_utils.notify_error(self._app.errorLog):
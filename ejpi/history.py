@@ -1,52 +1,165 @@
 #!/usr/bin/env python
 
+from __future__ import with_statement
 
 import re
 import weakref
 
-from util import algorithms
 import operation
+import instrumentation
+import snapshot
 
 
-__BASE_MAPPINGS = {
+_VARIABLE_VALIDATION_RE = re.compile("^[a-zA-Z0-9]+$")
+
+
+def validate_variable_name(variableName):
+	match = _VARIABLE_VALIDATION_RE.match(variableName)
+	if match is None:
+		raise RuntimeError("Invalid characters in '%s'" % variableName)
+
+
+TOKEN_NUMBER = "number"
+TOKEN_NAME = "name"
+TOKEN_OTHER = "other"
+
+
+def _any_case(word):
+	return "".join("[%s%s]" % (c.lower(), c.upper()) for c in word)
+
+
+# What int(), float() and complex() accept, so one match says which of them
+# will succeed instead of trying each in turn
+_FLOAT_PATTERN = r"(?:(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?|%s(?:%s)?|%s)" % (
+	_any_case("inf"), _any_case("inity"), _any_case("nan"),
+)
+_COMPLEX_PATTERN = r"[+-]?(?:%(float)s[+-])?(?:%(float)s)?[jJ]" % {"float": _FLOAT_PATTERN}
+_TOKEN_RE = re.compile(r"""
+	(?:
+		(?=[0-9+\-.(iInNjJ])
+		(?:
+			(?P<int>[+-]?\s*\d+)
+			|(?P<float>[+-]?%(float)s)
+			|(?P<complex>%(complex)s|\((?:%(complex)s|[+-]?%(float)s)\))
+		)
+		|(?P<name>[a-zA-Z0-9]+)
+		|(?P<other>\S+)
+	)\Z
+""" % {"float": _FLOAT_PATTERN, "complex": _COMPLEX_PATTERN}, re.VERBOSE)
+
+
+_PREFIX_BASES = {
 	"0x": 16,
 	"0o": 8,
 	"0b": 2,
 }
 
 
-_VARIABLE_VALIDATION_RE = re.compile("^[a-zA-Z0-9]+$")
+_NUMBER_PARSERS = {
+	"int": (int, 10),
+	"float": (float, 10),
+	"complex": (complex, 10),
+}
 
 
-def validate_variable_name(variableName):
-	match = _VARIABLE_VALIDATION_RE.match(variableName)
+def scan_token(token):
+	"""
+	Classify a token in one pass
+
+	@returns (kind, value, base), value and base being None for anything but
+		TOKEN_NUMBER.  A TOKEN_NAME is a valid constant or variable name.
+
+	>>> scan_token("0x1f")
+	('number', 31, 16)
+	>>> scan_token("-2.5e3")
+	('number', -2500.0, 10)
+	>>> scan_token("1-2j")
+	('number', (1-2j), 10)
+	>>> scan_token("x1")
+	('name', None, None)
+	>>> scan_token("0b12")
+	('name', None, None)
+	>>> scan_token("**")
+	('other', None, None)
+	>>> scan_token(" 12 ")
+	('number', 12, 10)
+
+	Like int(), a sign may be padded or follow a base prefix
+	>>> scan_token("- 45")
+	('number', -45, 10)
+	>>> scan_token("0x-1")
+	('number', -1, 16)
+	>>> scan_token("0o+2")
+	('number', 2, 8)
+	>>> scan_token("-0xff")
+	('number', -255, 16)
+	"""
+	# Like int() and float(), padding around the token is ignored
+	token = token.strip()
+	# Plain and prefixed integers are most of the input, str methods and
+	# int() settle them cheaper than any regex
+	if token.isdigit():
+		return TOKEN_NUMBER, int(token), 10
+	base = _PREFIX_BASES.get(token[0:2])
+	if base is not None:
+		# int() also takes a sign or padding after the prefix, as it always has
+		try:
+			return TOKEN_NUMBER, int(token[2:], base), base
+		except ValueError:
+			pass
+	elif token[0:1] in ("-", "+"):
+		# How negative hex and octal values are saved
+		base = _PREFIX_BASES.get(token[1:3])
+		if base is not None:
+			try:
+				return TOKEN_NUMBER, int(token, base), base
+			except ValueError:
+				pass
+
+	match = _TOKEN_RE.match(token)
 	if match is None:
-		raise RuntimeError("Invalid characters in '%s'" % variableName)
+		return TOKEN_OTHER, None, None
+	group = match.lastgroup
+	parser = _NUMBER_PARSERS.get(group)
+	if parser is None:
+		return (TOKEN_NAME if group == "name" else TOKEN_OTHER), None, None
+	convert, base = parser
+	return TOKEN_NUMBER, convert(token), base
 
 
-def parse_number(userInput):
-	try:
-		base = __BASE_MAPPINGS.get(userInput[0:2], 10)
-		if base != 10:
-			userInput = userInput[2:] # Remove prefix
-		value = int(userInput, base)
-		return value, base
-	except ValueError:
-		pass
+def scan_line(line):
+	"""
+	Classify every whitespace separated token of a line
 
-	try:
-		value = float(userInput)
-		return value, 10
-	except ValueError:
-		pass
+	@returns an iterator of (token, kind, value, base)
 
-	try:
-		value = complex(userInput)
-		return value, 10
-	except ValueError:
-		pass
+	>>> [(token, kind) for token, kind, value, base in scan_line(" 1 0o17\tpi + ")]
+	[('1', 'number'), ('0o17', 'number'), ('pi', 'name'), ('+', 'other')]
+	"""
+	# Splitting first measured faster than one regex over the whole line, it
+	# lets plain integers skip the regex
+	for token in line.split():
+		kind, value, base = scan_token(token)
+		yield token, kind, value, base
+
+
+def parse_number(userInput):
+	"""
+	@returns (value, base)
 
-	raise ValueError('Cannot parse "%s" as a number' % userInput)
+	Reads back what operation.render_number_literal writes, like a stack
+	row's value opened for editing
+
+	>>> literal = operation.render_number_literal()
+	>>> parse_number(literal(15, 8)), parse_number(literal(-255, 16))
+	((15, 8), (-255, 16))
+	>>> parse_number(operation.render_number()(15, 8))
+	(17, 10)
+	"""
+	kind, value, base = scan_token(userInput)
+	if kind != TOKEN_NUMBER:
+		raise ValueError('Cannot parse "%s" as a number' % userInput)
+	return value, base
 
 
 class AbstractHistory(object):
@@ -57,13 +170,55 @@ class AbstractHistory(object):
 	def push(self, node):
 		raise NotImplementedError
 
+	def push_pending(self, node):
+		"""
+		Push a node that is expensive to simplify.  Histories that show
+		results can work it out in the background, by default it is done
+		up front so failures are raised here.
+		"""
+		node.simplify()
+		return self.push(node)
+
+	def push_restored(self, node, equationText, resultText):
+		"""
+		Push a node restored from a snapshot, along with how it was displayed.
+		Its simplification is already cached when resultText isn't None.
+		"""
+		return self.push(node)
+
+	def push_many(self, nodes):
+		"""
+		Push each node in turn, the last one ending up on top
+		"""
+		with self.batch():
+			for node in nodes:
+				self.push(node)
+
 	def pop(self):
 		raise NotImplementedError
 
+	def pop_many(self, count):
+		"""
+		@returns the top count items of the stack, bottom most first
+		"""
+		if len(self) < count:
+			raise IndexError("Not enough items in the history for the operation")
+		nodes = [self.pop() for i in xrange(count)]
+		nodes.reverse()
+		return nodes
+
+	def batch(self):
+		"""
+		Group many changes to the stack, histories that show it can hold off
+		updating the display until the batch is done
+
+		@returns a context manager
+		"""
+		return _NO_BATCH
+
 	def unpush(self):
 		node = self.pop()
-		for child in node.get_children():
-			self.push(child)
+		self.push_many(node.get_children())
 
 	def peek(self):
 		raise NotImplementedError
@@ -78,6 +233,18 @@ class AbstractHistory(object):
 		raise NotImplementedError
 
 
+class _NoBatch(object):
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		return False
+
+
+_NO_BATCH = _NoBatch()
+
+
 class CalcHistory(AbstractHistory):
 
 	def __init__(self):
@@ -89,11 +256,25 @@ class CalcHistory(AbstractHistory):
 		self.__nodeStack.append(node)
 		return node
 
+	def push_many(self, nodes):
+		nodes = list(nodes)
+		assert None not in nodes
+		self.__nodeStack.extend(nodes)
+
 	def pop(self):
 		popped = self.__nodeStack[-1]
 		del self.__nodeStack[-1]
 		return popped
 
+	def pop_many(self, count):
+		if len(self.__nodeStack) < count:
+			raise IndexError("Not enough items in the history for the operation")
+		if count == 0:
+			return []
+		popped = self.__nodeStack[-count:]
+		del self.__nodeStack[-count:]
+		return popped
+
 	def peek(self):
 		return self.__nodeStack[-1]
 
@@ -104,12 +285,37 @@ class CalcHistory(AbstractHistory):
 		return len(self.__nodeStack)
 
 	def __iter__(self):
-		return self.__nodeStack[::-1]
+		return iter(self.__nodeStack)
+
+
+class _Entry(object):
+	"""
+	Stands in for the entry in the doctests
+	"""
+
+	def get_value(self):
+		return ""
+
+	def clear(self):
+		pass
+
+
+class _RaiseErrors(object):
+	"""
+	Stands in for the error reporting in the doctests
+	"""
+
+	def push_exception(self):
+		raise
 
 
 class RpnCalcHistory(object):
 
-	def __init__(self, history, entry, errorReporting, constants, operations):
+	def __init__(self, history, entry, errorReporting, constants, operations, recorder = None):
+		"""
+		@param recorder an instrumentation.Recorder to time parsing and
+			applying operators with, None to not keep timings
+		"""
 		self.history = history
 		self.history._parse_value = self._parse_value
 		self.__entry = weakref.ref(entry)
@@ -118,7 +324,11 @@ class RpnCalcHistory(object):
 		self.__constants = constants
 		self.__operations = operations
 
-		self.__serialRenderer = operation.render_number()
+		self.__serialRenderer = operation.render_number_literal()
+		self.__interner = operation.NodeInterner()
+		if recorder is None:
+			recorder = instrumentation.NullRecorder()
+		self.__recorder = recorder
 
 	@property
 	def OPERATIONS(self):
@@ -128,10 +338,23 @@ class RpnCalcHistory(object):
 	def CONSTANTS(self):
 		return self.__constants
 
+	@property
+	def recorder(self):
+		return self.__recorder
+
 	def clear(self):
 		self.history.clear()
 		self.__entry().clear()
 
+	def batch(self):
+		"""
+		Group many pushes and operations so the history is redisplayed once,
+		at the end
+
+		@returns a context manager
+		"""
+		return self.history.batch()
+
 	def push_entry(self):
 		value = self.__entry().get_value()
 
@@ -153,6 +376,78 @@ class RpnCalcHistory(object):
 			self.__errorReporter.push_exception()
 			return None
 
+	def apply_reduction(self, Node, count = None, countOnStack = False):
+		"""
+		Combine many items with a binary operator in one step, the way
+		repeatedly applying it would
+
+		@param count how many items from the top of the stack, all of them
+			when None
+		@param countOnStack take count from the top of the stack instead
+
+		>>> import operator
+		>>> sub = operation.generate_function(operator.sub, "-", operation.Function.REP_INFIX, 2)
+		>>> entry = _Entry()
+		>>> rpn = RpnCalcHistory(CalcHistory(), entry, _RaiseErrors(), {}, {"-": sub})
+		>>> rpn.deserialize_stack([["10", "3", "2", "-", "-"]])
+		>>> str(rpn.history.peek().simplify())
+		'9'
+		>>> rpn.deserialize_stack([["10", "3", "2"]])
+		>>> node = rpn.apply_reduction(sub, 3)
+		>>> str(node), str(node.simplify())
+		('(10 - (3 - 2))', '9')
+		"""
+		try:
+			self.push_entry()
+
+			if countOnStack:
+				node = self._apply_counted(self._apply_reduction, Node)
+			else:
+				node = self._apply_reduction(Node, count)
+			return node
+		except StandardError, e:
+			self.__errorReporter.push_exception()
+			return None
+
+	def apply_map(self, Node, count = None, countOnStack = False):
+		"""
+		Apply a unary operator to each of many items in one step
+
+		@param count how many items from the top of the stack, all of them
+			when None
+		@param countOnStack take count from the top of the stack instead
+
+		The items are taken and the results put back in one batch
+
+		>>> import contextlib, operator
+		>>> neg = operation.generate_function(operator.neg, "+-", operation.Function.REP_PREFIX, 1)
+		>>> class BatchedHistory(CalcHistory):
+		... 	batches = 0
+		... 	@contextlib.contextmanager
+		... 	def batch(self):
+		... 		self.batches += 1
+		... 		yield self
+		>>> entry = _Entry()
+		>>> rpn = RpnCalcHistory(BatchedHistory(), entry, _RaiseErrors(), {}, {})
+		>>> rpn.deserialize_stack([["1", "2", "3"]])
+		>>> rpn.history.batches = 0
+		>>> [str(node.simplify()) for node in rpn.apply_map(neg, 2)]
+		['-2', '-3']
+		>>> [str(node.simplify()) for node in rpn.history], rpn.history.batches
+		(['1', '-2', '-3'], 1)
+		"""
+		try:
+			self.push_entry()
+
+			if countOnStack:
+				nodes = self._apply_counted(self._apply_map, Node)
+			else:
+				nodes = self._apply_map(Node, count)
+			return nodes
+		except StandardError, e:
+			self.__errorReporter.push_exception()
+			return None
+
 	def serialize_stack(self):
 		serialized = (
 			stackNode.serialize(self.__serialRenderer)
@@ -162,48 +457,269 @@ class RpnCalcHistory(object):
 		return serialized
 
 	def deserialize_stack(self, data):
-		for possibleNode in data:
-			for nodeValue in possibleNode:
-				if nodeValue in self.OPERATIONS:
-					Node = self.OPERATIONS[nodeValue]
+		with self.batch():
+			for possibleNode in data:
+				for nodeValue in possibleNode:
+					if nodeValue in self.OPERATIONS:
+						Node = self.OPERATIONS[nodeValue]
+						self._apply_operation(Node)
+					else:
+						node = self._parse_value(nodeValue)
+						self.history.push(node)
+
+	def deserialize_line(self, line):
+		"""
+		Like deserialize_stack for a single line of whitespace separated
+		tokens, classifying them all in one pass
+		"""
+		with self.batch():
+			for token, kind, value, base in scan_line(line):
+				if token in self.OPERATIONS:
+					Node = self.OPERATIONS[token]
 					self._apply_operation(Node)
 				else:
-					node = self._parse_value(nodeValue)
+					with self.__recorder.timed("parse", "invalid") as timing:
+						node = self._scanned_value(token, kind, value, base)
+						timing.key = type(node).__name__
 					self.history.push(node)
 
-	def _parse_value(self, userInput):
-		try:
-			value, base = parse_number(userInput)
-			return operation.Value(value, base)
-		except ValueError:
-			pass
+	def is_program(self, text):
+		"""
+		@returns whether text reads as more than one number, name or operator
+
+		>>> import operator
+		>>> add = operation.generate_function(operator.add, "+", operation.Function.REP_INFIX, 2)
+		>>> entry = _Entry()
+		>>> rpn = RpnCalcHistory(CalcHistory(), entry, _RaiseErrors(), {}, {"+": add})
+		>>> rpn.is_program("1 2 +\\nx +"), rpn.is_program("12"), rpn.is_program("(x + 5)")
+		(True, False, False)
+		"""
+		return self._scan_program(text) is not None
+
+	def run_program(self, text):
+		"""
+		Run the lines of text in one batch, on failure the stack is put back
+		the way it was
+
+		>>> import operator
+		>>> add = operation.generate_function(operator.add, "+", operation.Function.REP_INFIX, 2)
+		>>> div = operation.generate_function(operator.div, "/", operation.Function.REP_INFIX, 2)
+		>>> entry = _Entry()
+		>>> rpn = RpnCalcHistory(CalcHistory(), entry, _RaiseErrors(), {}, {"+": add, "/": div})
+		>>> rpn.deserialize_stack([["5", "7"]])
+		>>> rpn.run_program("1 +\\n2 +")
+		>>> [str(node.simplify()) for node in rpn.history]
+		['5', '10']
+		>>> rpn.run_program("3 + + +")
+		Traceback (most recent call last):
+		ValueError: Not enough arguments.  The stack has 2 but the program needs 3
+		>>> rpn.run_program("3 +\\n0 /")
+		Traceback (most recent call last):
+		ZeroDivisionError: integer division or modulo by zero
+		>>> [str(node.simplify()) for node in rpn.history]
+		['5', '10']
+		"""
+		scanned = self._scan_program(text)
+		if scanned is None:
+			raise ValueError("Not a program: %r" % text)
+		lines, takenCount = scanned
+
+		if len(self.history) < takenCount:
+			raise ValueError(
+				"Not enough arguments.  The stack has %d but the program needs %d" % (
+					len(self.history), takenCount
+				)
+			)
 
+		with self.batch():
+			depth = len(self.history) - takenCount
+			taken = list(self.history)[depth:]
+			try:
+				for line in lines:
+					self.deserialize_line(line)
+			except StandardError:
+				self.history.pop_many(len(self.history) - depth)
+				self.history.push_many(taken)
+				raise
+
+	def _scan_program(self, text):
+		"""
+		@returns the lines of text and how many items from the stack they
+			take, None when text isn't a program
+		"""
+		lines = text.splitlines()
+		height = lowest = tokenCount = 0
+		for line in lines:
+			for token in line.split():
+				tokenCount += 1
+				Node = self.OPERATIONS.get(token)
+				if Node is not None:
+					height -= Node.argumentCount
+					lowest = min(lowest, height)
+					height += 1
+				elif scan_token(token)[0] != TOKEN_OTHER:
+					height += 1
+				else:
+					return None
+		if tokenCount <= 1:
+			return None
+		return lines, -lowest
+
+	def save_snapshot(self, path, renderer):
+		"""
+		@param renderer the render_number the history displays nodes with
+		"""
+		snapshot.save(path, self.history, renderer)
+
+	def restore_snapshot(self, path, journal = None):
+		"""
+		Push the stack saved by save_snapshot, nothing gets pushed if it can't
+		be read
+
+		@param journal a journal.Journal whose records since the snapshot are
+			replayed on top of it
+		@raises snapshot.SnapshotError when the snapshot is unusable, like one
+			made with different plugins
+		"""
+		data = snapshot.Snapshot.open(path)
 		try:
-			return self.CONSTANTS[userInput]
-		except KeyError:
-			pass
+			rows = list(data.iter_rows(self.CONSTANTS, self.OPERATIONS, self.__interner))
+			generation = data.generation
+		finally:
+			data.close()
+		if journal is not None:
+			journal.replay(rows, generation, self.CONSTANTS, self.OPERATIONS, self.__interner)
+		with self.batch():
+			for node, equationText, resultText in rows:
+				self.history.push_restored(node, equationText, resultText)
+
+	def _parse_value(self, userInput):
+		with self.__recorder.timed("parse", "invalid") as timing:
+			userInput = userInput.strip()
+			kind, value, base = scan_token(userInput)
+			node = self._scanned_value(userInput, kind, value, base)
+			timing.key = type(node).__name__
+		return node
 
-		validate_variable_name(userInput)
-		return operation.Variable(userInput)
+	def _scanned_value(self, token, kind, value, base):
+		if kind == TOKEN_NUMBER:
+			return self.__interner.value(value, base)
+
+		constant = self.CONSTANTS.get(token)
+		if constant is not None:
+			return constant
+		elif kind == TOKEN_NAME:
+			return self.__interner.variable(token)
+		else:
+			raise RuntimeError("Invalid characters in '%s'" % token)
 
 	def _apply_operation(self, Node):
-		numArgs = Node.argumentCount
+		with self.__recorder.timed("apply", Node.symbol):
+			numArgs = Node.argumentCount
+
+			if len(self.history) < numArgs:
+				raise ValueError(
+					"Not enough arguments.  The stack has %d but %s needs %d" % (
+						len(self.history), Node.symbol, numArgs
+					)
+				)
+
+			args = self.history.pop_many(numArgs)
+
+			try:
+				node = self.__interner.function(Node, *args)
+				if operation.is_expensive(node):
+					self.history.push_pending(node)
+					return node
+				# Nodes simplify lazily, force it so a failing operation leaves the
+				# stack as it was
+				node.simplify()
+			except StandardError:
+				self.history.push_many(args)
+				raise
+			self.history.push(node)
+			return node
 
-		if len(self.history) < numArgs:
+	def _apply_reduction(self, Node, count = None):
+		if Node.argumentCount != 2:
+			raise ValueError("%s can't combine items, it takes %d arguments" % (Node.symbol, Node.argumentCount))
+		args = self._pop_items(Node, count, 2)
+
+		try:
+			if issubclass(Node, operation.NaryFunction):
+				# One node holding every item, evaluated in one bulk call
+				node = self.__interner.function(Node, *args)
+			else:
+				# Applying it over and over takes the top two items each time,
+				# folding from the top of the stack down
+				node = args[-1]
+				for arg in reversed(args[:-1]):
+					node = self.__interner.function(Node, arg, node)
+			if operation.is_expensive(node):
+				self.history.push_pending(node)
+				return node
+			node.simplify()
+		except StandardError:
+			self.history.push_many(args)
+			raise
+		self.history.push(node)
+		return node
+
+	def _apply_map(self, Node, count = None):
+		if Node.argumentCount != 1:
+			raise ValueError("%s can't be applied to each item, it takes %d arguments" % (Node.symbol, Node.argumentCount))
+		# One update of the display for taking the items and putting back
+		# the results, or the items again when it fails
+		with self.history.batch():
+			args = self._pop_items(Node, count, 1)
+
+			pushed = 0
+			try:
+				nodes = [self.__interner.function(Node, arg) for arg in args]
+				pending = [operation.is_expensive(node) for node in nodes]
+				for node, isPending in zip(nodes, pending):
+					if not isPending:
+						node.simplify()
+				for node, isPending in zip(nodes, pending):
+					if isPending:
+						self.history.push_pending(node)
+					else:
+						self.history.push(node)
+					pushed += 1
+			except StandardError:
+				self.history.pop_many(pushed)
+				self.history.push_many(args)
+				raise
+		return nodes
+
+	def _pop_items(self, Node, count, minimum):
+		"""
+		@returns the top count items of the stack, bottom most first
+		"""
+		if count is None:
+			count = len(self.history)
+		if count < minimum or len(self.history) < count:
 			raise ValueError(
 				"Not enough arguments.  The stack has %d but %s needs %d" % (
-					len(self.history), Node.symbol, numArgs
+					len(self.history), Node.symbol, max(count, minimum)
 				)
 			)
 
-		args = [arg for arg in algorithms.func_repeat(numArgs, self.history.pop)]
-		args.reverse()
+		return self.history.pop_many(count)
 
+	def _apply_counted(self, apply, Node):
+		"""
+		apply(Node, count) with count taken from the top of the stack, the
+		count is put back if applying fails
+		"""
+		if len(self.history) == 0:
+			raise ValueError("Not enough arguments.  The stack is empty but needs a count")
+		countNode = self.history.pop()
 		try:
-			node = Node(*args)
+			count = countNode.evaluate()
+			if count != int(count) or count < 0:
+				raise ValueError("Invalid count %s" % (count, ))
+			return apply(Node, int(count))
 		except StandardError:
-			for arg in args:
-				self.history.push(arg)
+			self.history.push(countNode)
 			raise
-		self.history.push(node)
-		return node
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+"""
+Opt-in latency tracking of the calculator's stages, per operator
+
+Stages are things like parsing, applying an operator or pushing a row, keys
+are usually the operator's symbol.  Each (stage, key) gets a call count and
+a histogram of how long the calls took.
+"""
+
+from __future__ import with_statement
+
+import time
+import threading
+
+
+class Histogram(object):
+	"""
+	Call latencies, bucketed by decade from 10us up
+
+	>>> h = Histogram()
+	>>> for seconds in (0.000002, 0.00005, 0.00007, 0.3, 20):
+	... 	h.add(seconds)
+	>>> h.count, h.maximum
+	(5, 20)
+	>>> h.buckets
+	[1, 2, 0, 0, 0, 1, 0, 1]
+	>>> print h.format_buckets()
+	<10us:1 <100us:2 <1s:1 >=10s:1
+	"""
+
+	LIMITS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+	LABELS = ("<10us", "<100us", "<1ms", "<10ms", "<100ms", "<1s", "<10s", ">=10s")
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.maximum = 0.0
+		self.buckets = [0] * (len(self.LIMITS) + 1)
+
+	def add(self, seconds):
+		self.count += 1
+		self.total += seconds
+		if self.maximum < seconds:
+			self.maximum = seconds
+		for i, limit in enumerate(self.LIMITS):
+			if seconds < limit:
+				break
+		else:
+			i = len(self.LIMITS)
+		self.buckets[i] += 1
+
+	@property
+	def mean(self):
+		return self.total / self.count if self.count else 0.0
+
+	def copy(self):
+		other = Histogram()
+		other.count = self.count
+		other.total = self.total
+		other.maximum = self.maximum
+		other.buckets = list(self.buckets)
+		return other
+
+	def format_buckets(self):
+		return " ".join(
+			"%s:%d" % (label, count)
+			for label, count in zip(self.LABELS, self.buckets)
+			if count
+		)
+
+
+class Recorder(object):
+	"""
+	Thread safe, simplification happens off the UI thread
+
+	>>> recorder = Recorder()
+	>>> with recorder.timed("apply", "+"):
+	... 	pass
+	>>> with recorder.timed("parse") as timing:
+	... 	timing.key = "number"
+	>>> sorted(recorder.stats().iterkeys())
+	[('apply', '+'), ('parse', 'number')]
+	>>> recorder.stats()["apply", "+"].count
+	1
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._histograms = {}
+
+	def timed(self, stage, key = None):
+		"""
+		@returns a context manager recording the time spent in it, its key can
+			be set from inside once it is known
+		"""
+		return _Timing(self, stage, key)
+
+	def record(self, stage, key, seconds):
+		with self._lock:
+			try:
+				histogram = self._histograms[stage, key]
+			except KeyError:
+				histogram = self._histograms[stage, key] = Histogram()
+			histogram.add(seconds)
+
+	def stats(self):
+		"""
+		@returns a copy of the histograms, keyed by (stage, key)
+		"""
+		with self._lock:
+			return dict(
+				(stageKey, histogram.copy())
+				for stageKey, histogram in self._histograms.iteritems()
+			)
+
+	def reset(self):
+		with self._lock:
+			self._histograms.clear()
+
+	def report(self):
+		"""
+		@returns lines summarizing every stage, the most total time first
+		"""
+		stats = self.stats().items()
+		stats.sort(key=lambda item: item[1].total, reverse=True)
+		for (stage, key), histogram in stats:
+			yield "%-10s %-8s %7d calls %10.3fms total %8.3fms mean %8.3fms max  %s" % (
+				stage,
+				key,
+				histogram.count,
+				histogram.total * 1000,
+				histogram.mean * 1000,
+				histogram.maximum * 1000,
+				histogram.format_buckets(),
+			)
+
+	def log(self, logger):
+		for line in self.report():
+			logger.info(line)
+
+
+class NullRecorder(object):
+	"""
+	Stands in while instrumentation is off, recording nothing
+	"""
+
+	def timed(self, stage, key = None):
+		return _NULL_TIMING
+
+	def record(self, stage, key, seconds):
+		pass
+
+	def stats(self):
+		return {}
+
+	def reset(self):
+		pass
+
+	def report(self):
+		return iter(())
+
+	def log(self, logger):
+		pass
+
+
+class _Timing(object):
+
+	def __init__(self, recorder, stage, key):
+		self._recorder = recorder
+		self._stage = stage
+		self.key = key
+		self._start = None
+
+	def __enter__(self):
+		self._start = time.time()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self._recorder.record(self._stage, self.key, time.time() - self._start)
+		return False
+
+
+class _NullTiming(object):
+
+	key = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		return False
+
+
+_NULL_TIMING = _NullTiming()
@@ -0,0 +1,563 @@
+#!/usr/bin/env python
+
+"""
+Append-only journal of the stack's mutations, so a session survives a crash
+without the whole history being rewritten on every change
+
+Every mutation is one line:
+	push <node>
+	pop
+	insert <row> <node>
+	remove <row>
+	replace <row> <node>
+	clear
+
+Nodes are written in postfix, a token per node:
+	i<base>:<int>, f<base>:<float>, c<base>:<complex>	values
+	$<name>	variable
+	k<name>	constant
+	o<count>:<symbol>	operator applied to the count nodes before it
+	@<index>	a node taken off the stack by the same operation, or one of
+		its children
+
+so an operator's result is journaled in a few tokens however big its
+arguments are.  Unlike RpnCalcHistory.serialize_stack nothing is lost to
+rendering, replaying rebuilds the very same trees.
+
+The journal is split into segments numbered by generation.  Compacting
+starts a new segment and writes the stack to a snapshot in the background,
+which then stands in for every segment before it.  Recovering restores the
+snapshot and replays only the segments since, so closing has nothing left to
+write but the stack's text, and only when records came after the last
+compaction.
+
+Compacting and closing can also write the stack's text, dated to when the
+compaction started or the journal was last written.  The text being newer
+than the journal then means it was replaced since, see last_modified.
+"""
+
+from __future__ import with_statement
+
+import os
+import math
+import time
+import logging
+import threading
+
+import operation
+import snapshot
+
+
+_moduleLogger = logging.getLogger(__name__)
+
+
+JOURNAL_VERSION = 1
+
+
+class JournalError(ValueError):
+	pass
+
+
+_HEADER = "ejpi-journal %d" % JOURNAL_VERSION
+
+
+class Journal(object):
+	"""
+	>>> import operator, shutil, tempfile
+	>>> add = operation.generate_function(operator.add, "+", operation.Function.REP_INFIX, 2)
+	>>> directory = tempfile.mkdtemp()
+	>>> journal = Journal(os.path.join(directory, "journal"), os.path.join(directory, "snapshot"))
+	>>> journal.start([], operation.render_number())
+	>>> one, x = operation.Value(1, 16), operation.Variable("x")
+	>>> journal.record_push(one)
+	>>> journal.record_push(x)
+	>>> journal.record_pop(x)
+	>>> journal.record_pop(one)
+	>>> journal.record_push(add(one, x))
+	>>> journal.record_push(operation.Value(2.5, 10))
+	>>> journal.record_remove(0, add(one, x))
+	>>> journal.record_insert(0, x)
+	>>> journal.sync()
+	>>> print open(os.path.join(directory, "journal.1")).read(),
+	ejpi-journal 1
+	push i16:1
+	push $x
+	pop
+	pop
+	push @1 @0 o2:+
+	push f10:2.5
+	remove 0
+	insert 0 @2
+	>>> rows = []
+	>>> journal.replay(rows, 1, {}, {"+": add}, operation.NodeInterner())
+	>>> [(str(node), node.base) for node, equationText, resultText in rows]
+	[('x', 10), ('2.5', 10)]
+	>>> journal.close()
+	>>> [generation for generation, path in journal.segments()]
+	[1]
+	>>> shutil.rmtree(directory)
+	"""
+
+	def __init__(self, path, snapshotPath, textPath = None, syncEvery = 256, compactEvery = 2000):
+		"""
+		@param path segments are named path.<generation>
+		@param snapshotPath where compacting writes the stack to
+		@param textPath where compacting writes the stack's text to, like
+			RpnCalcHistory.serialize_stack gives, None for no text
+		@param syncEvery records written before they are synced to disk
+			without waiting for sync()
+		@param compactEvery records written before is_compaction_due
+		"""
+		self._path = path
+		self._snapshotPath = snapshotPath
+		self._textPath = textPath
+		self._syncEvery = syncEvery
+		self._compactEvery = compactEvery
+
+		self._file = None
+		self._generation = None
+		self._unsynced = 0
+		self._recordCount = 0
+		# Whether the last compaction wrote the text, set from its thread
+		self._isTextCompacted = True
+		self._taken = _TakenNodes()
+		self._compactor = None
+
+	def segments(self):
+		"""
+		@returns (generation, path) of every segment on disk, oldest first
+		"""
+		directory, prefix = os.path.split(self._path)
+		prefix += "."
+		found = []
+		for name in os.listdir(directory or os.curdir):
+			suffix = name[len(prefix):]
+			if name.startswith(prefix) and suffix.isdigit():
+				found.append((int(suffix), os.path.join(directory, name)))
+		found.sort()
+		return found
+
+	def last_modified(self):
+		"""
+		@returns when the snapshot or a segment was last written to, None if
+			there are none
+		"""
+		paths = [path for generation, path in self.segments()]
+		paths.append(self._snapshotPath)
+		modified = None
+		for path in paths:
+			try:
+				modified = max(modified, os.path.getmtime(path))
+			except OSError:
+				pass
+		return modified
+
+	def replay(self, rows, generation, constants, operators, interner):
+		"""
+		Apply the segments from generation on to rows.  A torn or corrupt
+		record ends the replay, keeping what came before it.
+
+		@param rows (node, equationText, resultText) of the stack the segments
+			start from, like Snapshot.iter_rows gives, replayed nodes are
+			added without text
+		"""
+		reader = _JournalReader(constants, operators, interner)
+		for segmentGeneration, path in self.segments():
+			if segmentGeneration < generation:
+				continue
+			try:
+				reader.replay_segment(path, rows)
+			except (JournalError, EnvironmentError):
+				_moduleLogger.exception("Stopped replaying at %s" % path)
+				break
+
+	def start(self, nodes, renderer, setAside = False):
+		"""
+		Start journaling after the stack is loaded, compacting it so the
+		segments it was recovered from can go
+
+		@param setAside whether the stack wasn't recovered from the journal
+			on disk, its segments and snapshot are then renamed with an
+			.unreplayed suffix rather than removed
+		"""
+		if setAside:
+			self._set_aside()
+		self._generation = self._latest_generation()
+		self.compact(nodes, renderer)
+
+	def is_compaction_due(self):
+		return self._compactEvery <= self._recordCount and not self.is_compacting()
+
+	def is_compacting(self):
+		return self._compactor is not None and self._compactor.isAlive()
+
+	def compact(self, nodes, renderer):
+		"""
+		Start a new segment and snapshot the stack into it in the background
+
+		@param nodes the stack, bottom first, as of the end of the current
+			segment
+		@returns False if a compaction is still running
+		"""
+		if self.is_compacting():
+			return False
+
+		nodes = list(nodes)
+		started = time.time()
+		self._open_segment(self._generation + 1)
+		self._isTextCompacted = False
+		self._compactor = threading.Thread(
+			target=self._compact,
+			args=(nodes, renderer, self._generation, started),
+			name="JournalCompactor",
+		)
+		self._compactor.setDaemon(True)
+		self._compactor.start()
+		return True
+
+	def sync(self):
+		if self._unsynced:
+			self._file.flush()
+			os.fsync(self._file.fileno())
+			self._unsynced = 0
+
+	def close(self, nodes = None):
+		"""
+		Sync the last records, after waiting on a running compaction
+
+		@param nodes the stack, bottom first, to write its text for when
+			there is a textPath.  The last compaction already wrote it unless
+			records came since.
+
+		>>> import shutil, tempfile
+		>>> directory = tempfile.mkdtemp()
+		>>> textPath = os.path.join(directory, "text")
+		>>> journal = Journal(os.path.join(directory, "journal"), os.path.join(directory, "snapshot"), textPath)
+		>>> journal.close([])
+		>>> os.path.exists(textPath)
+		False
+		>>> journal.start([], operation.render_number())
+		>>> journal.close([])
+		>>> open(textPath).read()
+		''
+		>>> journal = Journal(os.path.join(directory, "journal"), os.path.join(directory, "snapshot"), textPath)
+		>>> journal.start([], operation.render_number())
+		>>> journal.record_push(operation.Value(15, 8))
+		>>> journal.close([operation.Value(15, 8)])
+		>>> open(textPath).read()
+		'0o17\\n'
+		>>> shutil.rmtree(directory)
+		"""
+		if self._compactor is not None:
+			self._compactor.join()
+			self._compactor = None
+		self._close_segment()
+		isTextBehind = 0 < self._recordCount or not self._isTextCompacted
+		if nodes is not None and self._textPath is not None and isTextBehind:
+			modified = self.last_modified()
+			if modified is None:
+				modified = time.time()
+			# Whole seconds so the text isn't rounded to newer than the journal
+			modified = math.floor(modified)
+			try:
+				_save_text(self._textPath, nodes, modified)
+			except EnvironmentError:
+				_moduleLogger.exception("Failed to write %s" % self._textPath)
+
+	def record_push(self, node):
+		self._write("push %s" % self._encode(node))
+		self._taken.pushed()
+
+	def record_pop(self, node):
+		self._taken.take(node)
+		self._write("pop")
+
+	def record_insert(self, row, node):
+		self._write("insert %d %s" % (row, self._encode(node)))
+		self._taken.pushed()
+
+	def record_remove(self, row, node):
+		self._taken.take(node)
+		self._write("remove %d" % row)
+
+	def record_replace(self, row, node):
+		self._write("replace %d %s" % (row, self._encode(node)))
+		self._taken.pushed()
+
+	def record_clear(self):
+		self._taken.reset()
+		self._write("clear")
+
+	def _write(self, record):
+		self._file.write(record)
+		self._file.write("\n")
+		self._recordCount += 1
+		self._unsynced += 1
+		if self._syncEvery <= self._unsynced:
+			self.sync()
+
+	def _encode(self, node):
+		reference = self._taken.reference
+		tokens = reference(node)
+		if tokens is None:
+			# Most nodes are values or apply an operator to what was just
+			# taken, skip walking those
+			args = [reference(arg) for arg in operation._construction_args(node)]
+			if None in args:
+				tokens = operation.fold_tree(node, _encode_node, reference, operation._construction_args)
+			else:
+				tokens = _encode_node(node, args)
+		if isinstance(tokens, basestring):
+			return tokens
+		return " ".join(operation._iter_rope(tokens))
+
+	def _open_segment(self, generation):
+		self._close_segment()
+		self._file = open("%s.%d" % (self._path, generation), "wb")
+		self._file.write("%s\n" % _HEADER)
+		self._file.flush()
+		os.fsync(self._file.fileno())
+		self._generation = generation
+		self._recordCount = 0
+		self._taken.reset()
+
+	def _close_segment(self):
+		if self._file is not None:
+			self.sync()
+			self._file.close()
+			self._file = None
+
+	def _latest_generation(self):
+		generations = [generation for generation, path in self.segments()]
+		try:
+			data = snapshot.Snapshot.open(self._snapshotPath)
+		except (snapshot.SnapshotError, EnvironmentError):
+			pass
+		else:
+			generations.append(data.generation)
+			data.close()
+		return max(generations) if generations else 0
+
+	def _compact(self, nodes, renderer, generation, started):
+		# Runs on its own thread, the segments before generation stay until
+		# the snapshot replacing them is safely on disk
+		try:
+			if self._textPath is not None:
+				_save_text(self._textPath, nodes, started)
+				self._isTextCompacted = True
+			snapshot.save(self._snapshotPath, nodes, renderer, generation)
+		except StandardError:
+			# Anything going wrong leaves the segments to recover from
+			_moduleLogger.exception("Failed to compact the journal")
+			return
+		self._remove_segments(generation)
+
+	def _set_aside(self):
+		paths = [path for generation, path in self.segments()]
+		paths.append(self._snapshotPath)
+		for path in paths:
+			if not os.path.exists(path):
+				continue
+			asidePath = "%s.unreplayed" % path
+			os.rename(path, asidePath)
+			_moduleLogger.warning("Set %s aside as %s" % (path, asidePath))
+
+	def _remove_segments(self, generation):
+		for segmentGeneration, path in self.segments():
+			if generation <= segmentGeneration:
+				continue
+			try:
+				os.remove(path)
+			except OSError:
+				_moduleLogger.exception("Failed to remove %s" % path)
+
+
+class NullJournal(object):
+	"""
+	Stands in while the history isn't journaled
+	"""
+
+	def record_push(self, node):
+		pass
+
+	def record_pop(self, node):
+		pass
+
+	def record_insert(self, row, node):
+		pass
+
+	def record_remove(self, row, node):
+		pass
+
+	def record_replace(self, row, node):
+		pass
+
+	def record_clear(self):
+		pass
+
+
+class _TakenNodes(object):
+	"""
+	The nodes an operation took off the stack, and their children, that what
+	it puts back can refer to.  Writing and replaying keep them the same way
+	so they agree on the indices.
+	"""
+
+	def __init__(self):
+		self.nodes = []
+		self._indices = {}
+		self._hasPushed = False
+
+	def take(self, node):
+		if self._hasPushed:
+			# Taking after putting back starts the next operation
+			self.reset()
+		self._indices[id(node)] = len(self.nodes)
+		self.nodes.append(node)
+		for child in node.get_children():
+			self._indices[id(child)] = len(self.nodes)
+			self.nodes.append(child)
+
+	def pushed(self):
+		self._hasPushed = True
+
+	def reset(self):
+		self.nodes = []
+		self._indices = {}
+		self._hasPushed = False
+
+	def reference(self, node):
+		index = self._indices.get(id(node))
+		if index is None:
+			return None
+		return ["@%d" % index]
+
+
+class _JournalReader(object):
+
+	def __init__(self, constants, operators, interner):
+		self._constants = constants
+		self._operators = operators
+		self._interner = interner
+
+	def replay_segment(self, path, rows):
+		with open(path, "rb") as f:
+			lines = f.read().split("\n")
+		# Whatever follows the last newline is a record torn by a crash
+		del lines[-1]
+		if not lines or lines[0] != _HEADER:
+			raise JournalError("%s isn't a version %d journal" % (path, JOURNAL_VERSION))
+
+		taken = _TakenNodes()
+		for lineNumber, record in enumerate(lines[1:]):
+			try:
+				self._replay_record(record, rows, taken)
+			except (LookupError, ValueError), e:
+				raise JournalError("%s:%d: %s" % (path, lineNumber + 2, e))
+
+	def _replay_record(self, record, rows, taken):
+		action, ignored, args = record.partition(" ")
+		if action == "push":
+			rows.append(self._row(args.split(" "), taken))
+			taken.pushed()
+		elif action == "pop":
+			taken.take(rows.pop()[0])
+		elif action == "insert":
+			row, tokens = args.split(" ", 1)
+			rows.insert(self._index(row, rows, 1), self._row(tokens.split(" "), taken))
+			taken.pushed()
+		elif action == "remove":
+			taken.take(rows.pop(self._index(args, rows))[0])
+		elif action == "replace":
+			row, tokens = args.split(" ", 1)
+			rows[self._index(row, rows)] = self._row(tokens.split(" "), taken)
+			taken.pushed()
+		elif action == "clear":
+			del rows[:]
+			taken.reset()
+		else:
+			raise JournalError("Unknown record %r" % record)
+
+	def _index(self, text, rows, extra = 0):
+		row = int(text)
+		if not (0 <= row < len(rows) + extra):
+			raise JournalError("Row %d is out of range" % row)
+		return row
+
+	def _row(self, tokens, taken):
+		nodes = []
+		for token in tokens:
+			kind, text = token[0], token[1:]
+			if kind == "@":
+				nodes.append(taken.nodes[int(text)])
+			elif kind == "o":
+				count, symbol = text.split(":", 1)
+				count = int(count)
+				if len(nodes) < count:
+					raise JournalError("%s needs %d arguments" % (symbol, count))
+				args = nodes[len(nodes) - count:]
+				del nodes[len(nodes) - count:]
+				nodes.append(self._interner.function(self._operators[symbol], *args))
+			elif kind in _VALUE_PARSERS:
+				base, text = text.split(":", 1)
+				value = _VALUE_PARSERS[kind](text)
+				nodes.append(self._interner.value(value, int(base)))
+			elif kind == "$":
+				nodes.append(self._interner.variable(text))
+			elif kind == "k":
+				nodes.append(self._constants[text])
+			else:
+				raise JournalError("Unknown token %r" % token)
+		if len(nodes) != 1:
+			raise JournalError("Expected one node, got %d" % len(nodes))
+		return nodes[0], None, None
+
+
+def _save_text(path, nodes, modified):
+	serialRenderer = operation.render_number_literal()
+	tempPath = "%s.tmp" % path
+	try:
+		with open(tempPath, "w") as f:
+			for node in nodes:
+				f.write("%s\n" % " ".join(node.serialize(serialRenderer)))
+			f.flush()
+			os.fsync(f.fileno())
+		# Renaming keeps the time, so the text is never newer than the segment
+		# started after it
+		os.utime(tempPath, (modified, modified))
+		os.rename(tempPath, path)
+	except:
+		if os.path.exists(tempPath):
+			os.remove(tempPath)
+		raise
+
+
+_VALUE_PARSERS = {
+	"i": int,
+	"f": float,
+	"c": complex,
+}
+
+
+def _encode_node(node, args):
+	if isinstance(node, operation.Function):
+		return args + ["o%d:%s" % (len(args), node.symbol)]
+	elif isinstance(node, operation.Value):
+		return _encode_value(node.value, node.base)
+	elif isinstance(node, operation.Variable):
+		return "$%s" % node.name
+	elif isinstance(node, operation.Constant):
+		return "k%s" % node.name
+	else:
+		raise JournalError("Can't journal %r" % (node, ))
+
+
+def _encode_value(value, base):
+	if isinstance(value, (int, long)):
+		return "i%d:%d" % (base, value)
+	elif isinstance(value, float):
+		return "f%d:%r" % (base, value)
+	elif isinstance(value, complex):
+		return "c%d:%r" % (base, value)
+	else:
+		raise JournalError("Can't journal values of type %s" % type(value).__name__)
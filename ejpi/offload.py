@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""
+Runs expensive operator calls in child processes, so big-integer work isn't
+held up by, or holding up, the GIL of the UI process and can be killed
+outright when cancelled
+"""
+
+from __future__ import with_statement
+
+import threading
+import cPickle as pickle
+import logging
+
+try:
+	import multiprocessing
+except ImportError:
+	multiprocessing = None
+
+
+import operation
+
+
+_moduleLogger = logging.getLogger(__name__)
+
+
+class Cancelled(Exception):
+	pass
+
+
+class TimedOut(Cancelled, operation.OverBudget):
+	pass
+
+
+class ProcessBackend(object):
+	"""
+	Each call gets a forked child, the operator and operands are inherited
+	rather than pickled (operators are often lambdas) and only the result
+	comes back through a pipe.  Calls block the calling thread, not the GIL.
+
+	>>> backend = ProcessBackend(2)
+	>>> backend.apply(pow, (3, 4))
+	81
+	>>> backend.apply(divmod, (7, 0))
+	Traceback (most recent call last):
+	...
+	ZeroDivisionError: integer division or modulo by zero
+	>>> import time
+	>>> backend.apply(time.sleep, (10, ), 0.1)
+	Traceback (most recent call last):
+	...
+	TimedOut: Calculation ran out of time
+	"""
+
+	def __init__(self, processes = None):
+		assert multiprocessing is not None, "multiprocessing is not available"
+		if processes is None:
+			processes = multiprocessing.cpu_count()
+		self._slots = threading.Semaphore(processes)
+		self._childrenLock = threading.Lock()
+		self._children = set()
+
+	def apply(self, func, args, timeout = None):
+		"""
+		@param timeout seconds to wait before killing the child, None to wait
+			for as long as it takes
+		"""
+		with self._slots:
+			receiver, sender = multiprocessing.Pipe(False)
+			child = multiprocessing.Process(target=_run_in_child, args=(sender, func, args))
+			child.daemon = True
+			with self._childrenLock:
+				child.start()
+				self._children.add(child)
+			sender.close()
+			try:
+				if timeout is not None and not receiver.poll(timeout):
+					child.terminate()
+					raise TimedOut("Calculation ran out of time")
+				try:
+					payload = receiver.recv_bytes()
+				except EOFError:
+					raise Cancelled("Calculation was cancelled")
+			finally:
+				receiver.close()
+				child.join()
+				with self._childrenLock:
+					self._children.discard(child)
+
+		isError, result = pickle.loads(payload)
+		if isError:
+			raise result
+		return result
+
+	def cancel(self):
+		"""
+		Kill every running call, they raise Cancelled
+		"""
+		with self._childrenLock:
+			children = list(self._children)
+		for child in children:
+			_moduleLogger.info("Killing %r" % (child, ))
+			child.terminate()
+
+
+def _run_in_child(sender, func, args):
+	try:
+		result = False, func(*args)
+	except Exception, e:
+		result = True, e
+
+	try:
+		payload = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+	except Exception, e:
+		# Not everything survives pickling, the message at least does
+		isError, value = result
+		if isError:
+			failure = RuntimeError("%s: %s" % (type(value).__name__, value))
+		else:
+			failure = RuntimeError("Can't send back a result of type %s: %s" % (type(value).__name__, e))
+		payload = pickle.dumps((True, failure), pickle.HIGHEST_PROTOCOL)
+	sender.send_bytes(payload)
+	sender.close()
@@ -1,12 +1,23 @@
 #!/usr/bin/env python
 
 
-import itertools
+import math
+import time
+import weakref
 import functools
 import decimal
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+try:
+	import gmpy
+except ImportError:
+	gmpy = None
+
 from util import overloading
-from util import algorithms
 
 
 @overloading.overloaded
@@ -59,50 +70,278 @@ def render_complex(floatRender):
 	return render_complex_real
 
 
-def _seperate_num(rendered, sep, count):
+def _seperate_num(rendered, sep, count, leadCount = None):
 	"""
+	@param leadCount how many digits go before the first seperator, by
+		default whatever is left over from grouping the rest by count
+
 	>>> _seperate_num("123", ",", 3)
 	'123'
 	>>> _seperate_num("123456", ",", 3)
 	'123,456'
 	>>> _seperate_num("1234567", ",", 3)
 	'1,234,567'
+	>>> _seperate_num("1234567", ",", 3, 2)
+	'12,345,67'
 	"""
-	leadCount = len(rendered) % count
-	choppyRest = algorithms.itergroup(rendered[leadCount:], count)
-	rest = (
-		"".join(group)
-		for group in choppyRest
-	)
+	if leadCount is None:
+		leadCount = len(rendered) % count
+	parts = [
+		rendered[start:start+count]
+		for start in xrange(leadCount, len(rendered), count)
+	]
 	if 0 < leadCount:
-		lead = rendered[0:leadCount]
-		parts = itertools.chain((lead, ), rest)
-	else:
-		parts = rest
+		parts.insert(0, rendered[0:leadCount])
 	return sep.join(parts)
 
 
-def render_integer_oct(value, sep=""):
-	rendered = oct(int(value))
+# Below this many bits of quotient divmod's schoolbook division is faster
+# than splitting the division up
+_DIV_LIMIT = 4000
+
+
+def _div2n1n(a, b, n):
+	"""
+	Burnikel and Ziegler's recursive division of a, less than b shifted by
+	n, by b of n bits.  Quotients are worked out half at a time so most of
+	the work is multiplications, which are Karatsuba's rather than
+	quadratic.
+
+	@returns (quotient, remainder)
+	"""
+	if a.bit_length() - n <= _DIV_LIMIT:
+		return divmod(a, b)
+	pad = n & 1
+	if pad:
+		a <<= 1
+		b <<= 1
+		n += 1
+	halfN = n >> 1
+	mask = (1 << halfN) - 1
+	b1, b2 = b >> halfN, b & mask
+	q1, r = _div3n2n(a >> n, (a >> halfN) & mask, b, b1, b2, halfN)
+	q2, r = _div3n2n(r, a & mask, b, b1, b2, halfN)
+	if pad:
+		r >>= 1
+	return q1 << halfN | q2, r
+
+
+def _div3n2n(a12, a3, b, b1, b2, n):
+	if a12 >> n == b1:
+		q, r = (1 << n) - 1, a12 - (b1 << n) + b1
+	else:
+		q, r = _div2n1n(a12, b1, n)
+	r = (r << n | a3) - q * b2
+	while r < 0:
+		q -= 1
+		r += b
+	return q, r
+
+
+def _divmod_large(a, b):
+	"""
+	divmod of a non-negative a by a positive b, a being less than b
+	shifted by b's bit length
+	"""
+	n = b.bit_length()
+	if a.bit_length() - n <= _DIV_LIMIT:
+		return divmod(a, b)
+	return _div2n1n(a, b, n)
+
+
+# Up to this many digits str() is as fast as splitting the number up
+_DIGITS_LIMIT = 2000
+
+_LOG10_2 = math.log10(2)
+
+
+def _decimal_digits(value):
+	"""
+	@returns the decimal digits of a non-negative integer.  str() takes
+		quadratic time on longs, past _DIGITS_LIMIT they are split in halves on
+		powers of ten, each half converted on its own.
+
+	>>> _decimal_digits(0)
+	'0'
+	>>> big = 7 ** 20000
+	>>> _decimal_digits(big) == str(big)
+	True
+	"""
+	# One more digit than needed, in case of rounding, is stripped again
+	width = int(value.bit_length() * _LOG10_2) + 2
+	if width <= _DIGITS_LIMIT:
+		return str(value)
+	if gmpy is not None:
+		return gmpy.mpz(value).digits(10)
+	parts = []
+	_split_decimal(value, width, {}, parts)
+	return "".join(parts).lstrip("0")
+
+
+def _split_decimal(value, width, powers, parts):
+	"""
+	Append value's digits, zero padded to width, to parts
+	"""
+	if width <= _DIGITS_LIMIT:
+		parts.append(str(value).zfill(width))
+		return
+	# The low half is the wider so value stays under power shifted by its bit length
+	halfWidth = (width + 1) // 2
+	power = powers.get(halfWidth)
+	if power is None:
+		power = powers[halfWidth] = 10 ** halfWidth
+	high, low = _divmod_large(value, power)
+	_split_decimal(high, width - halfWidth, powers, parts)
+	_split_decimal(low, halfWidth, powers, parts)
+
+
+# Bits per digit of the bases with a digit per fixed number of bits
+_DIGIT_BITS = {
+	8: 3,
+	16: 4,
+}
+
+# The base integers of each base are shown in, binary being shown as hex
+_SHOWN_BASES = {
+	2: 16,
+	8: 8,
+	10: 10,
+	16: 16,
+}
+
+
+def _integer_digits(value, base):
+	"""
+	@returns the digits of a non-negative integer, without a prefix
+	"""
+	if base == 16:
+		return "%x" % value
+	elif base == 8:
+		return "%o" % value
+	else:
+		return _decimal_digits(value)
+
+
+def _integer_prefix(value, base, sep):
+	if base == 16:
+		return "0x"
+	elif base == 8:
+		# Like oct(), 0o only once the digits are seperated
+		if 0 < len(sep):
+			return "0o"
+		return "0" if value else ""
+	else:
+		return ""
+
+
+def _render_integer(value, base, sep):
+	value = int(value)
+	sign = "-" if value < 0 else ""
+	rendered = _integer_digits(abs(value), base)
 	if 0 < len(sep):
-		assert rendered.startswith("0")
-		rendered = "0o%s" % _seperate_num(rendered[1:], sep, 3)
-	return rendered
+		rendered = _seperate_num(rendered, sep, 3)
+	return "%s%s%s" % (sign, _integer_prefix(value, base, sep), rendered)
+
+
+def render_integer_oct(value, sep=""):
+	"""
+	>>> render_integer_oct(15), render_integer_oct(-15), render_integer_oct(0)
+	('017', '-017', '0')
+	>>> render_integer_oct(4095, ",")
+	'0o7,777'
+	"""
+	return _render_integer(value, 8, sep)
+
+
+def _render_integer_oct_literal(value):
+	"""
+	>>> _render_integer_oct_literal(-15)
+	'-0o17'
+	"""
+	value = int(value)
+	sign = "-" if value < 0 else ""
+	return "%s0o%s" % (sign, _integer_digits(abs(value), 8))
 
 
 def render_integer_dec(value, sep=""):
-	rendered = str(int(value))
-	if 0 < len(sep):
-		rendered = "%s" % _seperate_num(rendered, sep, 3)
-	return rendered
+	"""
+	>>> render_integer_dec(-1234567, ",")
+	'-1,234,567'
+	"""
+	return _render_integer(value, 10, sep)
 
 
 def render_integer_hex(value, sep=""):
-	rendered = hex(int(value))
-	if 0 < len(sep):
-		assert rendered.startswith("0x")
-		rendered = "0x%s" % _seperate_num(rendered[2:], sep, 3)
-	return rendered
+	"""
+	>>> render_integer_hex(2 ** 64)
+	'0x10000000000000000'
+	"""
+	return _render_integer(value, 16, sep)
+
+
+# Digits worked out past the ones shown, to tell if rounding reached them
+_GUARD_DIGITS = 20
+
+
+def _leading_decimal_digits(value, count):
+	"""
+	@returns (the first count decimal digits, how many digits there are) of
+		a positive integer, from an approximation of its top bits so nothing
+		is divided
+	"""
+	precision = count + _GUARD_DIGITS
+	shift = value.bit_length() - 4 * precision
+	if 0 < shift and _DIGITS_LIMIT < shift * _LOG10_2:
+		context = decimal.Context(prec=precision)
+		approximation = context.multiply(
+			decimal.Decimal(value >> shift),
+			context.power(decimal.Decimal(2), shift),
+		)
+		sign, digits, exponent = approximation.as_tuple()
+		# Off by a couple of units in the last place, which only matters
+		# when that carries into the digits shown
+		guard = frozenset(digits[count:-2])
+		if len(digits) == precision and guard != frozenset([0]) and guard != frozenset([9]):
+			leading = "".join(str(digit) for digit in digits[0:count])
+			return leading, len(digits) + exponent
+
+	rendered = _decimal_digits(value)
+	return rendered[0:count], len(rendered)
+
+
+def render_integer_elided(value, base, edgeCount):
+	"""
+	@returns the integer as its first and last edgeCount digits and how
+		many digits there are, without working out the digits between
+
+	>>> render_integer_elided(2 ** 100, 10, 5)
+	'12676...05376 (31 digits)'
+	>>> render_integer_elided(-2 ** 100, 16, 3)
+	'-0x100...000 (26 digits)'
+	>>> render_integer_elided(2 ** 100, 8, 3)
+	'0200...000 (34 digits)'
+	>>> render_integer_elided(1234, 10, 3)
+	'1234'
+	"""
+	value = int(value)
+	sign = "-" if value < 0 else ""
+	value = abs(value)
+	base = _SHOWN_BASES.get(base, 10)
+
+	if base == 10:
+		leading, digitCount = _leading_decimal_digits(value, edgeCount) if value else ("0", 1)
+		trailingPower = 10 ** edgeCount
+	else:
+		digitBits = _DIGIT_BITS[base]
+		digitCount = max((value.bit_length() + digitBits - 1) // digitBits, 1)
+		leading = _integer_digits(value >> (digitBits * max(digitCount - edgeCount, 0)), base)
+		trailingPower = 1 << (digitBits * edgeCount)
+	if digitCount <= 2 * edgeCount:
+		return _render_integer(-value if sign else value, base, "")
+
+	trailing = _integer_digits(value % trailingPower, base).zfill(edgeCount)
+	prefix = _integer_prefix(value, base, "")
+	return "%s%s%s...%s (%d digits)" % (sign, prefix, leading, trailing, digitCount)
 
 
 def set_render_int_seperator(renderer, sep):
@@ -120,7 +359,13 @@ class render_number(object):
 		ints = None,
 		f = None,
 		c = None,
+		maxDigits = None,
 	):
+		"""
+		@param maxDigits integers with more digits than this are shown as
+			their first and last digits and how many there are, None to show
+			every digit
+		"""
 		if ints is not None:
 			self.render_int = ints
 		else:
@@ -132,6 +377,7 @@ class render_number(object):
 			}
 		self.render_float = f if c is not None else render_float
 		self.render_complex = c if c is not None else self
+		self.maxDigits = maxDigits
 
 	def __call__(self, value, base):
 		return self.render(value, base)
@@ -141,7 +387,12 @@ class render_number(object):
 		return str(value)
 
 	@render.register(overloading.AnyType, int, overloading.AnyType)
+	@render.register(overloading.AnyType, long, overloading.AnyType)
 	def _render_int(self, value, base):
+		if self.maxDigits is not None:
+			digitBits = _DIGIT_BITS.get(_SHOWN_BASES.get(base, 10), 1 / _LOG10_2)
+			if self.maxDigits * digitBits < value.bit_length():
+				return render_integer_elided(value, base, self.maxDigits // 2)
 		renderer = self.render_int.get(base, render_integer_dec)
 		return renderer(value)
 
@@ -154,8 +405,29 @@ class render_number(object):
 		return self.render_float(value)
 
 
+def render_number_literal():
+	"""
+	@returns a render_number for text that is parsed back, like a saved
+		stack, where an octal 017 would read back as decimal 17
+
+	>>> render_number_literal()(15, 8), render_number_literal()(5, 2)
+	('0o17', '0x5')
+	"""
+	return render_number(ints = {
+		2: render_integer_hex,
+		8: _render_integer_oct_literal,
+		10: render_integer_dec,
+		16: render_integer_hex,
+	})
+
+
 class Operation(object):
 
+	# (token, text) left by the RenderCache that last rendered the node
+	_rendered = None
+	# NodeInterner the node is the shared instance of
+	_interner = None
+
 	def __init__(self):
 		self._base = 10
 
@@ -168,12 +440,30 @@ class Operation(object):
 		return base
 
 	def get_children(self):
+		"""
+		@returns the arguments the node was built from
+		"""
 		return []
 
+	def get_terms(self):
+		"""
+		@returns the arguments the node is computed from, what an absorbed
+			chain of an associative operator stands for
+		"""
+		return self.get_children()
+
 	def serialize(self, renderer):
-		for child in self.get_children():
-			for childItem in child.serialize(renderer):
-				yield childItem
+		"""
+		@returns an iterator over the RPN tokens that rebuild the tree
+		"""
+		tokens = fold_tree(self, lambda node, children: node._serialize_parts(renderer, children))
+		return _iter_rope(tokens)
+
+	def _serialize_parts(self, renderer, children):
+		"""
+		@returns this node's tokens, as a rope, given the ropes of its children
+		"""
+		return children
 
 	def simplify(self):
 		"""
@@ -188,6 +478,29 @@ class Operation(object):
 		"""
 		raise NotImplementedError
 
+	def _evaluate(self, depthLeft):
+		"""
+		evaluate, recursing at most depthLeft more levels before walking the
+		rest of the tree with fold_tree
+		"""
+		return self.evaluate()
+
+	def compile(self):
+		"""
+		@returns a function that evaluates the tree in one flat pass, taking
+			the tree's variables as positional parameters in the order given by
+			its "variables" attribute
+		"""
+		return compile_operation(self)
+
+	def evaluate_array(self, variables):
+		"""
+		@param variables mapping of variable names to arrays of values
+		@returns an array of the values the tree represents for each element
+			of the (broadcasted) variable arrays
+		"""
+		return evaluate_array(self, variables)
+
 	def __call__(self):
 		return self.evaluate()
 
@@ -199,11 +512,8 @@ class Value(Operation):
 		self.value = value
 		self._base = base
 
-	def serialize(self, renderer):
-		for item in super(Value, self).serialize(renderer):
-			yield item
-		for component in serialize_value(self.value, self.base, renderer):
-			yield component
+	def _serialize_parts(self, renderer, children):
+		return list(serialize_value(self.value, self.base, renderer))
 
 	def __str__(self):
 		return str(self.value)
@@ -214,6 +524,9 @@ class Value(Operation):
 	def evaluate(self):
 		return self.value
 
+	def _evaluate(self, depthLeft):
+		return self.value
+
 
 class Constant(Operation):
 
@@ -222,10 +535,8 @@ class Constant(Operation):
 		self.name = name
 		self.__valueNode = valueNode
 
-	def serialize(self, renderer):
-		for item in super(Constant, self).serialize(renderer):
-			yield item
-		yield self.name
+	def _serialize_parts(self, renderer, children):
+		return [self.name]
 
 	def __str__(self):
 		return self.name
@@ -243,10 +554,8 @@ class Variable(Operation):
 		super(Variable, self).__init__()
 		self.name = name
 
-	def serialize(self, renderer):
-		for item in super(Variable, self).serialize(renderer):
-			yield item
-		yield self.name
+	def _serialize_parts(self, renderer, children):
+		return [self.name]
 
 	def __str__(self):
 		return self.name
@@ -266,6 +575,16 @@ class Function(Operation):
 	REP_POSTFIX = 3
 
 	_op = None
+	_array_op = None
+	_ufunc = None
+	_commutative = False
+	_associative = False
+	_identity = None
+	_absorbing = None
+	_involution = False
+	_integral = False
+	_estimate = None
+	_cost = None
 	_rep = REP_FUNCTION
 	symbol = None
 	argumentCount = 0
@@ -275,55 +594,182 @@ class Function(Operation):
 		self._base = None
 		self._args = args
 		self._kwd = kwd
-		self._simple = self._simplify()
-		self._str = self.pretty_print(args, kwd)
+		# Derived data is computed on first use so building a node stays O(1)
+		self._simple = None
 
-	def serialize(self, renderer):
-		for item in super(Function, self).serialize(renderer):
-			yield item
-		yield self.symbol
+	def _serialize_parts(self, renderer, children):
+		return children + [self.symbol]
 
 	def get_children(self):
-		return (
-			arg
-			for arg in self._args
-		)
+		return self._args
 
 	@property
 	def base(self):
 		base = self._base
 		if base is None:
-			bases = [arg.base for arg in self._args]
-			base = bases[0]
+			# Follow the first arguments down to a known base rather than
+			# recursing, then remember it along the way
+			unresolved = []
+			node = self
+			while isinstance(node, Function) and node._base is None:
+				unresolved.append(node)
+				node = node._args[0]
+			base = node.base
+			for node in unresolved:
+				node._base = base
 		assert base is not None
 		return base
 
 	def __str__(self):
-		return self._str
+		return _flatten_text(self, str)
 
 	def simplify(self):
-		return self._simple
+		simple = self._simple
+		if simple is None:
+			budget = _budget.start() if _budget is not None else None
+			if _recorder is None:
+				simplify_node = functools.partial(_simplify_node, budget)
+			else:
+				simplify_node = functools.partial(_simplify_node_timed, _recorder, budget)
+			simple = fold_tree(self, simplify_node, _known_simplification, _construction_args)
+		return simple
 
 	def evaluate(self):
-		selfArgs = [arg.evaluate() for arg in self._args]
-		return Value(self._op(*selfArgs), self.base)
-
-	def _simplify(self):
-		selfArgs = [arg.simplify() for arg in self._args]
-		selfKwd = dict(
-			(name, arg.simplify())
-			for (name, arg) in self._kwd
-		)
+		return self._evaluate(FOLD_RECURSION_LIMIT)
+
+	def _evaluate(self, depthLeft):
+		if not depthLeft:
+			return fold_tree(self, _evaluate_node)
+		depthLeft -= 1
+		return self._apply([arg._evaluate(depthLeft) for arg in self.get_terms()])
+
+	def _apply(self, args, budget = None):
+		if _offload is not None and (self._cost is not None or self._estimate is not None):
+			# Only operators with an estimate ever get expensive enough
+			backend, bits = _offload
+			cost = self.estimate_cost(args)
+			if cost is not None and bits < cost:
+				timeout = budget.time_left() if budget is not None else None
+				return backend.apply(self._compute, (args, ), timeout)
+		return self._compute(args)
+
+	def _compute(self, args):
+		return self._op(*args)
+
+	def estimate_bits(self, args):
+		"""
+		@param args the evaluated arguments
+		@returns rough upper bound on the bit length of the result, None when
+			the operator doesn't say
+		"""
+		if self._estimate is None:
+			return None
+		return self._estimate(*args)
 
-		try:
-			args = [arg.evaluate() for arg in selfArgs]
-			base = self.base
-			result = self._op(*args)
+	def estimate_cost(self, args):
+		"""
+		@param args the evaluated arguments
+		@returns rough size of the work of computing the result, as the bit
+			length of a multiplication's result that takes as long.  Defaults
+			to the result's estimated size.
+		"""
+		if self._cost is None:
+			return self.estimate_bits(args)
+		return self._cost(*args)
 
-			node = Value(result, base)
-		except KeyError:
-			node = self
+	def _apply_array(self, args):
+		if self._array_op is not None:
+			return self._array_op(*args)
 
+		if self._ufunc is not None:
+			ufunc = getattr(numpy, self._ufunc, None)
+			if ufunc is not None:
+				return ufunc(*args)
+
+		try:
+			# Plain operators already broadcast over arrays
+			return self._op(*args)
+		except (TypeError, ValueError):
+			pass
+
+		elementwise = numpy.frompyfunc(self._op, len(args), 1)
+		result = elementwise(*args)
+		if isinstance(result, numpy.ndarray) and result.dtype == object:
+			result = numpy.array(result.tolist())
+		return result
+
+	def _simplify(self, selfArgs, budget = None):
+		"""
+		@param selfArgs the simplified arguments
+		@param budget what is left of the simplification's Budget, if any
+		"""
+		if not any(isinstance(arg, Function) for arg in selfArgs):
+			# Simplified children only stay functions when they can't be
+			# evaluated, no need to walk their subtrees again to find out
+			try:
+				args = [arg.evaluate() for arg in selfArgs]
+				base = self.base
+				if budget is not None and not budget.allows(self, args):
+					return self._rebuild(selfArgs)
+				result = self._apply(args, budget)
+
+				return Value(result, base)
+			except KeyError:
+				pass
+			except OverBudget:
+				if budget is not None:
+					budget.stop(self)
+				return self._rebuild(selfArgs)
+
+		return self._rewrite(selfArgs, budget)
+
+	def _rewrite(self, selfArgs, budget = None):
+		"""
+		Apply the operator's algebraic identities to its symbolic, simplified
+		arguments.  Only the arguments are looked at, they are already in
+		simplified form, so this is a single bounded step per node.
+
+		>>> import operator
+		>>> add = generate_function(operator.add, "+", Function.REP_INFIX, 2, commutative=True, associative=True, identity=0)
+		>>> mul = generate_function(operator.mul, "*", Function.REP_INFIX, 2, commutative=True, associative=True, identity=1, absorbing=0)
+		>>> neg = generate_function(operator.neg, "+-", Function.REP_PREFIX, 1, involution=True)
+		>>> x = Variable("x")
+		>>> str(add(add(Value(2, 10), x), Value(3, 10)).simplify())
+		'(x + 5)'
+		>>> str(add(add(x, Value(2, 10)), add(Variable("y"), Value(-2, 10))).simplify())
+		'(x + y)'
+		>>> str(mul(add(x, Value(0, 10)), Value(1, 10)).simplify())
+		'x'
+		>>> str(add(x, Value(0.0, 10)).simplify())
+		'(x + 0.0)'
+		>>> str(mul(x, Value(0, 10)).simplify())
+		'0'
+		>>> str(neg(neg(add(x, Value(0, 10)))).simplify())
+		'x'
+
+		An integer only operator only cancels out around something known to
+		be an integer, anything else still raises
+
+		>>> invert = generate_function(operator.invert, "~", Function.REP_PREFIX, 1, involution=True, integral=True)
+		>>> str(invert(invert(neg(x))).simplify())
+		'~ ~ +- x'
+		>>> str(invert(invert(invert(x))).simplify())
+		'~ x'
+		"""
+		if self._involution and isinstance(selfArgs[0], type(self)):
+			inner = selfArgs[0]._args[0]
+			if not self._integral or _is_integral(inner):
+				return inner
+		return self._rebuild(selfArgs)
+
+	def _rebuild(self, selfArgs):
+		if len(selfArgs) == len(self._args) and all(
+			arg is orig
+			for (arg, orig) in zip(selfArgs, self._args)
+		):
+			return self
+		node = type(self)(*selfArgs)
+		node._simple = node
 		return node
 
 	@classmethod
@@ -333,41 +779,250 @@ class Function(Operation):
 		if kwds is None:
 			kwds = {}
 
+		return "".join(str(part) for part in cls.layout(args, kwds))
+
+	@classmethod
+	def layout(cls, args, kwds = None):
+		"""
+		@returns the pieces of text making up the printed form, with the
+			arguments left in place to be rendered by the caller
+		"""
+		if kwds is None:
+			kwds = {}
+
 		if cls._rep == cls.REP_FUNCTION:
-			positional = (str(arg) for arg in args)
-			named = (
-				"%s=%s" % (str(key), str(value))
-				for (key, value) in kwds.iteritems()
-			)
-			return "%s(%s)" % (
-				cls.symbol,
-				", ".join(itertools.chain(named, positional)),
-			)
+			parts = [str(cls.symbol), "("]
+			for (key, value) in kwds.iteritems():
+				parts.extend((str(key), "=", value, ", "))
+			for arg in args:
+				parts.extend((arg, ", "))
+			if 0 < len(kwds) + len(args):
+				parts.pop()
+			parts.append(")")
+			return parts
 		elif cls._rep == cls.REP_PREFIX:
 			assert len(args) == 1
-			return "%s %s" % (cls.symbol, args[0])
+			return [str(cls.symbol), " ", args[0]]
 		elif cls._rep == cls.REP_POSTFIX:
 			assert len(args) == 1
-			return "%s %s" % (args[0], cls.symbol)
+			return [args[0], " ", str(cls.symbol)]
 		elif cls._rep == cls.REP_INFIX:
 			assert len(args) == 2
-			return "(%s %s %s)" % (
-				str(args[0]),
-				str(cls.symbol),
-				str(args[1]),
-			)
+			return ["(", args[0], " ", str(cls.symbol), " ", args[1], ")"]
 		else:
 			raise AssertionError("Unsupported rep style")
 
 
-def generate_function(op, rep, style, numArgs):
+class NaryFunction(Function):
+	"""
+	Associative operator that absorbs a first argument of the same
+	operator, so accumulations stay one node deep and evaluate in one bulk
+	call
+
+	It is still applied to argumentCount items at a time, the absorbed form
+	prints and serializes the same as the equivalent left-deep chain.
+
+	>>> import operator
+	>>> add = generate_function(operator.add, "+", Function.REP_INFIX, 2, associative=True, bulk=sum)
+	>>> chain = add(add(add(Value(1, 10), Value(2, 10)), Value(3, 10)), add(Variable("x"), Value(4, 10)))
+	>>> len(chain.get_terms()), len(chain.get_children())
+	(4, 2)
+	>>> str(chain)
+	'(((1 + 2) + 3) + (x + 4))'
+	>>> list(chain.serialize(render_number()))
+	['1', '2', '+', '3', '+', 'x', '4', '+', '+']
+	"""
 
-	class GenFunc(Function):
+	_bulk = None
+
+	def __init__(self, *args, **kwd):
+		super(NaryFunction, self).__init__(*args, **kwd)
+		# Only the first argument is absorbed, absorbing others would change
+		# the grouping that is displayed.  The absorbed node is linked rather
+		# than copied so accumulating one item at a time stays O(1) a push,
+		# and simplification still walks _args to reuse what it simplified to.
+		self._absorbs = bool(args) and type(args[0]) is type(self)
+
+	def get_terms(self):
+		if not self._absorbs:
+			return self._args
+
+		tails = []
+		node = self
+		while node._absorbs:
+			tails.append(node._args[1:])
+			node = node._args[0]
+		terms = list(node._args)
+		for tail in reversed(tails):
+			terms.extend(tail)
+		return tuple(terms)
+
+	def _compute(self, args):
+		return self._fold(args)
+
+	def _fold(self, values):
+		if self._bulk is not None:
+			return self._bulk(values)
+		return reduce(self._op, values)
+
+	def _apply_array(self, args):
+		binary = super(NaryFunction, self)._apply_array
+		return reduce(lambda lhs, rhs: binary((lhs, rhs)), args)
+
+	def _serialize_parts(self, renderer, children):
+		parts = children[0:1]
+		for child in children[1:]:
+			parts.extend((child, self.symbol))
+		return parts
+
+	@classmethod
+	def layout(cls, args, kwds = None):
+		if cls._rep != cls.REP_INFIX or len(args) < 2:
+			return super(NaryFunction, cls).layout(args, kwds)
+
+		parts = ["("] * (len(args) - 1)
+		parts.append(args[0])
+		for arg in args[1:]:
+			parts.extend((" ", str(cls.symbol), " ", arg, ")"))
+		return parts
+
+	def _rewrite(self, selfArgs, budget = None):
+		"""
+		Only an int identity or absorbing element is applied, a float or
+		complex one still changes the result's type
+
+		>>> import operator
+		>>> mul = generate_function(operator.mul, "*", Function.REP_INFIX, 2, commutative=True, associative=True, identity=1, absorbing=0)
+		>>> band = generate_function(operator.and_, "&", Function.REP_INFIX, 2, commutative=True, associative=True, identity=-1, absorbing=0, integral=True)
+		>>> bor = generate_function(operator.or_, "|", Function.REP_INFIX, 2, commutative=True, associative=True, identity=0, absorbing=-1, integral=True)
+		>>> x, y = Variable("x"), Variable("y")
+		>>> str(mul(x, Value(0, 10)).simplify()), str(mul(x, Value(0j, 10)).simplify())
+		('0', '(x * 0j)')
+		>>> str(band(x, Value(0.0, 10)).simplify()), str(bor(x, Value(-1.0, 10)).simplify())
+		('(x & 0.0)', '(x | -1.0)')
+
+		The integer only operators keep them next to anything that could
+		turn out not to be an integer, so it still raises
+
+		>>> str(band(x, Value(-1, 10)).simplify()), str(band(x, Value(0, 10)).simplify())
+		('(x & -1)', '(x & 0)')
+		>>> str(band(bor(x, y), Value(-1, 10)).simplify())
+		'(x | y)'
+		"""
+		if not self._commutative:
+			return super(NaryFunction, self)._rewrite(selfArgs, budget)
+
+		# Simplified chains keep their one constant last, gather every term
+		# and fold the constants together
+		terms = []
+		for arg in selfArgs:
+			if type(arg) is type(self):
+				terms.extend(arg.get_terms())
+			else:
+				terms.append(arg)
+		constants = [term for term in terms if isinstance(term, Value)]
+		symbolics = [term for term in terms if not isinstance(term, Value)]
+		if not constants:
+			return self._rebuild(selfArgs)
+
+		if len(constants) == 1:
+			constant = constants[0]
+		else:
+			values = [c.value for c in constants]
+			if budget is not None and not budget.allows(self, values):
+				return self._rebuild(selfArgs)
+			constant = Value(self._fold(values), constants[0].base)
+
+		if not isinstance(constant.value, (int, long)) or (
+			self._integral and not all(_is_integral(term) for term in symbolics)
+		):
+			return self._rebuild(symbolics + [constant])
+		if self._absorbing is not None and constant.value == self._absorbing:
+			return constant
+		if self._identity is not None and constant.value == self._identity:
+			if len(symbolics) == 1:
+				return symbolics[0]
+			return self._rebuild(symbolics)
+		return self._rebuild(symbolics + [constant])
+
+
+def _is_integral(node):
+	"""
+	@returns whether node is known to give an integer, when it gives anything
+	"""
+	if isinstance(node, Value):
+		return isinstance(node.value, (int, long))
+	return isinstance(node, Function) and node._integral
+
+
+def generate_function(op, rep, style, numArgs, ufunc = None,
+	commutative = False,
+	associative = False,
+	identity = None,
+	absorbing = None,
+	involution = False,
+	integral = False,
+	bulk = None,
+	estimate = None,
+	cost = None,
+	ints = None,
+	floats = None,
+	complexes = None,
+	arrays = None,
+):
+	"""
+	@param op function taking the argument values, used for the types
+		without an implementation of their own
+	@param ufunc name of the numpy ufunc equivalent to op, used for array
+		evaluation (otherwise op is tried on the arrays and then applied
+		element by element)
+	@param identity value that leaves the other argument unchanged (x+0)
+	@param absorbing value that the result collapses to (x*0)
+	@param involution whether applying op twice cancels out (- - x)
+	@param integral whether op only takes integers, identity and absorbing
+		then only apply next to arguments known to be integers, and an
+		involution only cancels around one
+	@param bulk function applying op across a whole sequence of values at
+		once, for associative operators
+	@param estimate function guessing the bit length of the result from the
+		argument values, for operators whose results can grow far beyond
+		their arguments
+	@param cost function guessing the work of computing the result from the
+		argument values, see Function.estimate_cost, for operators whose work
+		grows faster than their result
+	@param ints, floats, complexes implementations for when the widest
+		argument is of that type, ints default to the float one
+	@param arrays implementation for numpy arrays, used before ufunc
+
+	Associative operators become NaryFunctions and, when also commutative,
+	get their constant arguments folded together when simplifying partially
+	symbolic trees
+
+	>>> import cmath
+	>>> sin = generate_function(math.sin, "sin", Function.REP_FUNCTION, 1, complexes=cmath.sin)
+	>>> sin(Value(0, 10)).evaluate(), sin(Value(0j, 10)).evaluate()
+	(0.0, 0j)
+	"""
+	baseClass = NaryFunction if associative else Function
+	typedOp = _typed_op(op, numArgs, ints, floats, complexes)
+
+	class GenFunc(baseClass):
 
 		def __init__(self, *args, **kwd):
 			super(GenFunc, self).__init__(*args, **kwd)
 
-		_op = op
+		_op = staticmethod(typedOp)
+		_array_op = staticmethod(arrays) if arrays is not None else None
+		_ufunc = ufunc
+		_commutative = commutative
+		_associative = associative
+		_identity = identity
+		_absorbing = absorbing
+		_involution = involution
+		_integral = integral
+		_bulk = staticmethod(bulk) if bulk is not None else None
+		_estimate = staticmethod(estimate) if estimate is not None else None
+		_cost = staticmethod(cost) if cost is not None else None
 		_rep = style
 		symbol = rep
 		argumentCount = numArgs
@@ -376,6 +1031,237 @@ def generate_function(op, rep, style, numArgs):
 	return GenFunc
 
 
+def _typed_op(op, numArgs, ints, floats, complexes):
+	"""
+	@returns op when no type has an implementation of its own, otherwise a
+		function picking the implementation for its argument types from a
+		table built once, here
+	"""
+	if ints is None and floats is None and complexes is None:
+		return op
+
+	# By rank, the widest argument decides
+	ranked = [
+		((int, long, bool), ints if ints is not None else floats),
+		((float, ), floats),
+		((complex, ), complexes),
+	]
+	signatures = [((), 0)]
+	for i in xrange(numArgs):
+		signatures = [
+			(types + (t, ), max(rank, argRank))
+			for (types, rank) in signatures
+			for (argRank, (argTypes, impl)) in enumerate(ranked)
+			for t in argTypes
+		]
+	table = {}
+	for types, rank in signatures:
+		impl = ranked[rank][1]
+		if impl is not None:
+			table[types[0] if numArgs == 1 else types] = impl
+	lookup = table.get
+
+	if numArgs == 1:
+		def typed_op(x):
+			return lookup(type(x), op)(x)
+	elif numArgs == 2:
+		def typed_op(x, y):
+			return lookup((type(x), type(y)), op)(x, y)
+	else:
+		def typed_op(*args):
+			return lookup(tuple(map(type, args)), op)(*args)
+	typed_op.__name__ = op.__name__
+	typed_op.__doc__ = op.__doc__
+	return typed_op
+
+
+# Multiplying to a result this size takes about as long as handing the
+# work to another thread or process
+EXPENSIVE_BITS = 1 << 19
+
+
+class OverBudget(Exception):
+	pass
+
+
+class Budget(object):
+	"""
+	Limits on a single simplification, operations that would go over them
+	are left symbolic rather than computed
+
+	>>> import operator
+	>>> power = generate_function(operator.pow, "**", Function.REP_INFIX, 2, estimate=lambda b, e: e * b.bit_length())
+	>>> nine = Value(9, 10)
+	>>> str(power(nine, power(nine, nine)).simplify())
+	'(9 ** 387420489)'
+
+	What was left symbolic is tried again by later simplifications, a
+	bigger budget gets further
+
+	>>> big = power(nine, Value(100, 10))
+	>>> set_budget(Budget(maxBits = 64))
+	>>> str(big.simplify())
+	'(9 ** 100)'
+	>>> set_budget(Budget(maxBits = MAX_BITS))
+	>>> big.simplify().value == 9 ** 100
+	True
+	"""
+
+	def __init__(self, maxBits = None, maxSeconds = None, maxNodes = None):
+		"""
+		@param maxBits largest estimated result to compute, in bits
+		@param maxSeconds wall time to spend computing
+		@param maxNodes how many operations to compute
+		"""
+		self.maxBits = maxBits
+		self.maxSeconds = maxSeconds
+		self.maxNodes = maxNodes
+
+	def start(self):
+		return _BudgetRun(self)
+
+
+class _BudgetRun(object):
+
+	def __init__(self, budget):
+		self._maxBits = budget.maxBits
+		self._nodesLeft = budget.maxNodes
+		if budget.maxSeconds is not None:
+			self._deadline = time.time() + budget.maxSeconds
+		else:
+			self._deadline = None
+		# ids of the nodes left symbolic by this run, and of everything above
+		# them
+		self._stopped = set()
+
+	def allows(self, node, args):
+		if self._nodesLeft is not None:
+			if self._nodesLeft <= 0:
+				return self.stop(node)
+			self._nodesLeft -= 1
+		if self._deadline is not None and self._deadline <= time.time():
+			return self.stop(node)
+		if self._maxBits is not None and node._estimate is not None:
+			estimate = node.estimate_bits(args)
+			if estimate is not None and self._maxBits < estimate:
+				return self.stop(node)
+		return True
+
+	def stop(self, node):
+		"""
+		Remember node was left symbolic for going over the budget
+		"""
+		self._stopped.add(id(node))
+		return False
+
+	def stopped_under(self, node):
+		"""
+		@returns whether node, or anything below it, was left symbolic for
+			going over the budget
+		"""
+		stopped = self._stopped
+		if not stopped:
+			return False
+		if id(node) in stopped or any(id(arg) in stopped for arg in node._args):
+			stopped.add(id(node))
+			return True
+		return False
+
+	def time_left(self):
+		if self._deadline is None:
+			return None
+		return max(self._deadline - time.time(), 0)
+
+
+MAX_BITS = 1 << 24
+
+
+_budget = Budget(maxBits = MAX_BITS)
+
+
+def set_budget(budget):
+	"""
+	@param budget the Budget every simplification gets, None for no limits
+	"""
+	global _budget
+	_budget = budget
+
+
+_offload = None
+
+
+def set_offload(backend, bits = EXPENSIVE_BITS):
+	"""
+	@param backend something with apply(func, args, timeout), like
+		offload.ProcessBackend, taking over operator calls whose results are
+		estimated to be over bits.  Running out of time raises OverBudget.
+		None keeps every call in process.
+	"""
+	global _offload
+	if backend is None:
+		_offload = None
+	else:
+		_offload = backend, bits
+
+
+_recorder = None
+
+
+def set_recorder(recorder):
+	"""
+	@param recorder something with record(stage, key, seconds), like
+		instrumentation.Recorder, told how long each function node took to
+		simplify, keyed by its symbol.  None to stop timing.
+	"""
+	global _recorder
+	_recorder = recorder
+
+
+def is_expensive(node, bits = EXPENSIVE_BITS):
+	"""
+	Guess, without computing anything, whether simplifying node takes long
+	enough to be worth doing in the background
+
+	An argument that isn't simplified yet counts as expensive, nodes get
+	simplified as they are pushed so it is most likely still being worked
+	out.
+
+	>>> import operator
+	>>> power = generate_function(operator.pow, "**", Function.REP_INFIX, 2, estimate=lambda b, e: e * b.bit_length())
+	>>> is_expensive(power(Value(3, 10), Value(10, 10)))
+	False
+	>>> is_expensive(power(Value(3, 10), Value(1000000, 10)))
+	True
+	>>> is_expensive(power(power(Value(3, 10), Value(1000000, 10)), Value(2, 10)))
+	True
+	>>> is_expensive(power(Variable("x"), Value(1000000, 10)))
+	False
+	"""
+	if not isinstance(node, Function) or node._simple is not None:
+		return False
+
+	simpleArgs = []
+	for arg in node._args:
+		if isinstance(arg, Function):
+			if arg._simple is None:
+				return True
+			arg = arg._simple
+			if isinstance(arg, Function):
+				return False
+		simpleArgs.append(arg)
+	if node._estimate is None and node._cost is None:
+		# Most operators can't grow their results, skip evaluating the
+		# arguments for them
+		return False
+
+	try:
+		args = [arg.evaluate() for arg in simpleArgs]
+	except KeyError:
+		return False
+	cost = node.estimate_cost(args)
+	return cost is not None and bits < cost
+
+
 def change_base(base, rep):
 
 	class GenFunc(Function):
@@ -383,10 +1269,8 @@ def change_base(base, rep):
 		def __init__(self, *args, **kwd):
 			super(GenFunc, self).__init__(*args, **kwd)
 			self._base = base
-			self._simple = self._simplify()
-			self._str = self.pretty_print(args, kwd)
 
-		_op = lambda self, n: n
+		_op = staticmethod(lambda n: n)
 		_rep = Function.REP_FUNCTION
 		symbol = rep
 		argumentCount = 1
@@ -395,6 +1279,137 @@ def change_base(base, rep):
 	return GenFunc
 
 
+def _value_key(value, base):
+	key = (Value, type(value), value, base)
+	if isinstance(value, float):
+		# Keep 0.0 and -0.0 apart as they render differently
+		key += (math.copysign(1.0, value), )
+	elif isinstance(value, complex):
+		key += (math.copysign(1.0, value.real), math.copysign(1.0, value.imag))
+	return key
+
+
+# Values up to this size hash and compute as fast as they are looked up
+SMALL_VALUE_BITS = 64
+
+
+def _is_small_value(node):
+	if type(node) is not Value:
+		return False
+	value = node.value
+	return not isinstance(value, (int, long)) or value.bit_length() <= SMALL_VALUE_BITS
+
+
+class NodeInterner(object):
+	"""
+	Hash-conses operation nodes so structurally identical subexpressions
+	share one instance, and with it their cached simplification
+
+	Nodes are keyed by their class plus either their value or the identity of
+	their (already interned) children, so a key is built and hashed in time
+	proportional to the node's arity rather than the size of its subtree.
+	Nodes are held weakly and drop out once nothing else uses them.  A
+	function of nothing but small values is left to be interned until
+	something is built on it.
+
+	>>> import operator
+	>>> add = generate_function(operator.add, "+", Function.REP_INFIX, 2)
+	>>> interner = NodeInterner()
+	>>> x = interner.variable("x")
+	>>> first = interner.function(add, x, interner.value(1, 10))
+	>>> second = interner.function(add, interner.variable("x"), interner.value(1, 10))
+	>>> first is second
+	True
+	>>> interner.intern(add(Variable("x"), Value(1, 10))) is first
+	True
+	>>> interner.value(1, 16) is interner.value(1, 10)
+	False
+	>>> onePlusOne = interner.function(add, interner.value(1, 10), interner.value(1, 10))
+	>>> interner.is_interned(onePlusOne)
+	False
+	>>> interner.function(add, onePlusOne, x).get_children()[0] is onePlusOne
+	True
+	>>> interner.is_interned(onePlusOne)
+	True
+	"""
+
+	def __init__(self):
+		self._nodes = weakref.WeakValueDictionary()
+
+	def __len__(self):
+		return len(self._nodes)
+
+	def value(self, value, base):
+		return self._lookup(_value_key(value, base), Value, value, base)
+
+	def variable(self, name):
+		return self._lookup((Variable, name), Variable, name)
+
+	def function(self, Node, *args):
+		for arg in args:
+			if not _is_small_value(arg):
+				break
+		else:
+			# Working these out again is cheaper than looking them up, they get
+			# interned once something is built on them
+			return Node(*args)
+		args = [arg if arg._interner is self else self.intern(arg) for arg in args]
+		key = (Node, ) + tuple(map(id, args))
+		return self._lookup(key, Node, *args)
+
+	def is_interned(self, node):
+		# A registered node stays in _nodes for as long as it is alive
+		return node._interner is self
+
+	def intern(self, root):
+		"""
+		@returns the shared instance structurally identical to root
+		"""
+		if self.is_interned(root):
+			return root
+
+		return fold_tree(root, self._intern_node, self._interned_node, _construction_args)
+
+	def _interned_node(self, node):
+		return node if self.is_interned(node) else None
+
+	def _intern_node(self, node, args):
+		if isinstance(node, Function):
+			key = (type(node), ) + tuple(id(arg) for arg in args)
+			canonicalNode = self._nodes.get(key)
+			if canonicalNode is None:
+				if all(arg is orig for (arg, orig) in zip(args, node._args)):
+					canonicalNode = self._register(key, node)
+				else:
+					canonicalNode = self._lookup(key, type(node), *args)
+		elif isinstance(node, Value):
+			canonicalNode = self._intern_existing(_value_key(node.value, node.base), node)
+		elif isinstance(node, Variable):
+			canonicalNode = self._intern_existing((Variable, node.name), node)
+		elif isinstance(node, Constant):
+			canonicalNode = self._intern_existing((Constant, node.name), node)
+		else:
+			canonicalNode = node
+		return canonicalNode
+
+	def _intern_existing(self, key, node):
+		canonicalNode = self._nodes.get(key)
+		if canonicalNode is None:
+			canonicalNode = self._register(key, node)
+		return canonicalNode
+
+	def _lookup(self, key, factory, *args):
+		node = self._nodes.get(key)
+		if node is None:
+			node = self._register(key, factory(*args))
+		return node
+
+	def _register(self, key, node):
+		node._interner = self
+		self._nodes[key] = node
+		return node
+
+
 @overloading.overloaded
 def render_operation(render_func, operation):
 	return str(operation)
@@ -413,8 +1428,479 @@ def render_variable(render_func, operation):
 
 @render_operation.register(overloading.AnyType, Function)
 def render_function(render_func, operation):
-	args = [
-		render_operation(render_func, arg)
-		for arg in operation.get_children()
-	]
-	return operation.pretty_print(args)
+	return _flatten_text(operation, lambda node: render_operation(render_func, node))
+
+
+class RenderCache(object):
+	"""
+	Remembers the text of each node, on the node, so rendering a tree only
+	renders the nodes that are new and reuses the text of the subtrees it was
+	built from
+
+	Texts are tagged with the cache they came from, call invalidate() when
+	the renderer starts showing numbers differently.  Functions whose text
+	is longer than MAX_JOINED_LENGTH keep a rope of their pieces instead,
+	pointing at their children's texts, so a deep chain doesn't hold a copy
+	of its text at every level and a new parent still only renders itself.
+	The rope of a node rendered on its own is joined once and then kept
+	joined.
+
+	>>> import operator
+	>>> add = generate_function(operator.add, "+", Function.REP_INFIX, 2)
+	>>> cache = RenderCache(render_number())
+	>>> x = add(Variable("x"), Value(255, 16))
+	>>> cache.render(x)
+	'(x + 0xff)'
+	>>> cache.hits, cache.misses
+	(0, 3)
+	>>> cache.render(add(x, Value(2, 10)))
+	'((x + 0xff) + 2)'
+	>>> cache.hits, cache.misses
+	(1, 5)
+	>>> cache.invalidate()
+	>>> cache.render(x)
+	'(x + 0xff)'
+	>>> cache.hits, cache.misses
+	(1, 8)
+	>>> chain = Variable("x")
+	>>> for i in xrange(1000):
+	... 	chain = add(chain, Value(2, 10))
+	>>> len(cache.render(chain))
+	6001
+	>>> hits, misses = cache.hits, cache.misses
+	>>> cache.render(add(chain, Value(3, 10)))[-10:]
+	' + 2) + 3)'
+	>>> cache.hits - hits, cache.misses - misses
+	(1, 2)
+	"""
+
+	MAX_JOINED_LENGTH = 4096
+
+	def __init__(self, renderer):
+		self._renderer = renderer
+		self._token = object()
+		# Only approximate when rendering from more than one thread
+		self.hits = 0
+		self.misses = 0
+
+	@property
+	def renderer(self):
+		return self._renderer
+
+	@property
+	def hit_rate(self):
+		lookups = self.hits + self.misses
+		return float(self.hits) / lookups if lookups else 0.0
+
+	def invalidate(self):
+		self._token = object()
+
+	def render(self, node):
+		token = self._token
+		renderer = self._renderer
+
+		def known(node):
+			rendered = node._rendered
+			if rendered is not None and rendered[0] is token:
+				self.hits += 1
+				return rendered[1]
+			return None
+
+		def combine(node, children):
+			self.misses += 1
+			if not isinstance(node, Function):
+				text = render_operation(renderer, node)
+				node._rendered = (token, text)
+				return text
+
+			kwds = dict(
+				(key, render_operation(renderer, value))
+				for (key, value) in node._kwd.iteritems()
+			)
+			parts = node.layout(children, kwds)
+			length = sum(
+				len(part) if isinstance(part, basestring) else part.length
+				for part in parts
+			)
+			if length <= self.MAX_JOINED_LENGTH:
+				# Nothing this short has a rope among its pieces
+				text = "".join(parts)
+			else:
+				text = _Rope(parts)
+				text.length = length
+			node._rendered = (token, text)
+			return text
+
+		text = fold_tree(node, combine, known, _render_children)
+		if not isinstance(text, basestring):
+			rope = text
+			text = "".join(_iter_rope(rope))
+			# So a parent takes it as one piece instead of walking the rope
+			rendered = node._rendered
+			if rendered is not None and rendered[1] is rope:
+				node._rendered = (rendered[0], text)
+		return text
+
+
+# Deeper than this fold_tree stops recursing and walks the rest of the
+# subtree with an explicit stack
+FOLD_RECURSION_LIMIT = 200
+
+
+class _Rope(list):
+	"""
+	Pieces of a text too long to copy into every parent, with the length of
+	the text they join to
+	"""
+
+	__slots__ = ("length", )
+
+
+def _render_children(node):
+	if isinstance(node, NaryFunction) and node._rep == Function.REP_INFIX:
+		# Absorbed chains print like the left-deep chain they stand for, so
+		# the absorbed node's text can be reused as is
+		return node._args
+	return node.get_terms()
+
+
+def _flatten_text(root, render_leaf, depthLeft = FOLD_RECURSION_LIMIT):
+	"""
+	Build the text of a tree from the layouts of its functions
+
+	Shallow trees join their children's texts directly.  Past
+	FOLD_RECURSION_LIMIT each node contributes a rope of its own pieces with
+	its children's ropes left in place, so the text is built once, in time
+	linear to its length.  Nothing is kept on the nodes afterwards.
+	"""
+	if not isinstance(root, Function):
+		return render_leaf(root)
+	if depthLeft:
+		depthLeft -= 1
+		children = [
+			_flatten_text(child, render_leaf, depthLeft)
+			for child in root.get_terms()
+		]
+		kwds = {}
+		for (key, value) in root._kwd.iteritems():
+			kwds[key] = render_leaf(value)
+		return "".join(root.layout(children, kwds))
+
+	def combine(node, children):
+		if isinstance(node, Function):
+			kwds = dict(
+				(key, render_leaf(value))
+				for (key, value) in node._kwd.iteritems()
+			)
+			return node.layout(children, kwds)
+		return render_leaf(node)
+
+	return "".join(_iter_rope(fold_tree(root, combine)))
+
+
+def fold_tree(root, combine, known = None, children = None):
+	"""
+	Fold a tree bottom up, recursing for the shallow trees most expressions
+	are and switching to an explicit stack past FOLD_RECURSION_LIMIT so depth
+	is only limited by memory
+
+	@param combine called once per distinct node, after its children, as
+		combine(node, childResults) and returns the node's result
+	@param known optional function returning a result already known for a
+		node, or None, so the node's subtree isn't walked
+	@param children optional function giving the nodes to fold into a node,
+		defaults to its get_terms()
+	@returns the result for root
+
+	>>> import operator
+	>>> add = generate_function(operator.add, "+", Function.REP_INFIX, 2)
+	>>> leaf = Value(1, 10)
+	>>> chain = leaf
+	>>> for i in xrange(100000):
+	... 	chain = add(chain, leaf)
+	>>> fold_tree(chain, lambda node, children: 1 + sum(children))
+	200001
+	>>> chain.evaluate()
+	100001
+	>>> combined = []
+	>>> shared = add(leaf, leaf)
+	>>> fold_tree(add(shared, shared), lambda node, children: combined.append(node) or 1 + sum(children))
+	7
+	>>> len(combined)
+	3
+	"""
+	if children is None:
+		children = _get_terms
+	results = {}
+
+	def fold(node, depthLeft):
+		nodeId = id(node)
+		if nodeId in results:
+			return results[nodeId]
+		if not depthLeft:
+			return _fold_stack(node, combine, known, children, results)
+
+		if known is not None:
+			result = known(node)
+			if result is not None:
+				results[nodeId] = result
+				return result
+
+		depthLeft -= 1
+		childResults = [fold(child, depthLeft) for child in children(node)]
+		result = results[nodeId] = combine(node, childResults)
+		return result
+
+	return fold(root, FOLD_RECURSION_LIMIT)
+
+
+def _fold_stack(root, combine, known, children, results):
+	"""
+	fold_tree's walk for deep subtrees, filling in results as it goes
+	"""
+	pending = [(root, False)]
+	while pending:
+		node, isExpanded = pending.pop()
+		nodeId = id(node)
+		if nodeId in results:
+			continue
+
+		if isExpanded:
+			childResults = [results[id(child)] for child in children(node)]
+			results[nodeId] = combine(node, childResults)
+			continue
+
+		if known is not None:
+			result = known(node)
+			if result is not None:
+				results[nodeId] = result
+				continue
+
+		pending.append((node, True))
+		nodeChildren = list(children(node))
+		nodeChildren.reverse()
+		pending.extend((child, False) for child in nodeChildren)
+	return results[id(root)]
+
+
+def _iter_rope(rope):
+	"""
+	Walk a rope (a string or a list of ropes) without recursing
+
+	>>> list(_iter_rope(["a", ["b", ["c"]], [], "d"]))
+	['a', 'b', 'c', 'd']
+	"""
+	pending = [rope]
+	while pending:
+		item = pending.pop()
+		if isinstance(item, basestring):
+			yield item
+		else:
+			pending.extend(reversed(item))
+
+
+def _get_terms(node):
+	return node.get_terms()
+
+
+def _evaluate_node(node, args):
+	if isinstance(node, Function):
+		return node._apply(args)
+	return node.evaluate()
+
+
+def _construction_args(node):
+	if isinstance(node, Function):
+		return node._args
+	return node.get_children()
+
+
+def _known_simplification(node):
+	if isinstance(node, Function):
+		return node._simple
+	return node.simplify()
+
+
+def _simplify_node(budget, node, args):
+	simple = node._simplify(args, budget)
+	if budget is not None and budget.stopped_under(node):
+		# Only as far as this budget got, a later one may get further
+		if isinstance(simple, Function) and simple._simple is simple:
+			simple._simple = None
+		return simple
+	node._simple = simple
+	return simple
+
+
+def _simplify_node_timed(recorder, budget, node, args):
+	# The children are already simplified, only this node's own work counts
+	start = time.time()
+	try:
+		return _simplify_node(budget, node, args)
+	finally:
+		if isinstance(node, Function):
+			recorder.record("simplify", node.symbol, time.time() - start)
+
+
+class _CodeGenerator(object):
+
+	def __init__(self):
+		self.namespace = {}
+		self.parameters = {}
+		self.variables = []
+		self.statements = []
+		self._emitted = {}
+
+	def bind(self, prefix, obj):
+		name = "_%s%d" % (prefix, len(self.namespace))
+		self.namespace[name] = obj
+		return name
+
+	def emit(self, root):
+		"""
+		@returns the name holding the value of root, generating the code to
+			compute it and any of its children that haven't been seen yet
+		"""
+		return fold_tree(root, self._emit_node, self._emitted_name)
+
+	def _emit_node(self, node, args):
+		name = _emit_operation(self, node, args)
+		self._emitted[id(node)] = name
+		return name
+
+	def _emitted_name(self, node):
+		return self._emitted.get(id(node))
+
+	def add_variable(self, variableName):
+		name = self.parameters.get(variableName)
+		if name is None:
+			name = "_v%d" % len(self.variables)
+			self.parameters[variableName] = name
+			self.variables.append(variableName)
+		return name
+
+	def add_statement(self, expression):
+		name = "_t%d" % len(self.statements)
+		self.statements.append("\t%s = %s" % (name, expression))
+		return name
+
+	def generate(self, result):
+		parameters = (self.parameters[variableName] for variableName in self.variables)
+		lines = ["def compiled_operation(%s):" % ", ".join(parameters)]
+		lines.extend(self.statements)
+		lines.append("\treturn %s" % result)
+		return "\n".join(lines)
+
+
+@overloading.overloaded
+def _emit_operation(generator, operation, args):
+	return generator.add_statement("%s()" % generator.bind("e", operation.evaluate))
+
+
+@_emit_operation.register(overloading.AnyType, Value, overloading.AnyType)
+@_emit_operation.register(overloading.AnyType, Constant, overloading.AnyType)
+def _emit_value(generator, operation, args):
+	return generator.bind("c", operation.evaluate())
+
+
+@_emit_operation.register(overloading.AnyType, Variable, overloading.AnyType)
+def _emit_variable(generator, operation, args):
+	return generator.add_variable(operation.name)
+
+
+@_emit_operation.register(overloading.AnyType, Function, overloading.AnyType)
+def _emit_function(generator, operation, args):
+	op = generator.bind("op", operation._op)
+	return generator.add_statement("%s(%s)" % (op, ", ".join(args)))
+
+
+@_emit_operation.register(overloading.AnyType, NaryFunction, overloading.AnyType)
+def _emit_nary_function(generator, operation, args):
+	fold = generator.bind("op", operation._fold)
+	return generator.add_statement("%s((%s, ))" % (fold, ", ".join(args)))
+
+
+def compile_operation(operation):
+	"""
+	Lower an operation tree into a single generated function so repeated
+	evaluations skip the tree walk and the intermediate nodes
+
+	>>> import operator
+	>>> add = generate_function(operator.add, "+", Function.REP_INFIX, 2)
+	>>> mul = generate_function(operator.mul, "*", Function.REP_INFIX, 2)
+	>>> x = Variable("x")
+	>>> compiled = mul(add(x, Value(2, 10)), Variable("x")).compile()
+	>>> compiled.variables
+	('x',)
+	>>> compiled(3)
+	15
+	>>> add(Value(2, 10), Value(3, 10)).compile()()
+	5
+	"""
+	generator = _CodeGenerator()
+	result = generator.emit(operation)
+	source = generator.generate(result)
+
+	code = compile(source, "<compiled %s>" % operation.__class__.__name__, "exec")
+	exec code in generator.namespace
+	compiled = generator.namespace["compiled_operation"]
+	compiled.variables = tuple(generator.variables)
+	return compiled
+
+
+def evaluate_array(operation, variables):
+	"""
+	Evaluate an operation tree element-wise over arrays of variable values
+
+	Operators with a ufunc follow numpy's rules rather than their scalar
+	implementation's:
+	- results outside the reals, like sqrt or log of a negative number or
+		arccosh below 1, are nan rather than complex or a ValueError
+	- dividing by zero gives inf or nan, and 0 for integer // and %,
+		rather than raising ZeroDivisionError
+	- integers are fixed width and wrap around rather than growing
+	numpy warns about these instead of raising, see numpy.errstate.
+	Operators without a ufunc are applied to the arrays as they are, or
+	element by element when that fails.
+	"""
+	if numpy is None:
+		raise RuntimeError("numpy is required for evaluating over arrays")
+
+	def combine(node, args):
+		if isinstance(node, Function):
+			return node._apply_array(args)
+		elif isinstance(node, Variable):
+			return numpy.asarray(variables[node.name])
+		else:
+			return node.evaluate()
+
+	return fold_tree(operation, combine)
+
+
+if numpy is not None:
+	__test__ = {
+		"evaluate_array": """
+		>>> import operator
+		>>> add = generate_function(operator.add, "+", Function.REP_INFIX, 2, ufunc="add")
+		>>> sqrt = generate_function(lambda x: x ** 0.5, "sqrt", Function.REP_FUNCTION, 1, ufunc="sqrt")
+		>>> import cmath
+		>>> acosh = generate_function(cmath.acosh, "acosh", Function.REP_FUNCTION, 1, ufunc="arccosh")
+		>>> factorial = generate_function(math.factorial, "!", Function.REP_POSTFIX, 1)
+		>>> x, y = Variable("x"), Variable("y")
+		>>> add(x, y).evaluate_array({"x": [1, 2, 3], "y": 10}).tolist()
+		[11, 12, 13]
+		>>> factorial(add(x, Value(1, 10))).evaluate_array({"x": [2, 3]}).tolist()
+		[6, 24]
+		>>> with numpy.errstate(invalid="ignore"):
+		... 	sqrt(x).evaluate_array({"x": [4.0, -1.0]}).tolist()
+		[2.0, nan]
+		>>> sqrt(Value(-1.0, 10)).evaluate()
+		Traceback (most recent call last):
+		ValueError: negative number cannot be raised to a fractional power
+		>>> type(acosh(Value(0.5, 10)).evaluate())
+		<type 'complex'>
+		>>> with numpy.errstate(invalid="ignore"):
+		... 	acosh(x).evaluate_array({"x": [0.5]}).tolist()
+		[nan]
+		""",
+	}
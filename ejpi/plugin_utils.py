@@ -9,7 +9,6 @@ import os
 import inspect
 import ConfigParser
 
-from util import qtpieboard
 from util import io
 import operation
 
@@ -26,6 +25,40 @@ class CommandStackHandler(object):
 		self.__stack.apply_operation(self.__operator)
 
 
+class CommandStackReduceHandler(object):
+	"""
+	Combines the whole stack with a binary operator, or with Shift held as
+	many items as the top of the stack says
+	"""
+
+	def __init__(self, stack, command, operator):
+		self.command = command
+
+		self.__stack = stack
+		self.__operator = operator
+
+	def handler(self, commandName, activeModifiers):
+		countOnStack = "Shift" in activeModifiers
+		self.__stack.apply_reduction(self.__operator, countOnStack=countOnStack)
+
+
+class CommandStackMapHandler(object):
+	"""
+	Applies a unary operator to every item on the stack, or with Shift held
+	to as many items as the top of the stack says
+	"""
+
+	def __init__(self, stack, command, operator):
+		self.command = command
+
+		self.__stack = stack
+		self.__operator = operator
+
+	def handler(self, commandName, activeModifiers):
+		countOnStack = "Shift" in activeModifiers
+		self.__stack.apply_map(self.__operator, countOnStack=countOnStack)
+
+
 class PieKeyboardPlugin(object):
 
 	def __init__(self, name, factory):
@@ -34,6 +67,9 @@ class PieKeyboardPlugin(object):
 		self.__handler = None
 
 	def setup(self, calcStack, boardHandler):
+		# Only keyboards need Qt, plugins are also loaded headless
+		from util import qtpieboard
+
 		self.__handler = boardHandler
 
 		boardTree = self.factory.map
@@ -47,12 +83,19 @@ class PieKeyboardPlugin(object):
 		for commandName, operator in self.factory.commands.iteritems():
 			handler = CommandStackHandler(calcStack, commandName, operator)
 			self.__handler.register_command_handler(commandName, handler.handler)
+		for commandName, operator in self.factory.reductions.iteritems():
+			handler = CommandStackReduceHandler(calcStack, commandName, operator)
+			self.__handler.register_command_handler(commandName, handler.handler)
+		for commandName, operator in self.factory.maps.iteritems():
+			handler = CommandStackMapHandler(calcStack, commandName, operator)
+			self.__handler.register_command_handler(commandName, handler.handler)
 
 		return keyboard
 
 	def tear_down(self):
-		for commandName, operator in self.factory.commands.itervalues():
-			self.__handler.unregister_command_handler(commandName)
+		for commands in (self.factory.commands, self.factory.reductions, self.factory.maps):
+			for commandName in commands.iterkeys():
+				self.__handler.unregister_command_handler(commandName)
 
 		# Leave our self completely unusable
 		self.name = None
@@ -66,12 +109,20 @@ class PieKeyboardPluginFactory(object):
 		self.name = pluginName
 		self.map = keyboardMap
 		self.commands = {}
+		self.reductions = {}
+		self.maps = {}
 		self.icon = icon
 		self.iconPaths = iconPaths
 
 	def register_operation(self, commandName, operator):
 		self.commands[commandName] = operator
 
+	def register_reduction(self, commandName, operator):
+		self.reductions[commandName] = operator
+
+	def register_map(self, commandName, operator):
+		self.maps[commandName] = operator
+
 	def construct_keyboard(self):
 		plugin = PieKeyboardPlugin(self.name, self)
 		return plugin
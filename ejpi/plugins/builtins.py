@@ -15,6 +15,7 @@ _MAP = {
 	"keys": {
 		(0, 0): {
 			"CENTER": {"action": "7", "type": "text", "text": "7", },
+			"SOUTH": {"action": "[sum]", "type": "text", "text": "sum", },
 			"showAllSlices": True,
 		},
 		(0, 1): {
@@ -26,10 +27,12 @@ _MAP = {
 		},
 		(0, 2): {
 			"CENTER": {"action": "9", "type": "text", "text": "9", },
+			"SOUTH": {"action": "[product]", "type": "text", "text": "prod", },
 			"showAllSlices": True,
 		},
 		(1, 0): {
 			"CENTER": {"action": "4", "type": "text", "text": "4", },
+			"EAST": {"action": "[map +-]", "type": "text", "text": "all +/-", },
 			"showAllSlices": True,
 		},
 		(1, 1): {
@@ -42,6 +45,7 @@ _MAP = {
 		},
 		(1, 2): {
 			"CENTER": {"action": "6", "type": "text", "text": "6", },
+			"WEST": {"action": "[map abs]", "type": "text", "text": "all abs", },
 			"showAllSlices": True,
 		},
 		(2, 0): {
@@ -67,29 +71,68 @@ _MAP = {
 _ICON_PATH = [os.path.join(os.path.dirname(__file__), "images")]
 PLUGIN = plugin_utils.PieKeyboardPluginFactory(_NAME, _ICON, _MAP, _ICON_PATH)
 
-addition = operation.generate_function(operator.add, "+", operation.Function.REP_INFIX, 2)
-subtraction = operation.generate_function(operator.sub, "-", operation.Function.REP_INFIX, 2)
-multiplication = operation.generate_function(operator.mul, "*", operation.Function.REP_INFIX, 2)
-trueDivision = operation.generate_function(operator.truediv, "/", operation.Function.REP_INFIX, 2)
+def _sum(values):
+	# Same left to right order as a chain of additions, in one C loop
+	return sum(values[1:], values[0])
+
+def _product_bits(*values):
+	if all(isinstance(value, (int, long)) for value in values):
+		return sum((-value if value < 0 else value).bit_length() for value in values)
+	return None
+
+addition = operation.generate_function(operator.add, "+", operation.Function.REP_INFIX, 2, ufunc="add", commutative=True, associative=True, identity=0, bulk=_sum)
+subtraction = operation.generate_function(operator.sub, "-", operation.Function.REP_INFIX, 2, ufunc="subtract")
+multiplication = operation.generate_function(operator.mul, "*", operation.Function.REP_INFIX, 2, ufunc="multiply", commutative=True, associative=True, identity=1, absorbing=0, estimate=_product_bits)
+trueDivision = operation.generate_function(operator.truediv, "/", operation.Function.REP_INFIX, 2, ufunc="true_divide")
 
 PLUGIN.register_operation("+", addition)
 PLUGIN.register_operation("-", subtraction)
 PLUGIN.register_operation("*", multiplication)
 PLUGIN.register_operation("/", trueDivision)
+PLUGIN.register_reduction("sum", addition)
+PLUGIN.register_reduction("product", multiplication)
+
+def _pow_bits(base, exponent):
+	"""
+	>>> _pow_bits(0, 10 ** 8), _pow_bits(1, 10 ** 8), _pow_bits(-1, 10 ** 8)
+	(0, 1, 1)
+	>>> _pow_bits(2, 1000) == (2 ** 1000).bit_length()
+	True
+	>>> 0 <= _pow_bits(3, 10 ** 5) - (3 ** 10 ** 5).bit_length() <= 1
+	True
+	"""
+	if isinstance(base, (int, long)) and isinstance(exponent, (int, long)) and 0 < exponent:
+		# Not abs(), that name is the operator below
+		magnitude = -base if base < 0 else base
+		if magnitude <= 1:
+			return magnitude
+		# exponent * log2(magnitude) + 1 in 32 bit fixed point, rounded up so
+		# it stays an upper bound, and without floats for huge exponents
+		scaledLog = int(math.log(magnitude, 2) * (1 << 32)) + 1
+		return min((exponent * scaledLog >> 32) + 1, exponent * magnitude.bit_length())
+	return None
 
-exponentiation = operation.generate_function(operator.pow, "**", operation.Function.REP_INFIX, 2)
-abs = operation.generate_function(operator.abs, "abs", operation.Function.REP_FUNCTION, 1)
+exponentiation = operation.generate_function(operator.pow, "**", operation.Function.REP_INFIX, 2, ufunc="power", estimate=_pow_bits)
+abs = operation.generate_function(operator.abs, "abs", operation.Function.REP_FUNCTION, 1, ufunc="absolute")
 try:
 	fact_func = math.factorial
 except AttributeError:
-	def fact_func(self, num):
+	def fact_func(num):
 		if num <= 0:
 			return 1
-		return num * fact_func(self, num - 1)
-factorial = operation.generate_function(fact_func, "!", operation.Function.REP_POSTFIX, 1)
-negate = operation.generate_function(operator.neg, "+-", operation.Function.REP_PREFIX, 1)
-square = operation.generate_function((lambda self, x: x ** 2), "sq", operation.Function.REP_FUNCTION, 1)
-square_root = operation.generate_function((lambda self, x: x ** 0.5), "sqrt", operation.Function.REP_FUNCTION, 1)
+		return num * fact_func(num - 1)
+def _factorial_bits(num):
+	if isinstance(num, (int, long)) and 0 < num:
+		return num * num.bit_length()
+	return None
+def _factorial_cost(num):
+	# Takes about as long as multiplying to a result 4 times its size
+	bits = _factorial_bits(num)
+	return 4 * bits if bits is not None else None
+factorial = operation.generate_function(fact_func, "!", operation.Function.REP_POSTFIX, 1, estimate=_factorial_bits, cost=_factorial_cost)
+negate = operation.generate_function(operator.neg, "+-", operation.Function.REP_PREFIX, 1, ufunc="negative", involution=True)
+square = operation.generate_function((lambda x: x ** 2), "sq", operation.Function.REP_FUNCTION, 1, ufunc="square")
+square_root = operation.generate_function((lambda x: x ** 0.5), "sqrt", operation.Function.REP_FUNCTION, 1, ufunc="sqrt")
 
 # @todo Possibly make a graphic for this of x^y
 PLUGIN.register_operation("**", exponentiation)
@@ -98,3 +141,5 @@ PLUGIN.register_operation("!", factorial)
 PLUGIN.register_operation("+-", negate)
 PLUGIN.register_operation("sq", square)
 PLUGIN.register_operation("sqrt", square_root)
+PLUGIN.register_map("map abs", abs)
+PLUGIN.register_map("map +-", negate)
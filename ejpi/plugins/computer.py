@@ -76,8 +76,8 @@ PLUGIN = plugin_utils.PieKeyboardPluginFactory(_NAME, _ICON, _MAP, _ICON_PATH)
 hex = operation.change_base(16, "hex")
 oct = operation.change_base(8, "oct")
 dec = operation.change_base(10, "dec")
-ceil = operation.generate_function(math.ceil, "ceil", operation.Function.REP_FUNCTION, 1)
-floor = operation.generate_function(math.floor, "floor", operation.Function.REP_FUNCTION, 1)
+ceil = operation.generate_function(math.ceil, "ceil", operation.Function.REP_FUNCTION, 1, ufunc="ceil")
+floor = operation.generate_function(math.floor, "floor", operation.Function.REP_FUNCTION, 1, ufunc="floor")
 
 PLUGIN.register_operation("hex", hex)
 PLUGIN.register_operation("oct", oct)
@@ -85,16 +85,16 @@ PLUGIN.register_operation("dec", dec)
 PLUGIN.register_operation("ceil", ceil)
 PLUGIN.register_operation("floor", floor)
 
-floorDivision = operation.generate_function(operator.floordiv, "//", operation.Function.REP_INFIX, 2)
-modulo = operation.generate_function(operator.mod, "%", operation.Function.REP_INFIX, 2)
+floorDivision = operation.generate_function(operator.floordiv, "//", operation.Function.REP_INFIX, 2, ufunc="floor_divide")
+modulo = operation.generate_function(operator.mod, "%", operation.Function.REP_INFIX, 2, ufunc="remainder")
 
 PLUGIN.register_operation("//", floorDivision)
 PLUGIN.register_operation("%", modulo)
 
-bitAnd = operation.generate_function(operator.and_, "&", operation.Function.REP_INFIX, 2)
-bitOr = operation.generate_function(operator.or_, "|", operation.Function.REP_INFIX, 2)
-bitXor = operation.generate_function(operator.xor, "^", operation.Function.REP_INFIX, 2)
-bitInvert = operation.generate_function(operator.invert, "~", operation.Function.REP_PREFIX, 1)
+bitAnd = operation.generate_function(operator.and_, "&", operation.Function.REP_INFIX, 2, ufunc="bitwise_and", commutative=True, associative=True, identity=-1, absorbing=0, integral=True)
+bitOr = operation.generate_function(operator.or_, "|", operation.Function.REP_INFIX, 2, ufunc="bitwise_or", commutative=True, associative=True, identity=0, absorbing=-1, integral=True)
+bitXor = operation.generate_function(operator.xor, "^", operation.Function.REP_INFIX, 2, ufunc="bitwise_xor", commutative=True, associative=True, identity=0, integral=True)
+bitInvert = operation.generate_function(operator.invert, "~", operation.Function.REP_PREFIX, 1, ufunc="invert", involution=True, integral=True)
 
 PLUGIN.register_operation("&", bitAnd)
 PLUGIN.register_operation("|", bitOr)
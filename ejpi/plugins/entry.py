@@ -15,6 +15,7 @@ _MAP = {
 			"NORTH": {"action": "[unpush]", "type": "text", "text": "Undo", },
 			"NORTH_WEST": {"action": "[clear]", "type": "image", "path": "clear.png", },
 			"WEST": {"action": "[backspace]", "type": "image", "path": "backspace.png", },
+			"SOUTH": {"action": "[cancel]", "type": "text", "text": "Stop", },
 			"showAllSlices": False,
 		},
 	},
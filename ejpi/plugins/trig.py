@@ -78,33 +78,18 @@ PLUGIN = plugin_utils.PieKeyboardPluginFactory(_NAME, _ICON, _MAP, _ICON_PATH)
 pi = operation.Constant("pi", operation.Value(math.pi, operation.render_float_eng))
 e = operation.Constant("e", operation.Value(math.e, operation.render_float_eng))
 
-def float_or_complex(float_func, complex_func):
-
-	def switching_func(self, *args, **kwd):
-		if any(
-			isinstance(arg, complex)
-			for arg in args
-		):
-			return complex_func(*args, **kwd)
-		else:
-			return float_func(*args, **kwd)
-
-	switching_func.__name__ = complex_func.__name__
-	switching_func.__doc__ = complex_func.__doc__
-	return switching_func
-
-exp = operation.generate_function(float_or_complex(math.exp, cmath.exp), "exp", operation.Function.REP_FUNCTION, 1)
-log = operation.generate_function(float_or_complex(math.log, cmath.log), "log", operation.Function.REP_FUNCTION, 1)
+exp = operation.generate_function(math.exp, "exp", operation.Function.REP_FUNCTION, 1, ufunc="exp", complexes=cmath.exp)
+log = operation.generate_function(math.log, "log", operation.Function.REP_FUNCTION, 1, ufunc="log", complexes=cmath.log)
 
 PLUGIN.register_operation("exp", exp)
 PLUGIN.register_operation("log", log)
 
-cos = operation.generate_function(float_or_complex(math.cos, cmath.cos), "cos", operation.Function.REP_FUNCTION, 1)
-acos = operation.generate_function(float_or_complex(math.acos, cmath.acos), "acos", operation.Function.REP_FUNCTION, 1)
-sin = operation.generate_function(float_or_complex(math.sin, cmath.sin), "sin", operation.Function.REP_FUNCTION, 1)
-asin = operation.generate_function(float_or_complex(math.asin, cmath.asin), "asin", operation.Function.REP_FUNCTION, 1)
-tan = operation.generate_function(float_or_complex(math.tan, cmath.tan), "tan", operation.Function.REP_FUNCTION, 1)
-atan = operation.generate_function(float_or_complex(math.atan, cmath.atan), "atan", operation.Function.REP_FUNCTION, 1)
+cos = operation.generate_function(math.cos, "cos", operation.Function.REP_FUNCTION, 1, ufunc="cos", complexes=cmath.cos)
+acos = operation.generate_function(math.acos, "acos", operation.Function.REP_FUNCTION, 1, ufunc="arccos", complexes=cmath.acos)
+sin = operation.generate_function(math.sin, "sin", operation.Function.REP_FUNCTION, 1, ufunc="sin", complexes=cmath.sin)
+asin = operation.generate_function(math.asin, "asin", operation.Function.REP_FUNCTION, 1, ufunc="arcsin", complexes=cmath.asin)
+tan = operation.generate_function(math.tan, "tan", operation.Function.REP_FUNCTION, 1, ufunc="tan", complexes=cmath.tan)
+atan = operation.generate_function(math.atan, "atan", operation.Function.REP_FUNCTION, 1, ufunc="arctan", complexes=cmath.atan)
 
 PLUGIN.register_operation("cos", cos)
 PLUGIN.register_operation("acos", acos)
@@ -113,12 +98,12 @@ PLUGIN.register_operation("asin", asin)
 PLUGIN.register_operation("tan", tan)
 PLUGIN.register_operation("atan", atan)
 
-cosh = operation.generate_function(float_or_complex(math.cosh, cmath.cosh), "cosh", operation.Function.REP_FUNCTION, 1)
-acosh = operation.generate_function(cmath.acosh, "acosh", operation.Function.REP_FUNCTION, 1)
-sinh = operation.generate_function(float_or_complex(math.sinh, cmath.sinh), "sinh", operation.Function.REP_FUNCTION, 1)
-asinh = operation.generate_function(cmath.asinh, "asinh", operation.Function.REP_FUNCTION, 1)
-tanh = operation.generate_function(float_or_complex(math.tanh, cmath.tanh), "tanh", operation.Function.REP_FUNCTION, 1)
-atanh = operation.generate_function(cmath.atanh, "atanh", operation.Function.REP_FUNCTION, 1)
+cosh = operation.generate_function(math.cosh, "cosh", operation.Function.REP_FUNCTION, 1, ufunc="cosh", complexes=cmath.cosh)
+acosh = operation.generate_function(cmath.acosh, "acosh", operation.Function.REP_FUNCTION, 1, ufunc="arccosh")
+sinh = operation.generate_function(math.sinh, "sinh", operation.Function.REP_FUNCTION, 1, ufunc="sinh", complexes=cmath.sinh)
+asinh = operation.generate_function(cmath.asinh, "asinh", operation.Function.REP_FUNCTION, 1, ufunc="arcsinh")
+tanh = operation.generate_function(math.tanh, "tanh", operation.Function.REP_FUNCTION, 1, ufunc="tanh", complexes=cmath.tanh)
+atanh = operation.generate_function(cmath.atanh, "atanh", operation.Function.REP_FUNCTION, 1, ufunc="arctanh")
 
 PLUGIN.register_operation("cosh", cosh)
 PLUGIN.register_operation("acosh", acosh)
@@ -127,8 +112,8 @@ PLUGIN.register_operation("asinh", asinh)
 PLUGIN.register_operation("tanh", tanh)
 PLUGIN.register_operation("atanh", atanh)
 
-deg = operation.generate_function(math.degrees, "deg", operation.Function.REP_FUNCTION, 1)
-rad = operation.generate_function(math.radians, "rad", operation.Function.REP_FUNCTION, 1)
+deg = operation.generate_function(math.degrees, "deg", operation.Function.REP_FUNCTION, 1, ufunc="degrees")
+rad = operation.generate_function(math.radians, "rad", operation.Function.REP_FUNCTION, 1, ufunc="radians")
 
 PLUGIN.register_operation("deg", deg)
 PLUGIN.register_operation("rad", rad)
@@ -7,16 +7,21 @@ http://helm.cs.unibo.it/mml-widget/ (MathML widget in C++)
 
 from __future__ import with_statement
 
+import functools
 import logging
+import contextlib
 
 import util.qt_compat as qt_compat
 QtCore = qt_compat.QtCore
 QtGui = qt_compat.import_module("QtGui")
 
 from util import qui_utils
+from util import qore_utils
 import util.misc as misc_utils
 import history
 import operation
+import instrumentation
+import journal
 
 
 _moduleLogger = logging.getLogger(__name__)
@@ -28,17 +33,28 @@ class QCalcHistory(history.AbstractHistory):
 	_EQ_COLUMN = 1
 	_RESULT_COLUMN = 2
 
-	def __init__(self, errorReporter):
+	_PENDING_TEXT = "..."
+
+	def __init__(self, errorReporter, backend = None, recorder = None, maxDigits = None):
+		"""
+		@param backend the offload backend to kill calculations on when their
+			row gets cancelled
+		@param recorder an instrumentation.Recorder to time pushes with, None
+			to not keep timings
+		@param maxDigits integers longer than this are shown as their first
+			and last digits, None (the default) shows every digit
+		"""
 		super(QCalcHistory, self).__init__()
-		self._prettyRenderer = operation.render_number()
+		self._prettyRenderer = operation.render_number(maxDigits = maxDigits)
+		self._renderCache = operation.RenderCache(self._prettyRenderer)
 		self._errorLog = errorReporter
 
-		self._historyStore = QtGui.QStandardItemModel()
-		self._historyStore.setHorizontalHeaderLabels(["", "Equation", "Result"])
-		self._historyStore.itemChanged.connect(self._on_item_changed)
+		self._closeIcon = qui_utils.get_theme_icon(("window-close", "general_close", "gtk-close"))
+		self._historyModel = _HistoryModel(self._closeIcon)
+		self._historyModel.equationEdited.connect(self._on_equation_edited)
 
 		self._historyView = QtGui.QTreeView()
-		self._historyView.setModel(self._historyStore)
+		self._historyView.setModel(self._historyModel)
 		self._historyView.setUniformRowHeights(True)
 		self._historyView.setRootIsDecorated(False)
 		self._historyView.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
@@ -56,71 +72,178 @@ class QCalcHistory(history.AbstractHistory):
 		viewHeader.setResizeMode(self._RESULT_COLUMN, QtGui.QHeaderView.ResizeToContents)
 		viewHeader.setStretchLastSection(False)
 
-		self._rowCount = 0
-		self._programmaticUpdate = False
-		self._closeIcon = qui_utils.get_theme_icon(("window-close", "general_close", "gtk-close"))
+		# Expensive results are worked out on a worker thread, keyed by an id
+		# kept on the row so removing the row drops the result
+		self._pendingRows = {}
+		self._nextPendingId = 0
+		self._runningId = None
+		# A popped row's result is left to finish for the next pending row,
+		# which most likely took its node, cancelling that row stops it
+		self._handedOverId = None
+		self._inheritedIds = {}
+		self._backend = backend
+		self._simplifier = qore_utils.FutureThread()
+		self._simplifier.start()
+
+		if recorder is None:
+			recorder = instrumentation.NullRecorder()
+		self._recorder = recorder
+		self._journal = journal.NullJournal()
 
 	@property
 	def toplevel(self):
 		return self._historyView
 
+	@property
+	def recorder(self):
+		return self._recorder
+
+	def get_journal(self):
+		return self._journal
+
+	def set_journal(self, stackJournal):
+		"""
+		@param stackJournal a journal.Journal to record every change to the
+			stack in, None to stop
+		"""
+		if stackJournal is None:
+			stackJournal = journal.NullJournal()
+		self._journal = stackJournal
+
+	journal = property(get_journal, set_journal)
+
+	def get_renderer(self):
+		return self._prettyRenderer
+
+	def set_renderer(self, renderer):
+		"""
+		@param renderer the render_number to display nodes with, every row is
+			rendered again with it
+		"""
+		self._prettyRenderer = renderer
+		self._renderCache = operation.RenderCache(renderer)
+		for row in self._historyModel:
+			row.equationText = self._renderCache.render(row.node)
+			if row.pendingId is None:
+				row.resultText = self._renderCache.render(row.simpleNode)
+		self._historyModel.rows_changed(0, len(self._historyModel) - 1)
+
+	renderer = property(get_renderer, set_renderer)
+
+	@property
+	def render_cache(self):
+		return self._renderCache
+
 	def push(self, node):
-		simpleNode = node.simplify()
+		with self._recorder.timed("push", getattr(node, "symbol", type(node).__name__)):
+			if operation.is_expensive(node):
+				return self.push_pending(node)
 
-		closeIcon = self._closeIcon
-		icon = QtGui.QStandardItem(closeIcon, "")
-		icon.setEditable(False)
-		icon.setCheckable(False)
-		equation = QtGui.QStandardItem(operation.render_operation(self._prettyRenderer, node))
-		equation.setData(node)
-		equation.setCheckable(False)
-		eqFont = equation.font()
-		eqFont.setPointSize(max(eqFont.pointSize() - 3, 5))
-		equation.setFont(eqFont)
-
-		result = QtGui.QStandardItem(operation.render_operation(self._prettyRenderer, simpleNode))
-		result.setData(simpleNode)
-		result.setEditable(False)
-		result.setCheckable(False)
-
-		row = (icon, equation, result)
-		self._historyStore.appendRow(row)
-
-		index = result.index()
-		self._historyView.scrollToBottom()
-		self._rowCount += 1
+			row = self._create_node_row(node)
+			self._historyModel.append_row(row)
+
+			self._scroll_after_push()
+			self._journal.record_push(node)
+
+	def push_restored(self, node, equationText, resultText):
+		if resultText is None:
+			return self.push(node)
+
+		row = self._create_row(node, node.simplify(), resultText, equationText)
+		self._historyModel.append_row(row)
+
+		self._scroll_after_push()
+
+	def push_pending(self, node):
+		row = self._create_pending_row(node)
+		self._historyModel.append_row(row)
+
+		self._scroll_after_push()
+		self._journal.record_push(node)
 
 	def pop(self):
 		if len(self) == 0:
 			raise IndexError("Not enough items in the history for the operation")
 
-		icon, equation, result = self._historyStore.takeRow(self._rowCount - 1)
-		self._rowCount -= 1
-		return equation.data()
+		row = self._historyModel.pop_row()
+		self._forget_pending(row, stop = False)
+		self._journal.record_pop(row.node)
+		return row.node
+
+	def pop_many(self, count):
+		if len(self) < count:
+			raise IndexError("Not enough items in the history for the operation")
+
+		rows = self._historyModel.pop_rows(count)
+		for row in reversed(rows):
+			self._forget_pending(row, stop = False)
+			self._journal.record_pop(row.node)
+		return [row.node for row in rows]
+
+	@contextlib.contextmanager
+	def batch(self):
+		self._historyModel.begin_batch()
+		try:
+			yield self
+		finally:
+			if self._historyModel.end_batch():
+				self._historyView.scrollToBottom()
 
 	def peek(self):
 		if len(self) == 0:
 			raise IndexError("Not enough items in the history for the operation")
 
-		icon, equation, result = self._historyStore.takeRow(self._rowCount - 1)
-		row = (icon, equation, result)
-		self._historyStore.appendRow(row)
+		return self._historyModel[-1].node
 
-		return equation.data()
+	def unpush(self):
+		if len(self) and self._historyModel[-1].pendingId is not None:
+			# Undoing a result being worked out gives up on it
+			self._revert_pending(self._historyModel[-1].pendingId)
+		else:
+			super(QCalcHistory, self).unpush()
 
 	def clear(self):
-		self._historyStore.clear()
-		self._rowCount = 0
+		if self._runningId is not None:
+			self._stop_running(self._runningId)
+		self._pendingRows.clear()
+		self._handedOverId = None
+		self._inheritedIds.clear()
+		self._historyModel.clear()
+		self._journal.record_clear()
+
+	def cancel(self):
+		"""
+		Give up on the most recently started background result, putting its
+		arguments back in its place
+
+		@returns whether there was a result to give up on
+		"""
+		if not self._pendingRows:
+			return False
+		self._revert_pending(max(self._pendingRows))
+		return True
+
+	def stop(self):
+		self._simplifier.stop()
+		if self._backend is not None:
+			self._backend.cancel()
 
 	def scroll_to_bottom(self):
 		self._historyView.scrollToBottom()
 
+	def _scroll_after_push(self):
+		# A batch scrolls once, when its rows are shown
+		if not self._historyModel.is_batching():
+			self._historyView.scrollToBottom()
+
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_row_activated(self, index):
 		with qui_utils.notify_error(self._errorLog):
 			if index.column() == self._CLOSE_COLUMN:
-				self._historyStore.removeRow(index.row(), index.parent())
-				self._rowCount -= 1
+				rowIndex = index.row()
+				row = self._historyModel.remove_row(rowIndex)
+				self._forget_pending(row)
+				self._journal.record_remove(rowIndex, row.node)
 			elif index.column() == self._EQ_COLUMN:
 				self._duplicate_row(index)
 			elif index.column() == self._RESULT_COLUMN:
@@ -129,55 +252,329 @@ class QCalcHistory(history.AbstractHistory):
 				raise NotImplementedError("Unsupported column to activate %s" % index.column())
 
 	@misc_utils.log_exception(_moduleLogger)
-	def _on_item_changed(self, item):
+	def _on_equation_edited(self, rowIndex, text):
+		with qui_utils.notify_error(self._errorLog):
+			# The row is left as it was if the new equation fails
+			eqNode = self._parse_value(str(text).strip())
+			newRow = self._create_node_row(eqNode)
+
+			self._forget_pending(self._historyModel[rowIndex])
+			self._historyModel.replace_row(rowIndex, newRow)
+			self._journal.record_replace(rowIndex, eqNode)
+
+	@misc_utils.log_exception(_moduleLogger)
+	def _on_simplified(self, pendingId, simplified):
 		with qui_utils.notify_error(self._errorLog):
-			if self._programmaticUpdate:
-				_moduleLogger.info("Blocking updating %r recursively" % item)
+			self._finished(pendingId)
+			row = self._pendingRows.pop(pendingId, None)
+			if row is None:
+				# Cancelled or its row is gone
 				return
-			self._programmaticUpdate = True
-			try:
-				if item.column() in [self._EQ_COLUMN, self._RESULT_COLUMN]:
-					self._update_input(item)
-				else:
-					raise NotImplementedError("Unsupported column to edit %s" % item.column())
-			except StandardError, e:
-				self._errorReporter.push_exception()
-			finally:
-				self._programmaticUpdate = False
+
+			simpleNode, resultText, renderCache = simplified
+			if renderCache is not self._renderCache:
+				# The renderer changed while it was worked out
+				resultText = self._renderCache.render(simpleNode)
+			row.simpleNode, row.resultText = simpleNode, resultText
+			row.pendingId = None
+			self._historyModel.row_changed(self._historyModel.find_row(row))
+
+	@misc_utils.log_exception(_moduleLogger)
+	def _on_simplify_failed(self, pendingId, error):
+		with qui_utils.notify_error(self._errorLog):
+			self._finished(pendingId)
+			if pendingId not in self._pendingRows:
+				return
+			# Leave the stack as if the operation never happened, like a
+			# failure while pushing
+			self._revert_pending(pendingId)
+			self._errorLog.push_error(str(error))
+
+	def _simplify(self, pendingId, node):
+		# Runs on the worker thread, so only the nodes are touched
+		if pendingId not in self._pendingRows:
+			return None, None, None
+		self._runningId = pendingId
+		try:
+			renderCache = self._renderCache
+			simpleNode = node.simplify()
+			return simpleNode, renderCache.render(simpleNode), renderCache
+		finally:
+			self._runningId = None
+
+	def _create_row(self, node, simpleNode, resultText, equationText = None):
+		if equationText is None:
+			equationText = self._renderCache.render(node)
+		return _HistoryRow(node, equationText, simpleNode, resultText)
+
+	def _create_node_row(self, node):
+		if operation.is_expensive(node):
+			return self._create_pending_row(node)
+		simpleNode = node.simplify()
+		resultText = self._renderCache.render(simpleNode)
+		return self._create_row(node, simpleNode, resultText)
+
+	def _create_pending_row(self, node):
+		pendingId = self._nextPendingId
+		self._nextPendingId += 1
+
+		row = self._create_row(node, None, self._PENDING_TEXT)
+		row.pendingId = pendingId
+		self._pendingRows[pendingId] = row
+		if self._handedOverId is not None:
+			self._inheritedIds[pendingId] = self._handedOverId
+			self._handedOverId = None
+
+		self._simplifier.add_task(
+			self._simplify, (pendingId, node), {},
+			functools.partial(self._on_simplified, pendingId),
+			functools.partial(self._on_simplify_failed, pendingId),
+		)
+		return row
+
+	def _forget_pending(self, row, stop = True):
+		"""
+		@param stop whether to stop working out the row's result, for rows the
+			user gave up on rather than ones taken as an argument
+		"""
+		pendingId = row.pendingId
+		if pendingId is None:
+			return
+		self._pendingRows.pop(pendingId, None)
+		if stop:
+			self._stop_running(pendingId)
+		elif self._runningId is not None and self._runningId in (pendingId, self._inheritedIds.get(pendingId)):
+			self._handedOverId = self._runningId
+		self._inheritedIds.pop(pendingId, None)
+
+	def _stop_running(self, pendingId):
+		runningId = self._runningId
+		if runningId is None or self._backend is None:
+			return
+		if runningId in (pendingId, self._inheritedIds.get(pendingId)):
+			self._backend.cancel()
+
+	def _finished(self, pendingId):
+		self._inheritedIds.pop(pendingId, None)
+		if self._handedOverId == pendingId:
+			self._handedOverId = None
+
+	def _revert_pending(self, pendingId):
+		row = self._pendingRows.pop(pendingId)
+		self._stop_running(pendingId)
+		self._inheritedIds.pop(pendingId, None)
+		rowIndex = self._historyModel.find_row(row)
+
+		self._historyModel.remove_row(rowIndex)
+		self._journal.record_remove(rowIndex, row.node)
+		for offset, child in enumerate(row.node.get_children()):
+			self._historyModel.insert_row(rowIndex + offset, self._create_node_row(child))
+			self._journal.record_insert(rowIndex + offset, child)
 
 	def _duplicate_row(self, index):
-		item = self._historyStore.item(index.row(), self._EQ_COLUMN)
-		self.push(item.data())
+		self.push(self._historyModel[index.row()].node)
 
 	def _parse_value(self, value):
 		raise NotImplementedError("What?")
 
-	def _update_input(self, item):
-		node = item.data()
-		try:
-			eqNode = self._parse_value(str(item.text()))
-			newText = operation.render_operation(self._prettyRenderer, eqNode)
-
-			eqItem = self._historyStore.item(item.row(), self._EQ_COLUMN)
-			eqItem.setData(eqNode)
-			eqItem.setText(newText)
-
-			resultNode = eqNode.simplify()
-			resultText = operation.render_operation(self._prettyRenderer, resultNode)
-			resultItem = self._historyStore.item(item.row(), self._RESULT_COLUMN)
-			resultItem.setData(resultNode)
-			resultItem.setText(resultText)
-		except:
-			oldText = operation.render_operation(self._prettyRenderer, node)
-			item.setText(oldText)
-			raise
+	def __len__(self):
+		return len(self._historyModel)
+
+	def __iter__(self):
+		for row in self._historyModel:
+			yield row.node
+
+
+class _HistoryRow(object):
+
+	__slots__ = ["node", "equationText", "simpleNode", "resultText", "pendingId"]
+
+	def __init__(self, node, equationText, simpleNode, resultText):
+		self.node = node
+		self.equationText = equationText
+		self.simpleNode = simpleNode
+		self.resultText = resultText
+		# Set while the result is worked out in the background
+		self.pendingId = None
+
+
+class _HistoryModel(QtCore.QAbstractTableModel):
+	"""
+	The stack as a plain list of rows, each a node and the text it is shown
+	with, that the view reads from only for the rows it paints.  Rows are
+	added and removed at the bottom without touching the others.
+
+	During a batch, rows added past the ones the view knows about stay
+	hidden from it until the batch ends and they are announced as one range.
+	"""
+
+	PENDING_ROLE = QtCore.Qt.UserRole + 2
+
+	equationEdited = qt_compat.Signal(int, object)
+
+	_HEADERS = ("", "Equation", "Result")
+
+	def __init__(self, closeIcon, parent = None):
+		QtCore.QAbstractTableModel.__init__(self, parent)
+		self._rows = []
+		self._shownCount = 0
+		self._batchDepth = 0
+		self._closeIcon = closeIcon
+		# Edits are parsed back, displayed text like octal 017 would read as
+		# decimal
+		self._editRenderer = operation.render_number_literal()
+		self._eqFont = QtGui.QFont()
+		self._eqFont.setPointSize(max(self._eqFont.pointSize() - 3, 5))
+
+	def rowCount(self, parent = QtCore.QModelIndex()):
+		if parent.isValid():
+			return 0
+		return self._shownCount
+
+	def columnCount(self, parent = QtCore.QModelIndex()):
+		if parent.isValid():
+			return 0
+		return len(self._HEADERS)
+
+	def data(self, index, role = QtCore.Qt.DisplayRole):
+		if not index.isValid():
+			return None
+		row = self._rows[index.row()]
+		column = index.column()
+
+		if role == QtCore.Qt.EditRole and column == QCalcHistory._EQ_COLUMN:
+			# Edited in full, even when shown elided
+			return operation.render_operation(self._editRenderer, row.node)
+		elif role == QtCore.Qt.DisplayRole or role == QtCore.Qt.EditRole:
+			if column == QCalcHistory._EQ_COLUMN:
+				return row.equationText
+			elif column == QCalcHistory._RESULT_COLUMN:
+				return row.resultText
+		elif role == QtCore.Qt.DecorationRole:
+			if column == QCalcHistory._CLOSE_COLUMN:
+				return self._closeIcon
+		elif role == QtCore.Qt.FontRole:
+			if column == QCalcHistory._EQ_COLUMN:
+				return self._eqFont
+		elif role == self.PENDING_ROLE:
+			return row.pendingId
+		return None
+
+	def setData(self, index, value, role = QtCore.Qt.EditRole):
+		if role != QtCore.Qt.EditRole or index.column() != QCalcHistory._EQ_COLUMN:
+			return False
+		# The history parses and replaces the row, or reports the error
+		self.equationEdited.emit(index.row(), value)
+		return True
+
+	def flags(self, index):
+		flags = QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+		if index.column() == QCalcHistory._EQ_COLUMN:
+			flags |= QtCore.Qt.ItemIsEditable
+		return flags
+
+	def headerData(self, section, orientation, role = QtCore.Qt.DisplayRole):
+		if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+			return self._HEADERS[section]
+		return None
+
+	def begin_batch(self):
+		self._batchDepth += 1
+
+	def end_batch(self):
+		"""
+		@returns whether rows were announced, once the outermost batch ends
+		"""
+		self._batchDepth -= 1
+		if self._batchDepth or self._shownCount == len(self._rows):
+			return False
+		self.beginInsertRows(QtCore.QModelIndex(), self._shownCount, len(self._rows) - 1)
+		self._shownCount = len(self._rows)
+		self.endInsertRows()
+		return True
+
+	def is_batching(self):
+		return 0 < self._batchDepth
+
+	def append_row(self, row):
+		self.insert_row(len(self._rows), row)
+
+	def insert_row(self, rowIndex, row):
+		if self._batchDepth and self._shownCount <= rowIndex:
+			self._rows.insert(rowIndex, row)
+			return
+		self.beginInsertRows(QtCore.QModelIndex(), rowIndex, rowIndex)
+		self._rows.insert(rowIndex, row)
+		self._shownCount += 1
+		self.endInsertRows()
+
+	def pop_row(self):
+		return self.remove_row(len(self._rows) - 1)
+
+	def pop_rows(self, count):
+		"""
+		Remove the bottom count rows, announcing the ones the view knows about
+		as one range
+
+		@returns the removed rows, in stack order
+		"""
+		first = len(self._rows) - count
+		rows = self._rows[first:]
+		hiddenFirst = max(first, self._shownCount)
+		del self._rows[hiddenFirst:]
+		if first < hiddenFirst:
+			self.beginRemoveRows(QtCore.QModelIndex(), first, hiddenFirst - 1)
+			del self._rows[first:]
+			self._shownCount = first
+			self.endRemoveRows()
+		return rows
+
+	def remove_row(self, rowIndex):
+		if self._shownCount <= rowIndex:
+			return self._rows.pop(rowIndex)
+		self.beginRemoveRows(QtCore.QModelIndex(), rowIndex, rowIndex)
+		row = self._rows.pop(rowIndex)
+		self._shownCount -= 1
+		self.endRemoveRows()
+		return row
+
+	def replace_row(self, rowIndex, row):
+		self._rows[rowIndex] = row
+		self.row_changed(rowIndex)
+
+	def row_changed(self, rowIndex):
+		self.rows_changed(rowIndex, rowIndex)
+
+	def rows_changed(self, first, last):
+		last = min(last, self._shownCount - 1)
+		if last < first:
+			return
+		self.dataChanged.emit(
+			self.index(first, 0),
+			self.index(last, len(self._HEADERS) - 1),
+		)
+
+	def find_row(self, row):
+		"""
+		@returns the index of row, searching up from the bottom where pending
+			rows usually are
+		"""
+		for rowIndex in xrange(len(self._rows) - 1, -1, -1):
+			if self._rows[rowIndex] is row:
+				return rowIndex
+		raise ValueError("Row isn't in the history")
+
+	def clear(self):
+		self.beginResetModel()
+		self._rows = []
+		self._shownCount = 0
+		self.endResetModel()
 
 	def __len__(self):
-		return self._rowCount
+		return len(self._rows)
+
+	def __getitem__(self, rowIndex):
+		return self._rows[rowIndex]
 
 	def __iter__(self):
-		for i in xrange(self._rowCount):
-			item = self._historyStore.item(i, self._EQ_COLUMN)
-			if item is None:
-				continue
-			yield item.data()
+		return iter(self._rows)
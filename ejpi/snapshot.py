@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+
+"""
+Binary snapshots of the calculator stack, restored without parsing,
+simplifying or rendering anything
+
+The stack's nodes are written bottom up as postfix instructions, each making
+one node that later instructions refer to by index, so shared subtrees are
+stored once.  Cached simplifications and the rows' rendered text are stored
+alongside.  Every section is fixed size records, read in place through mmap.
+
+Layout, all little endian:
+	header	including the journal generation the snapshot was compacted at
+	string index	(offset, length) into the string blob
+	values	type, base, 16 bytes of payload
+	instructions	opcode and two operands
+	arguments	node indices of function arguments
+	string blob
+
+The text format (RpnCalcHistory.serialize_stack) stays the portable one, a
+snapshot is only valid for the plugins and renderers it was written with.
+"""
+
+from __future__ import with_statement
+
+import os
+import mmap
+import struct
+
+import operation
+
+
+SNAPSHOT_MAGIC = "EJPS"
+SNAPSHOT_VERSION = 2
+
+
+class SnapshotError(ValueError):
+	pass
+
+
+_HEADER = struct.Struct("<4sHHIIIIII")
+_STRING = struct.Struct("<II")
+_VALUE = struct.Struct("<BBxx16s")
+_INSTRUCTION = struct.Struct("<BII")
+_ARGUMENT = struct.Struct("<I")
+
+_INT_PAYLOAD = struct.Struct("<q8x")
+_FLOAT_PAYLOAD = struct.Struct("<d8x")
+_COMPLEX_PAYLOAD = struct.Struct("<dd")
+_STRING_PAYLOAD = struct.Struct("<I12x")
+
+_VALUE_INT = 0
+_VALUE_LONG = 1
+_VALUE_FLOAT = 2
+_VALUE_COMPLEX = 3
+
+# Instructions making a node, in postfix order
+_OP_VALUE = 0 # value index
+_OP_VARIABLE = 1 # name string
+_OP_CONSTANT = 2 # name string
+_OP_FUNCTION = 3 # symbol string, argument count, taking the next arguments
+# Instructions referring to nodes already made
+_OP_SIMPLIFIED = 4 # node, its simplification
+_OP_RESULT = 5 # result text string of the next row
+_OP_ROW = 6 # node, equation text string
+# Instructions making a node, continued
+_OP_RENDERED_VALUE = 7 # value index, name string of the renderer it is shown with
+
+
+def save(path, nodes, renderer, generation = 0):
+	"""
+	Replace the snapshot at path, atomically
+
+	@param nodes the stack, bottom first
+	@param renderer the render_number the rows are displayed with
+	@param generation the first journal segment not included in the snapshot
+	"""
+	tempPath = "%s.tmp" % path
+	try:
+		with open(tempPath, "wb") as f:
+			write(f, nodes, renderer, generation)
+			f.flush()
+			os.fsync(f.fileno())
+		os.rename(tempPath, path)
+	except:
+		if os.path.exists(tempPath):
+			os.remove(tempPath)
+		raise
+
+
+def write(f, nodes, renderer, generation = 0):
+	writer = _SnapshotWriter(renderer)
+	for node in nodes:
+		writer.add_row(node)
+	writer.write(f, generation)
+
+
+class Snapshot(object):
+	"""
+	>>> import operator, StringIO
+	>>> add = operation.generate_function(operator.add, "+", operation.Function.REP_INFIX, 2)
+	>>> shared = add(operation.Value(2, 16), operation.Variable("x"))
+	>>> total = add(shared, shared)
+	>>> rows = [operation.Value(1.5, 10), shared, total]
+	>>> ignored = [row.simplify() for row in rows]
+	>>> f = StringIO.StringIO()
+	>>> write(f, rows, operation.render_number(), 3)
+	>>> snapshot = Snapshot(f.getvalue())
+	>>> snapshot.generation
+	3
+	>>> restored = list(snapshot.iter_rows({}, {"+": add}, operation.NodeInterner()))
+	>>> [(str(node), equation, result) for (node, equation, result) in restored]
+	[('1.5', '1.5', '1.5'), ('(2 + x)', '(0x2 + x)', '(0x2 + x)'), ('((2 + x) + (2 + x))', '((0x2 + x) + (0x2 + x))', '((0x2 + x) + (0x2 + x))')]
+	>>> restored[2][0].get_children()[0] is restored[1][0]
+	True
+	>>> restored[2][0]._simple is not None
+	True
+
+	Constants are stored by name, the values they simplify to by the renderer
+	they are shown with
+
+	>>> pi = operation.Constant("pi", operation.Value(3.5, operation.render_float_eng))
+	>>> row = add(operation.Variable("x"), pi)
+	>>> ignored = row.simplify()
+	>>> f = StringIO.StringIO()
+	>>> write(f, [row], operation.render_number())
+	>>> [(node, equation, result)] = Snapshot(f.getvalue()).iter_rows({"pi": pi}, {"+": add}, operation.NodeInterner())
+	>>> node.get_children()[1] is pi, equation, result
+	(True, '(x + pi)', '(x + 3.5)')
+	>>> node._simple.get_children()[1].base is operation.render_float_eng
+	True
+	>>> write(f, [operation.Value(1.5, lambda value: str(value))], operation.render_number())
+	Traceback (most recent call last):
+	SnapshotError: Can't snapshot values shown with <lambda>
+	"""
+
+	def __init__(self, data):
+		"""
+		@param data anything supporting the buffer interface, like a string or
+			an mmap
+		"""
+		self._data = data
+		if len(data) < _HEADER.size:
+			raise SnapshotError("Snapshot is truncated")
+		(
+			magic, version, reserved, self.generation,
+			self._stringCount, self._valueCount, self._instructionCount, self._argumentCount,
+			self._blobSize,
+		) = _HEADER.unpack_from(data, 0)
+		if magic != SNAPSHOT_MAGIC:
+			raise SnapshotError("Not a snapshot")
+		if version != SNAPSHOT_VERSION:
+			raise SnapshotError("Snapshot version %d is unsupported" % version)
+
+		self._stringsOffset = _HEADER.size
+		self._valuesOffset = self._stringsOffset + self._stringCount * _STRING.size
+		self._instructionsOffset = self._valuesOffset + self._valueCount * _VALUE.size
+		self._argumentsOffset = self._instructionsOffset + self._instructionCount * _INSTRUCTION.size
+		self._blobOffset = self._argumentsOffset + self._argumentCount * _ARGUMENT.size
+		if len(data) != self._blobOffset + self._blobSize:
+			raise SnapshotError("Snapshot is truncated")
+
+	@classmethod
+	def open(cls, path):
+		with open(path, "rb") as f:
+			try:
+				data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			except (mmap.error, ValueError), e:
+				raise SnapshotError("Can't map %s: %s" % (path, e))
+		try:
+			return cls(data)
+		except:
+			data.close()
+			raise
+
+	def close(self):
+		if isinstance(self._data, mmap.mmap):
+			self._data.close()
+
+	def iter_rows(self, constants, operators, interner):
+		"""
+		@returns an iterator of (node, equationText, resultText) for the stack,
+			bottom first, resultText being None when the node wasn't simplified
+		"""
+		try:
+			for row in self._iter_rows(constants, operators, interner):
+				yield row
+		except IndexError:
+			raise SnapshotError("Snapshot refers to a node it doesn't have")
+
+	def _iter_rows(self, constants, operators, interner):
+		# Decoding the tables in one call each is much cheaper than record by
+		# record, and they are only a fraction of the file
+		instructions = struct.unpack_from(
+			"<" + _INSTRUCTION.format[1:] * self._instructionCount, self._data, self._instructionsOffset
+		)
+		arguments = struct.unpack_from(
+			"<%dI" % self._argumentCount, self._data, self._argumentsOffset
+		)
+		functions = {}
+
+		nodes = []
+		nextArgument = 0
+		resultText = None
+		for i in xrange(0, len(instructions), 3):
+			op, a, b = instructions[i:i + 3]
+			if op == _OP_VALUE:
+				value, base = self._value(a)
+				nodes.append(interner.value(value, base))
+			elif op == _OP_RENDERED_VALUE:
+				value, base = self._value(a)
+				nodes.append(interner.value(value, _find_renderer(self._string(b))))
+			elif op == _OP_VARIABLE:
+				nodes.append(interner.variable(self._string(a)))
+			elif op == _OP_CONSTANT:
+				name = self._string(a)
+				try:
+					nodes.append(constants[name])
+				except KeyError:
+					raise SnapshotError("Unknown constant %s" % name)
+			elif op == _OP_FUNCTION:
+				try:
+					Node = functions[a]
+				except KeyError:
+					symbol = self._string(a)
+					try:
+						Node = functions[a] = operators[symbol]
+					except KeyError:
+						raise SnapshotError("Unknown operator %s" % symbol)
+				args = [nodes[arg] for arg in arguments[nextArgument:nextArgument + b]]
+				if len(args) != b:
+					raise SnapshotError("Argument %d is out of range" % (nextArgument + b))
+				nextArgument += b
+				nodes.append(interner.function(Node, *args))
+			elif op == _OP_SIMPLIFIED:
+				nodes[a]._simple = nodes[b]
+			elif op == _OP_RESULT:
+				resultText = self._string(a)
+			elif op == _OP_ROW:
+				yield nodes[a], self._string(b), resultText
+				resultText = None
+			else:
+				raise SnapshotError("Unknown instruction %d" % op)
+
+	def _string(self, index):
+		if not (0 <= index < self._stringCount):
+			raise SnapshotError("String %d is out of range" % index)
+		offset, length = _STRING.unpack_from(self._data, self._stringsOffset + index * _STRING.size)
+		if self._blobSize < offset + length:
+			raise SnapshotError("String %d is truncated" % index)
+		start = self._blobOffset + offset
+		return self._data[start:start + length]
+
+	def _value(self, index):
+		if not (0 <= index < self._valueCount):
+			raise SnapshotError("Value %d is out of range" % index)
+		valueType, base, payload = _VALUE.unpack_from(self._data, self._valuesOffset + index * _VALUE.size)
+		if valueType == _VALUE_INT:
+			value, = _INT_PAYLOAD.unpack(payload)
+			value = int(value)
+		elif valueType == _VALUE_LONG:
+			stringIndex, = _STRING_PAYLOAD.unpack(payload)
+			value = long(self._string(stringIndex), 16)
+		elif valueType == _VALUE_FLOAT:
+			value, = _FLOAT_PAYLOAD.unpack(payload)
+		elif valueType == _VALUE_COMPLEX:
+			value = complex(*_COMPLEX_PAYLOAD.unpack(payload))
+		else:
+			raise SnapshotError("Unknown value type %d" % valueType)
+		return value, base
+
+
+class _SnapshotWriter(object):
+
+	def __init__(self, renderer):
+		self._renderer = renderer
+		self._strings = []
+		self._stringIndices = {}
+		self._values = []
+		self._valueIndices = {}
+		self._instructions = []
+		self._arguments = []
+		self._nodeIndices = {}
+		self._simplified = set()
+		self._nodeCount = 0
+		# Nodes are held until written so their ids stay unique
+		self._nodes = []
+
+	def add_row(self, node):
+		nodeIndex = self._add_node(node)
+		self._add_simplification(node)
+		equationText = operation.render_operation(self._renderer, node)
+		simpleNode = _cached_simplification(node)
+		if simpleNode is not None:
+			resultText = operation.render_operation(self._renderer, simpleNode)
+			self._instructions.append((_OP_RESULT, self._string(resultText), 0))
+		self._instructions.append((_OP_ROW, nodeIndex, self._string(equationText)))
+
+	def write(self, f, generation):
+		blob = []
+		blobSize = 0
+		stringIndex = []
+		for text in self._strings:
+			stringIndex.append(_STRING.pack(blobSize, len(text)))
+			blob.append(text)
+			blobSize += len(text)
+
+		f.write(_HEADER.pack(
+			SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, generation,
+			len(self._strings), len(self._values), len(self._instructions), len(self._arguments),
+			blobSize,
+		))
+		f.write("".join(stringIndex))
+		f.write("".join(self._values))
+		f.write("".join(_INSTRUCTION.pack(*instruction) for instruction in self._instructions))
+		f.write(struct.pack("<%dI" % len(self._arguments), *self._arguments))
+		f.write("".join(blob))
+
+	def _add_node(self, root):
+		return operation.fold_tree(
+			root, self._emit_node, self._emitted_index, operation._construction_args,
+		)
+
+	def _add_simplification(self, node):
+		# Only the rows' own, nothing deeper is displayed and the arguments of
+		# an unpushed row are cheap to simplify again next to restoring
+		# every one of them
+		while isinstance(node, operation.Function) and node._simple is not None:
+			if id(node) in self._simplified:
+				break
+			self._simplified.add(id(node))
+			simpleIndex = self._add_node(node._simple)
+			self._instructions.append((_OP_SIMPLIFIED, self._nodeIndices[id(node)], simpleIndex))
+			node = node._simple
+
+	def _emitted_index(self, node):
+		return self._nodeIndices.get(id(node))
+
+	def _emit_node(self, node, args):
+		if isinstance(node, operation.Function):
+			self._arguments.extend(args)
+			instruction = (_OP_FUNCTION, self._string(node.symbol), len(args))
+		elif isinstance(node, operation.Value):
+			if isinstance(node.base, (int, long)):
+				instruction = (_OP_VALUE, self._value(node.value, node.base), 0)
+			else:
+				# Like the constants' values, shown with a renderer instead of in a base
+				rendererName = _renderer_name(node.base)
+				instruction = (_OP_RENDERED_VALUE, self._value(node.value, 0), self._string(rendererName))
+		elif isinstance(node, operation.Variable):
+			instruction = (_OP_VARIABLE, self._string(node.name), 0)
+		elif isinstance(node, operation.Constant):
+			instruction = (_OP_CONSTANT, self._string(node.name), 0)
+		else:
+			raise SnapshotError("Can't snapshot %r" % (node, ))
+		self._instructions.append(instruction)
+
+		index = self._nodeCount
+		self._nodeCount += 1
+		self._nodeIndices[id(node)] = index
+		self._nodes.append(node)
+		return index
+
+	def _string(self, text):
+		try:
+			return self._stringIndices[text]
+		except KeyError:
+			index = self._stringIndices[text] = len(self._strings)
+			self._strings.append(text)
+			return index
+
+	def _value(self, value, base):
+		key = operation._value_key(value, base)
+		try:
+			return self._valueIndices[key]
+		except KeyError:
+			pass
+
+		try:
+			if type(value) is long:
+				record = _VALUE.pack(_VALUE_LONG, base, _STRING_PAYLOAD.pack(self._string("%x" % value)))
+			elif isinstance(value, (int, long)):
+				record = _VALUE.pack(_VALUE_INT, base, _INT_PAYLOAD.pack(value))
+			elif isinstance(value, float):
+				record = _VALUE.pack(_VALUE_FLOAT, base, _FLOAT_PAYLOAD.pack(value))
+			elif isinstance(value, complex):
+				record = _VALUE.pack(_VALUE_COMPLEX, base, _COMPLEX_PAYLOAD.pack(value.real, value.imag))
+			else:
+				raise SnapshotError("Can't snapshot values of type %s" % type(value).__name__)
+		except struct.error, e:
+			raise SnapshotError("Can't snapshot %r in base %r: %s" % (value, base, e))
+		index = self._valueIndices[key] = len(self._values)
+		self._values.append(record)
+		return index
+
+
+def _renderer_name(renderer):
+	name = getattr(renderer, "__name__", "")
+	if _find_renderer(name, None) is not renderer:
+		raise SnapshotError("Can't snapshot values shown with %s" % (name or repr(renderer)))
+	return name
+
+
+def _find_renderer(name, default = SnapshotError):
+	"""
+	@returns one of operation's render_float functions by name
+	"""
+	renderer = getattr(operation, name, None) if name.startswith("render_float") else None
+	if renderer is None:
+		if default is SnapshotError:
+			raise SnapshotError("Unknown renderer %s" % name)
+		return default
+	return renderer
+
+
+def _cached_simplification(node):
+	if isinstance(node, operation.Function):
+		return node._simple
+	return node.simplify()
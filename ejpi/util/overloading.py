@@ -17,6 +17,17 @@ __all__ = [
 AnyType = object
 
 
+_DISPATCH_TEMPLATE = """
+def __call__(self, %(params)s):
+	%(count)s
+	try:
+		func = cache[%(key)s]
+	except KeyError:
+		func = resolve(%(args)s)
+	return func(%(args)s)
+"""
+
+
 class overloaded:
 	"""
 	Dynamically overloaded functions.
@@ -132,8 +143,40 @@ class overloaded:
 	Hello world
 	>>> two_arg(500, "World")
 	500 world
+	>>>
+	>>>
+	>>>
+	>>> #################
+	>>> #dispatch counters, registering only drops the cached calls it matches
+	>>> @overloaded
+	... def kind(x):
+	... 	return "object"
+	...
+	>>> @kind.register(str)
+	... def kind_str(x):
+	... 	return "str"
+	...
+	>>> kind.set_counting(True)
+	>>> kind(1), kind(2), kind("a")
+	('object', 'object', 'str')
+	>>> kind.calls, kind.misses
+	(3, 2)
+	>>> @kind.register(int)
+	... def kind_int(x):
+	... 	return "int"
+	...
+	>>> kind(1), kind("a")
+	('int', 'str')
+	>>> kind.calls, kind.misses, kind.invalidations
+	(5, 3, 1)
 	"""
 
+	def __new__(cls, default_func):
+		# Every overloaded function gets a class of its own, to hold the
+		# __call__ compiled for its registrations
+		dispatcherClass = type(cls.__name__, (cls, ), {})
+		return object.__new__(dispatcherClass)
+
 	def __init__(self, default_func):
 		# Decorator to declare new overloaded function.
 		self.registry = {}
@@ -143,6 +186,14 @@ class overloaded:
 		self.__doc__ = self.default_func.__doc__
 		self.__dict__.update (self.default_func.__dict__)
 
+		# Calls are only counted with set_counting, it costs a bit per call
+		self.calls = 0
+		self.misses = 0
+		self.invalidations = 0
+		self._counting = False
+		self._shape = None
+		self._compile()
+
 	def __get__(self, obj, type=None):
 		if obj is None:
 			return self
@@ -178,8 +229,25 @@ class overloaded:
 
 	def register_func(self, types, func):
 		"""Helper to register an implementation."""
-		self.registry[tuple(types)] = func
-		self.cache = {} # Clear the cache (later we can optimize this).
+		types = tuple(types)
+		self.registry[types] = func
+		if self._find_shape() != self._shape:
+			self._compile()
+			return
+
+		# Only the calls the new signature matches can resolve differently
+		stale = [key for key in self.cache if self._key_matches(types, key)]
+		for key in stale:
+			del self.cache[key]
+		self.invalidations += len(stale)
+
+	def set_counting(self, counting):
+		"""
+		Count every call in self.calls, cache misses and invalidations are
+		always counted
+		"""
+		self._counting = counting
+		self._compile()
 
 	def __call__(self, *args):
 		"""Call the overloaded function."""
@@ -189,6 +257,96 @@ class overloaded:
 			self.cache[types] = func = self.find_func(types)
 		return func(*args)
 
+	def _find_shape(self):
+		"""
+		@returns the number of arguments every call takes, None when that
+			varies, and the positions whose types pick the function
+		"""
+		arity = None
+		try:
+			args, varargs, varkw, defaults = inspect.getargspec(self.default_func)
+		except TypeError:
+			pass
+		else:
+			if varargs is None and not defaults:
+				arity = len(args)
+		if arity is None or any(len(sig) != arity for sig in self.registry):
+			return None, None
+
+		positions = set(
+			i
+			for sig in self.registry
+			for (i, t) in enumerate(sig)
+			if t is not AnyType
+		)
+		return arity, tuple(sorted(positions))
+
+	def _compile(self):
+		"""
+		Generate a __call__ for the current registrations, it only builds a
+		cache key from the arguments whose types matter
+		"""
+		shape = arity, positions = self._find_shape()
+		if shape != self._shape:
+			self.cache.clear()
+			self._shape = shape
+
+		if arity is None:
+			params = "*args"
+			callArgs = "*args"
+			key = "tuple(map(type, args))"
+		else:
+			names = ["a%d" % i for i in xrange(arity)]
+			params = callArgs = ", ".join(names)
+			if len(positions) == 0:
+				key = "None"
+			elif len(positions) == 1:
+				key = "type(%s)" % names[positions[0]]
+			else:
+				key = "(%s, )" % ", ".join("type(%s)" % names[i] for i in positions)
+
+		source = _DISPATCH_TEMPLATE % {
+			"params": params if params else "",
+			"count": "self.calls += 1" if self._counting else "pass",
+			"key": key,
+			"args": callArgs,
+		}
+		namespace = {"cache": self.cache, "resolve": self._resolve}
+		exec source in namespace
+		type(self).__call__ = namespace["__call__"]
+
+	def _resolve(self, *args):
+		types = tuple(map(type, args))
+		func = self.find_func(types)
+		self.cache[self._key(types)] = func
+		self.misses += 1
+		return func
+
+	def _key(self, types):
+		arity, positions = self._shape
+		if arity is None:
+			return types
+		elif len(positions) == 0:
+			return None
+		elif len(positions) == 1:
+			return types[positions[0]]
+		else:
+			return tuple(types[i] for i in positions)
+
+	def _key_matches(self, sig, key):
+		arity, positions = self._shape
+		if arity is None:
+			return len(sig) == len(key) and all(
+				t in inspect.getmro(keyType) for t, keyType in zip(sig, key)
+			)
+		elif len(positions) == 0:
+			return True
+		elif len(positions) == 1:
+			key = (key, )
+		return all(
+			sig[i] in inspect.getmro(keyType) for i, keyType in zip(positions, key)
+		)
+
 	def __contains__ (self, types):
 		return self.find_func(types) is not self.default_func
 